@@ -0,0 +1,93 @@
+"""
+Compares Queue's compress settings on the messages in tests/data.
+
+The corpus (the spam mbox and the other .msg files) is pushed into a queue over
+and over until it holds the requested number of messages, which are then all
+popped.  For each setting this reports how long pushing and popping took, how
+much of that was CPU time (compressing and decompressing), and how much space
+the queue took up: both the size of the messages and the blocks the files were
+actually given by the filesystem, which is what counts for the page cache.
+
+Run from the root of the repository:
+
+    python benchmarks/queue_compression.py --messages 5000
+"""
+import argparse
+import glob
+import mailbox
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from salmon import queue  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_corpus():
+    corpus = [msg.as_bytes() for msg in mailbox.mbox(os.path.join(ROOT, "tests", "data", "spam"))]
+    for path in sorted(glob.glob(os.path.join(ROOT, "tests", "data", "*.msg"))):
+        with open(path, "rb") as msg_file:
+            corpus.append(msg_file.read())
+    return corpus
+
+
+def disk_usage(queue_dir):
+    """Returns the bytes allocated to the messages in queue_dir"""
+    usage = 0
+    with os.scandir(os.path.join(queue_dir, "new")) as entries:
+        for entry in entries:
+            usage += entry.stat().st_blocks * 512
+    return usage
+
+
+def timed(func):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    func()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def benchmark(compress, corpus, messages):
+    queue_dir = os.path.join(tempfile.mkdtemp(), "queue")
+    try:
+        run_queue = queue.Queue(queue_dir, compress=compress)
+        push_wall, push_cpu = timed(lambda: run_queue.push_many(corpus[i % len(corpus)] for i in range(messages)))
+        stats = run_queue.stats(exact=True)
+        usage = disk_usage(queue_dir)
+        pop_wall, pop_cpu = timed(lambda: run_queue.pop_many(messages))
+    finally:
+        shutil.rmtree(os.path.dirname(queue_dir))
+
+    return {
+        "push messages/sec": messages / push_wall,
+        "push CPU (s)": push_cpu,
+        "pop messages/sec": messages / pop_wall,
+        "pop CPU (s)": pop_cpu,
+        "size (MiB)": stats["bytes"] / 2 ** 20,
+        "disk usage (MiB)": usage / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000, help="messages to put in the queue")
+    parser.add_argument("settings", nargs="*", default=["none"] + list(queue.COMPRESSION),
+                        help="compress settings to benchmark")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    print("corpus: %d messages, %d bytes on average" % (len(corpus), sum(map(len, corpus)) / len(corpus)))
+    for setting in args.settings:
+        results = benchmark(None if setting == "none" else setting, corpus, args.messages)
+        print(setting)
+        for key, value in results.items():
+            print("    %-22s %10.2f" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
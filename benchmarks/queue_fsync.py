@@ -0,0 +1,85 @@
+"""
+Compares Queue's fsync policies with several threads pushing at once, as an
+AsyncSMTPReceiver's delivery threads do when they spool messages.
+
+Each thread pushes its share of the messages one at a time, and this reports
+how many messages a second were pushed in total.  "group (no syncfs)" is the
+group policy with each message fsynced on its own, as it is where syncfs
+isn't available.
+
+fsync is close to free on tmpfs, which is where tempfile usually puts things,
+so point --dir at the filesystem the queue will really be on:
+
+    python benchmarks/queue_fsync.py --dir /var/spool/salmon --threads 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from salmon import queue  # noqa: E402
+
+MESSAGE = (b"From: me@example.com\nTo: you@example.com\nSubject: benchmark\n\n" + b"a" * 76 + b"\n") * 40
+
+SETTINGS = {
+    "none": ("none", True),
+    "message": ("message", True),
+    "group": ("group", True),
+    "group (no syncfs)": ("group", False),
+}
+
+
+def benchmark(fsync, base_dir, threads, messages):
+    queue_dir = os.path.join(tempfile.mkdtemp(dir=base_dir), "queue")
+    try:
+        run_queue = queue.Queue(queue_dir, fsync=fsync)
+        barrier = threading.Barrier(threads + 1)
+
+        def push():
+            barrier.wait()
+            for i in range(messages // threads):
+                run_queue.push(MESSAGE)
+
+        workers = [threading.Thread(target=push) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        pushed = len(run_queue)
+    finally:
+        shutil.rmtree(os.path.dirname(queue_dir))
+
+    return pushed / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=None, help="where to make the queues")
+    parser.add_argument("--threads", type=int, default=8, help="threads pushing at once")
+    parser.add_argument("--messages", type=int, default=2000, help="messages to push in total")
+    parser.add_argument("settings", nargs="*", default=list(SETTINGS), help="fsync settings to benchmark")
+    args = parser.parse_args()
+
+    print("syncfs: %s" % ("available" if queue._syncfs is not None else "not available"))
+    for setting in args.settings:
+        fsync, use_syncfs = SETTINGS[setting]
+        syncfs = queue._syncfs
+        if not use_syncfs:
+            queue._syncfs = None
+        try:
+            rate = benchmark(fsync, args.dir, args.threads, args.messages)
+        finally:
+            queue._syncfs = syncfs
+        print("%-20s %10.0f messages/sec" % (setting, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares QueueReceiver's thread and process modes on a CPU heavy handler.
+
+A queue is filled with messages that each have a few attachments, then a
+QueueReceiver is run over it with one_shot=True.  The handler walks every part
+of the message and decodes its body, so most of the time is spent parsing.
+Reported is the number of messages processed per second.
+
+Run from the root of the repository:
+
+    python benchmarks/queue_receiver.py --messages 2000 --workers 4
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from salmon import mail, queue, routing, server  # noqa: E402
+
+
+def make_message():
+    msg = mail.MailResponse(To="recipient@example.com", From="sender@example.com", Subject="benchmark",
+                            Body="All work and no play makes Jack a dull boy.\n" * 100)
+    for i in range(4):
+        msg.attach(filename="attachment%d.txt" % i, content_type="text/plain",
+                   data="All work and no play makes Jack a dull boy.\n" * 500)
+    return str(msg)
+
+
+def deliver(msg):
+    for part in msg.walk():
+        part.body
+
+
+def benchmark(mode, messages, workers, batch_size):
+    queue_dir = os.path.join(tempfile.mkdtemp(), "queue")
+    try:
+        run_queue = queue.Queue(queue_dir)
+        data = make_message()
+        for i in range(messages):
+            run_queue.push(data)
+
+        receiver = server.QueueReceiver(queue_dir, workers=workers, mode=mode, batch_size=batch_size)
+        start = time.perf_counter()
+        receiver.start(one_shot=True)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(os.path.dirname(queue_dir))
+
+    return {
+        "messages/sec": receiver.metrics["delivered"] / elapsed,
+        "blocked (s)": receiver.metrics["blocked"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000, help="messages to put in the queue")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="workers for each receiver")
+    parser.add_argument("--batch-size", type=int, default=1, help="messages handed to a worker at a time")
+    parser.add_argument("modes", nargs="*", default=["thread", "process"], help="modes to benchmark")
+    args = parser.parse_args()
+
+    # the Router is replaced before the workers are forked, so they use it too
+    routing.Router.deliver = deliver
+
+    for mode in args.modes:
+        results = benchmark(mode, args.messages, args.workers, args.batch_size)
+        print(mode)
+        for key, value in results.items():
+            print("    %-22s %10.2f" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Compares the throughput and latency of Salmon's SMTP receivers.
+
+Each receiver is run in its own process with an empty Router, so every message
+is parsed and then discarded. A number of client threads then open sessions
+with smtplib and send a single message each. Two numbers are reported:
+
+- sessions/sec: complete sessions (connect, EHLO, MAIL, RCPT, DATA, QUIT) per second
+- p50/p99 DATA-to-250: the time between sending DATA and receiving the reply to the end of data
+
+Run from the root of the repository:
+
+    python benchmarks/receivers.py --clients 20 --sessions 100
+"""
+from multiprocessing import Event, Process
+import argparse
+import os
+import smtplib
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from salmon import server  # noqa: E402
+
+MESSAGE = (
+    "From: sender@example.com\r\n"
+    "To: recipient@example.com\r\n"
+    "Subject: benchmark\r\n"
+    "\r\n"
+) + "All work and no play makes Jack a dull boy.\r\n" * 100
+
+RECEIVERS = {
+    "SMTPReceiver": server.SMTPReceiver,
+    "AsyncSMTPReceiver": server.AsyncSMTPReceiver,
+}
+
+
+def run_receiver(name, port, ready):
+    receiver = RECEIVERS[name](host="127.0.0.1", port=port)
+    receiver.start()
+    ready.set()
+    # multiprocessing runs its exit handlers once this function returns, which
+    # would take down any thread pools, so wait here until we're terminated
+    threading.Event().wait()
+
+
+def client(port, sessions, latencies, errors):
+    for i in range(sessions):
+        try:
+            conn = smtplib.SMTP("127.0.0.1", port, timeout=10)
+            conn.ehlo()
+            conn.mail("sender@example.com")
+            conn.rcpt("recipient@example.com")
+            start = time.perf_counter()
+            code, _ = conn.data(MESSAGE)
+            latencies.append(time.perf_counter() - start)
+            if code != 250:
+                errors.append(code)
+            conn.quit()
+        except (OSError, smtplib.SMTPException) as exc:
+            errors.append(exc)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def benchmark(name, port, clients, sessions):
+    ready = Event()
+    proc = Process(target=run_receiver, args=(name, port, ready))
+    proc.start()
+    try:
+        ready.wait(10)
+        latencies = []
+        errors = []
+        threads = [threading.Thread(target=client, args=(port, sessions, latencies, errors)) for i in range(clients)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.join()
+
+    return {
+        "sessions/sec": len(latencies) / elapsed,
+        "p50 DATA-to-250 (ms)": percentile(latencies, 50) * 1000,
+        "p99 DATA-to-250 (ms)": percentile(latencies, 99) * 1000,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20, help="concurrent client threads")
+    parser.add_argument("--sessions", type=int, default=100, help="sessions per client")
+    parser.add_argument("--port", type=int, default=8899, help="port to run receivers on")
+    parser.add_argument("receivers", nargs="*", default=list(RECEIVERS), help="receivers to benchmark")
+    args = parser.parse_args()
+
+    for name in args.receivers:
+        results = benchmark(name, args.port, args.clients, args.sessions)
+        print(name)
+        for key, value in results.items():
+            print("    %-22s %10.2f" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
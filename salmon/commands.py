@@ -3,12 +3,14 @@ Documentation for this module can be found in :doc:`commandline`
 """
 from importlib import import_module
 import glob
+import json
 import mailbox
 import os
 import shutil
 import signal
 import socket
 import sys
+import time
 
 import click
 
@@ -146,22 +148,34 @@ def sendmail(port, host, recipients, debug, lmtp):
 
 @daemon_start(main.command, additional_options=[
     click.option("--boot", metavar="MODULE", default="config.boot", help="module with server definition"),
+    click.option("--processes", metavar="N", default=1, type=click.IntRange(min=1),
+                 help="number of worker processes to run the receiver in"),
 ], short_help="starts a server")
-def start(pid, force, chdir, boot, chroot, uid, gid, umask, debug, daemon):
+def start(pid, force, chdir, boot, chroot, uid, gid, umask, debug, daemon, processes):
     """
     Runs a salmon server out of the current directory
+
+    With --processes, the receiver's socket is bound once and then that many
+    worker processes are forked to share it. Workers that die are restarted,
+    and signals sent to the main process are passed on to the workers.
     """
     utils.start_server(pid, force, chroot, chdir, uid, gid, umask,
-                       lambda: utils.import_settings(True, boot_module=boot), debug, daemon)
+                       lambda: utils.import_settings(True, boot_module=boot), debug, daemon, processes=processes)
 
 
 @main.command(short_help="stops a server")
 @click.option("--pid", metavar="PATH", default=DEFAULT_PID_FILE, help="path to pid file")
 @click.option("-f", "--force", default=False, is_flag=True, help="force stop server")
 @click.option("--all", "all_pids", help="stops all servers with .pid files in the specified directory")
-def stop(pid, force, all_pids):
+@click.option("--graceful", default=False, is_flag=True, help="let sessions finish their transactions first")
+@click.option("--timeout", metavar="SECONDS", default=60, type=int, help="how long to wait for a graceful stop")
+def stop(pid, force, all_pids, graceful, timeout):
     """
     Stops a running salmon server
+
+    With --graceful, the server stops accepting connections and waits for
+    current transactions to finish before exiting.  This only works with the
+    Async receivers, see their drain_timeout option.
     """
     pid_files = []
 
@@ -183,6 +197,12 @@ def stop(pid, force, all_pids):
         try:
             if force:
                 os.kill(int(pid_data), signal.SIGKILL)
+            elif graceful:
+                os.kill(int(pid_data), signal.SIGTERM)
+                # the server removes its own pid file once it's done
+                wait_for(lambda: not is_running(int(pid_data)), timeout,
+                         "Salmon on PID %d didn't stop in time" % int(pid_data))
+                continue
             else:
                 os.kill(int(pid_data), signal.SIGHUP)
 
@@ -191,6 +211,58 @@ def stop(pid, force, all_pids):
             raise click.ClickException("stopping Salmon on PID %d: %s" % (int(pid_data), exc))
 
 
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def read_pid(pid):
+    try:
+        with open(pid) as pid_file:
+            return int(pid_file.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def wait_for(condition, timeout, message):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise click.ClickException(message)
+        time.sleep(0.1)
+
+
+@main.command(short_help="restarts a server without dropping connections")
+@click.option("--pid", metavar="PATH", default=DEFAULT_PID_FILE, help="path to pid file")
+@click.option("--timeout", metavar="SECONDS", default=60, type=int, help="how long to wait for the new server")
+def restart(pid, timeout):
+    """
+    Restarts a running salmon server
+
+    The server starts a new copy of itself that takes over its listening
+    socket and then stops gracefully, so no connections are refused.  If the
+    new copy fails to start, the old one carries on.  This only works with
+    the Async receivers and a server started as a daemon.
+    """
+    old_pid = read_pid(pid)
+    if old_pid is None:
+        raise click.FileError(pid, "Maybe Salmon isn't running?")
+
+    click.echo("Restarting salmon at pid %d" % old_pid)
+    try:
+        os.kill(old_pid, signal.SIGUSR2)
+    except OSError as exc:
+        raise click.ClickException("restarting Salmon on PID %d: %s" % (old_pid, exc))
+
+    # the old server only stops once the new one is up, and otherwise carries on
+    wait_for(lambda: not is_running(old_pid), timeout,
+             "Salmon on PID %d didn't restart in time, see its logs" % old_pid)
+    click.echo("Salmon restarted with PID %d" % read_pid(pid))
+
+
 @main.command(short_help="displays status of server")
 @click.option("--pid", metavar="PATH", default=DEFAULT_PID_FILE, help="path to pid file")
 def status(pid):
@@ -211,10 +283,12 @@ def status(pid):
 @click.option("--get", metavar="KEY", help="get key from queue")
 @click.option("--remove", metavar="KEY", help="remove chosen key from queue")
 @click.option("--count", default=False, is_flag=True, help="count messages in queue")
+@click.option("--stats", default=False, is_flag=True, help="print queue depth, size and oldest message age as JSON")
 @click.option("--clear", default=False, is_flag=True, help="clear queue")
+@click.option("--workers", metavar="N", default=1, type=click.IntRange(min=1), help="threads to clear the queue with")
 @click.option("--keys", default=False, is_flag=True, help="print queue keys")
 @click.argument("name", metavar="PATH", default="./run/queue")
-def queue(name, pop, get, keys, remove, count, clear):
+def queue(name, pop, get, keys, remove, count, stats, clear, workers):
     """
     Lets you do most of the operations available to a queue.
     """
@@ -233,8 +307,10 @@ def queue(name, pop, get, keys, remove, count, clear):
         inq.remove(remove)
     elif count:
         click.echo("Queue %s contains %d messages" % (name, len(inq)))
+    elif stats:
+        click.echo(json.dumps(inq.stats()))
     elif clear:
-        inq.clear()
+        click.echo("Removed %d messages" % inq.clear(workers))
     elif keys:
         click.echo("\n".join(inq.keys()))
 
@@ -94,13 +94,17 @@ class ConfirmationEngine:
     def __init__(self, pending_queue, storage):
         """
         The pending_queue should be a string with the path to the salmon.queue.Queue
-        that will store pending messages.  These messages are the originals the user
+        that will store pending messages, or a queue object such as a
+        salmon.queue.SQLiteQueue.  These messages are the originals the user
         sent when they tried to confirm.
 
         Storage should be something that is like ConfirmationStorage so that this
         can store things for later verification.
         """
-        self.pending = queue.Queue(pending_queue)
+        if isinstance(pending_queue, str):
+            self.pending = queue.Queue(pending_queue)
+        else:
+            self.pending = pending_queue
         self.storage = storage
 
     def get_pending(self, pending_id):
@@ -5,6 +5,9 @@ salmon.routing.RoutingBase.UNDELIVERABLE_QUEUE if you want mail that Salmon
 doesn't understand to be delivered like normal.  The Router will dump
 any mail that doesn't match into that queue if you set it, and then you can
 load this handler into a special queue receiver to have it forwarded on.
+Messages that no other handler has modified are relayed as they were
+received rather than being converted back into a string, see
+salmon.server.Relay.deliver.
 
 BE VERY CAREFUL WITH THIS.  It should only be used in testing scenarios as
 it can turn your server into an open relay if you're not careful.  You
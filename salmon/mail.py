@@ -43,6 +43,14 @@ def _decode_header_randomness(addr):
         raise encoding.EncodingError("Address must be a string or a list not: %r", type(addr))
 
 
+def _snapshot(part):
+    """Returns enough of part to tell if it's been changed later, see MailRequest.is_modified"""
+    mime_part = part.mime_part
+    # the payload of a multipart message is its parts, which are compared separately
+    payload = None if mime_part.is_multipart() else mime_part.get_payload()
+    return mime_part.items(), payload, [_snapshot(child) for child in part.parts]
+
+
 class MailRequest:
     """
     This is what is given to your message handlers. The information you get out
@@ -73,6 +81,7 @@ class MailRequest:
             self.To = None
 
         self.base = encoding.from_string(self.Data)
+        self._snapshot = _snapshot(self.base)
 
         if 'from' not in self.base:
             self.base['from'] = self.From
@@ -141,6 +150,15 @@ class MailRequest:
         for x in self.base.walk():
             yield x
 
+    def is_modified(self):
+        """
+        Returns True if the headers, body or parts of this message have been
+        changed since it was parsed from Data, in which case str(message)
+        has to be used to get them.  Messages that were missing a From or To
+        header count as modified, since one is added for them.
+        """
+        return _snapshot(self.base) != self._snapshot
+
     def is_bounce(self, threshold=0.3):
         """
         Determines whether the message is a bounce message based on
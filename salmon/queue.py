@@ -4,13 +4,30 @@ do get a lot more features from the Python library, so if you need
 to do some serious surgery go use that.  This works as a good
 API for the 90% case of "put mail in, get mail out" queues.
 """
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from multiprocessing.dummy import Pool
+import collections
+import contextlib
+import ctypes
+import ctypes.util
 import errno
 import hashlib
+import heapq
+import io
+import itertools
 import logging
+import lzma
 import mailbox
 import os
+import re
+import select
 import socket
+import sqlite3
+import struct
+import threading
 import time
+import zlib
 
 from salmon import mail
 
@@ -18,6 +35,96 @@ from salmon import mail
 # email we put in a queue
 HASHED_HOSTNAME = hashlib.md5(socket.gethostname().encode("utf-8")).hexdigest()
 
+# how many files Queue reads from a directory at a time
+SCAN_BATCH = 1000
+
+# how durable Queue.push is, see Queue.__init__
+FSYNC_POLICIES = ("none", "message", "group")
+
+# the parts of a Maildir key that say when it was created: the time in
+# seconds and microseconds, and how many keys the process had created before
+MAILDIR_KEY_ORDER = re.compile(r"(\d+)\.M(\d+)P\d+Q(\d+)\.")
+
+# priorities messages can be pushed with if Queue is given them, and how many
+# of each are popped for every message of weight 1
+PRIORITIES = {"high": 4, "normal": 2, "low": 1}
+
+# how Queue(compress=...) can compress messages: the prefix written before
+# them, so they can be told apart from messages that aren't compressed (which
+# never start with a NUL), and the functions to compress and decompress them
+COMPRESSION = {
+    "zlib": (b"\0SQz", zlib.compress, zlib.decompress),
+    "lzma": (b"\0SQx", lzma.compress, lzma.decompress),
+}
+
+# the prefix is followed by the size of the message uncompressed
+_COMPRESSED_HEADER = struct.Struct(">4sQ")
+_DECOMPRESSORS = {prefix: decompress for prefix, compress, decompress in COMPRESSION.values()}
+# what they raise when a compressed message has been truncated or corrupted
+_DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError)
+
+# messages are only ever claimed or deleted from the front of the queue, and
+# the number and size of those waiting are kept up to date by triggers so
+# len and stats don't count them
+SQLITE_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data BLOB NOT NULL,
+    pushed_at REAL NOT NULL,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS waiting ON messages (id) WHERE claimed_at IS NULL;
+CREATE INDEX IF NOT EXISTS claimed ON messages (claimed_at) WHERE claimed_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS counts (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    waiting INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counts VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS pushed AFTER INSERT ON messages WHEN NEW.claimed_at IS NULL
+BEGIN
+    UPDATE counts SET waiting = waiting + 1, bytes = bytes + length(NEW.data);
+END;
+CREATE TRIGGER IF NOT EXISTS removed AFTER DELETE ON messages WHEN OLD.claimed_at IS NULL
+BEGIN
+    UPDATE counts SET waiting = waiting - 1, bytes = bytes - length(OLD.data);
+END;
+CREATE TRIGGER IF NOT EXISTS claimed AFTER UPDATE OF claimed_at ON messages
+BEGIN
+    UPDATE counts SET
+        waiting = waiting + (NEW.claimed_at IS NULL) - (OLD.claimed_at IS NULL),
+        bytes = bytes + length(NEW.data) * (NEW.claimed_at IS NULL) - length(OLD.data) * (OLD.claimed_at IS NULL);
+END;
+COMMIT;
+"""
+
+# inotify constants from <sys/inotify.h>
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError):
+    # not Linux, Queue.wait falls back to sleeping
+    _libc = None
+
+# flushes a whole filesystem in one go, see Queue._sync_tmp
+_syncfs = getattr(_libc, "syncfs", None)
+
+
+def _unlink(path):
+    """Removes the file at path, returns 1 if it did or 0 if it was already gone"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return 0
+    return 1
+
 
 class SafeMaildir(mailbox.Maildir):
     def _create_tmp(self):
@@ -42,6 +149,150 @@ class SafeMaildir(mailbox.Maildir):
         raise mailbox.ExternalClashError('Name clash prevented file creation: %s' % path)
 
 
+class InotifyWatcher:
+    """
+    Watches directories for new files using inotify, which is only available
+    on Linux.  Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self, *paths):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        for path in paths:
+            if _libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CREATE | IN_MOVED_TO) < 0:
+                err = ctypes.get_errno()
+                self.close()
+                raise OSError(err, os.strerror(err), path)
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for a file to appear, returns True if one
+        did.  Any events that have built up since the last call count.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+
+        # we only care that something happened, not what
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _compress(method, data):
+    prefix, compress, decompress = COMPRESSION[method]
+    return _COMPRESSED_HEADER.pack(prefix, len(data)) + compress(data)
+
+
+def _decompress(data):
+    """Returns data uncompressed if it was compressed by _compress, otherwise as it is"""
+    decompress = _DECOMPRESSORS.get(data[:4]) if data[:1] == b"\0" else None
+    if decompress is None:
+        return data
+    return decompress(data[_COMPRESSED_HEADER.size:])
+
+
+def _message_size(path):
+    """Returns the size of the message in the file at path, uncompressed"""
+    with open(path, "rb") as msg_file:
+        header = msg_file.read(_COMPRESSED_HEADER.size)
+        if len(header) == _COMPRESSED_HEADER.size and header[:4] in _DECOMPRESSORS:
+            return _COMPRESSED_HEADER.unpack(header)[1]
+        return os.fstat(msg_file.fileno()).st_size
+
+
+def _merge_stats(all_stats):
+    """Adds up the results of several queues' stats methods"""
+    ages = [stats["oldest_age"] for stats in all_stats if stats["oldest_age"] is not None]
+    return {
+        "depth": sum(stats["depth"] for stats in all_stats),
+        "bytes": sum(stats["bytes"] for stats in all_stats),
+        "oldest_age": max(ages) if ages else None,
+    }
+
+
+def _key_time(key):
+    """Returns when the message with key was pushed, from the time at the start of Maildir keys"""
+    try:
+        return int(key.split(".", 1)[0])
+    except ValueError:
+        return None
+
+
+def _key_order(name):
+    """
+    Returns something to sort Maildir file names by so that the oldest comes
+    first, see MAILDIR_KEY_ORDER.  Names that aren't in the usual format go
+    before the rest.
+    """
+    match = MAILDIR_KEY_ORDER.match(name)
+    if match is None:
+        return (0, 0, 0, name)
+    return (int(match.group(1)), int(match.group(2)), int(match.group(3)), name)
+
+
+class _Stats:
+    """
+    Running totals of the messages in a Maildir, see Queue.stats.  The time
+    each message was pushed is counted to the second, so that the oldest can
+    be found without looking at every message.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.times = collections.Counter()
+        self._heap = []
+
+    def add(self, key, size):
+        self.count += 1
+        self.bytes += size
+        pushed = _key_time(key)
+        if pushed is not None:
+            if not self.times[pushed]:
+                heapq.heappush(self._heap, pushed)
+            self.times[pushed] += 1
+
+    def remove(self, key, size):
+        self.count = max(self.count - 1, 0)
+        self.bytes = max(self.bytes - size, 0)
+        pushed = _key_time(key)
+        if self.times[pushed] > 1:
+            self.times[pushed] -= 1
+        else:
+            self.times.pop(pushed, None)
+
+    def oldest(self):
+        """Returns when the oldest message was pushed, or None if there aren't any"""
+        # times that have no messages left are only taken off the heap here
+        while self._heap and self._heap[0] not in self.times:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+
+class _Group:
+    """Messages that are being committed to a queue together, see Queue._commit_group"""
+
+    def __init__(self):
+        self.files = []
+        self.done = False
+        self.error = None
+
+
 class QueueError(Exception):
 
     def __init__(self, msg, data):
@@ -57,7 +308,8 @@ class Queue:
     most robust, but could implement others later.
     """
 
-    def __init__(self, queue_dir, safe=False, pop_limit=0, oversize_dir=None):
+    def __init__(self, queue_dir, safe=False, pop_limit=0, oversize_dir=None, fsync=False, exact_len=False,
+                 priorities=None, group_window=0, compress=None, ordered=False):
         """
         This gives the Maildir queue directory to use, and whether you want
         this Queue to use the SafeMaildir variant which hashes the hostname
@@ -73,14 +325,94 @@ class Queue:
         The oversize protection only works on pop messages off, not
         putting them in, get, or any other call.  If you use get you can
         use self.oversize to also check if it's oversize manually.
+
+        fsync is one of FSYNC_POLICIES, which decides what push does before it
+        returns to make sure a message will survive a crash or power failure:
+
+        - "none" (or False): nothing, it's up to the filesystem
+        - "message" (or True): the message and the directory entry for it are
+          flushed to disk
+        - "group": the same, but messages pushed by other threads while a
+          group is being flushed wait to be flushed together in the next
+          one, with a single syncfs (on Linux) and one flush of new/.
+          Setting group_window makes each group wait that many seconds for
+          more messages first.
+
+        Messages that have been claimed (see claim) are kept in the claimed
+        directory of the Maildir until they're acked or released.
+
+        Counting the messages in a big queue is slow, so by default len only
+        does it the first time and then keeps track of what this Queue has
+        pushed and popped since.  Set exact_len to True to count them every
+        time, which you'll want to do if other processes use the queue too.
+
+        Messages can be pushed with any of the priorities in priorities, which
+        maps them to weights, e.g. PRIORITIES.  By default there's only
+        "normal", so the queue is a single Maildir.  Each priority has its own
+        lane: "normal" is queue_dir itself and the others are Maildir++ style
+        subfolders, such as queue_dir/.high.  Messages are popped from the
+        lanes in proportion to their weights, so a lane with a backlog doesn't
+        hold up the others and low priority messages still trickle through.
+        Keys of messages in lanes other than "normal" start with the
+        priority, e.g. "high/...".
+
+        compress is None, or one of COMPRESSION (True means "zlib") to
+        compress messages as they're pushed.  zlib is several times faster
+        than lzma, which only does better on big messages (see
+        benchmarks/queue_compression.py).  Messages are decompressed when
+        they're read whether or not compress is set, so a queue can hold a mix
+        of both.  pop_limit is compared with the size of messages
+        uncompressed, but messages moved to oversize_dir stay compressed.
+        pop and claim also move compressed messages that can't be
+        decompressed to oversize_dir (deleting them if it isn't set), rather
+        than raising.
+
+        By default pop and claim take messages in whatever order the
+        filesystem lists them.  Set ordered to True to take the oldest first,
+        going by the time and sequence number in their keys.  The queue is
+        listed once and kept in a heap until it's been taken, with messages
+        this Queue pushes or releases meanwhile added to the heap; messages
+        pushed by other processes are found once it's empty.  Each priority
+        lane is ordered separately, and keys from processes with different
+        clocks are only as ordered as the clocks.
         """
+        if priorities is not None and "normal" not in priorities:
+            raise ValueError("priorities must include 'normal'")
+        fsync = {False: "none", True: "message"}.get(fsync, fsync)
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s, not %r" % (", ".join(FSYNC_POLICIES), fsync))
+        compress = {False: None, True: "zlib"}.get(compress, compress)
+        if compress is not None and compress not in COMPRESSION:
+            raise ValueError("compress must be None or one of %s, not %r" % (", ".join(COMPRESSION), compress))
+
         self.dir = queue_dir
+        self.fsync = fsync
+        self.compress = compress
+        self.ordered = ordered
+        self.group_window = group_window
+        self._group = None
+        self._group_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self.exact_len = exact_len
+        self._watcher = None
+        # see _Stats, None until the messages have been counted
+        self._stats = None
+        # files that pop and claim will try next, and the directory scan
+        # that they came from.  When ordered it's a heap of the whole scan.
+        self._cursor = [] if ordered else collections.deque()
+        self._scan = None
+        # mtimes of new/ and cur/ when they were last found empty
+        self._empty_mtimes = None
 
         if safe:
             self.mbox = SafeMaildir(queue_dir)
         else:
             self.mbox = mailbox.Maildir(queue_dir)
 
+        # only made once something is claimed, see _make_claimed_dir
+        self.claimed_dir = os.path.join(queue_dir, "claimed")
+        self._claimed_dir_made = False
+
         self.pop_limit = pop_limit
 
         if oversize_dir:
@@ -94,58 +426,557 @@ class Queue:
         else:
             self.oversize_dir = None
 
-    def push(self, message):
+        self.priorities = priorities or {"normal": 1}
+        self.lanes = {"normal": self}
+        for priority in self.priorities:
+            if priority != "normal":
+                self.lanes[priority] = Queue(os.path.join(queue_dir, "." + priority), safe, pop_limit, oversize_dir,
+                                             fsync, exact_len, priorities=None, group_window=group_window,
+                                             compress=compress, ordered=ordered)
+        # for smooth weighted round robin, see _next_lane
+        self._current_weights = dict.fromkeys(self.priorities, 0)
+
+    def push(self, message, priority="normal"):
         """
         Pushes the message onto the queue.  Remember the order is probably
         not maintained.  It returns the key that gets created.
+
+        The message can also be a binary file, which is copied into the queue
+        a line at a time.
         """
-        if not isinstance(message, (str, bytes)):
-            # bytes is ok, but anything else needs to be turned into str
-            message = str(message)
-        return self.mbox.add(message)
+        return self.push_many([message], priority)[0]
 
-    def pop(self):
+    def push_many(self, messages, priority="normal"):
+        """
+        Pushes each of messages onto the queue, see push, and returns their
+        keys.  Unless fsync is "none", they're flushed to disk together, see
+        _sync_tmp, and new/ is only flushed once for all of them.
         """
-        Pops a message off the queue, order is not really maintained
-        like a stack.
+        if priority not in self.lanes:
+            raise ValueError("Unknown priority %r, expected one of %s" % (priority, ", ".join(self.lanes)))
+
+        lane = self.lanes[priority]
+        files = []
+        try:
+            for message in messages:
+                files.append(lane._write_tmp(message))
+
+            if not files:
+                pass
+            elif lane.fsync == "group":
+                lane._commit_group(files)
+            else:
+                lane._commit(files)
+        except BaseException:
+            for path, key, size in files:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        for path, key, size in files:
+            lane._added(key, size)
+        prefix = "" if lane is self else priority + "/"
+        return [prefix + key for path, key, size in files]
 
-        It returns a (key, message) tuple for that item.
+    def _write_tmp(self, message):
+        """
+        Writes message to a file in tmp/, which is flushed to disk by _commit.
+        Returns the path of the file, the message's key and its size.
         """
-        for key in self.mbox.iterkeys():
-            over, over_name = self.oversize(key)
+        if not isinstance(message, (str, bytes)) and not hasattr(message, "read"):
+            # bytes and files are ok, but anything else needs to be turned into str
+            message = str(message)
 
-            if over:
-                if self.oversize_dir:
-                    logging.info("Message key %s over size limit %d, moving to %s.",
-                                 key, self.pop_limit, self.oversize_dir)
-                    os.rename(over_name, os.path.join(self.oversize_dir, key))
-                else:
-                    logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
-                                 key, self.pop_limit)
-                    os.unlink(over_name)
+        if self.compress:
+            buf = io.BytesIO()
+            self.mbox._dump_message(message, buf)
+            message = _compress(self.compress, buf.getvalue())
+
+        tmp_file = self.mbox._create_tmp()
+        try:
+            if self.compress:
+                # _dump_message would change line endings in the compressed data
+                tmp_file.write(message)
             else:
+                self.mbox._dump_message(message, tmp_file)
+            tmp_file.flush()
+            size = tmp_file.tell()
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+        tmp_file.close()
+
+        return tmp_file.name, os.path.basename(tmp_file.name).split(self.mbox.colon)[0], size
+
+    def _commit(self, files):
+        """
+        Moves files, a list of (path, key, size) from _write_tmp, into new/.
+        Unless fsync is "none" they're flushed to disk first, and new/ is
+        flushed afterwards.
+        """
+        if self.fsync != "none":
+            self._sync_tmp(files)
+
+        new_dir = os.path.join(self.dir, "new")
+        for path, key, size in files:
+            os.rename(path, os.path.join(new_dir, key))
+
+        if self.fsync != "none":
+            dir_fd = os.open(new_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _sync_tmp(self, files):
+        """
+        Flushes files to disk.  More than one is done with a single syncfs of
+        the filesystem tmp/ is on where that's available, which costs about
+        as much as flushing one of them, and otherwise each is fsynced.
+        """
+        if len(files) > 1 and _syncfs is not None:
+            tmp_fd = os.open(os.path.join(self.dir, "tmp"), os.O_RDONLY)
+            try:
+                if _syncfs(tmp_fd) < 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err))
+            finally:
+                os.close(tmp_fd)
+            return
+
+        for path, key, size in files:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _commit_group(self, files):
+        """
+        Commits files along with those of any other threads that are waiting
+        to.  Only one group is committed at a time, and threads that arrive
+        meanwhile join the next group, which is committed by whichever of them
+        gets there first.
+        """
+        with self._group_lock:
+            if self._group is None:
+                self._group = _Group()
+            group = self._group
+            group.files.extend(files)
+
+        with self._commit_lock:
+            if not group.done:
+                if self.group_window:
+                    time.sleep(self.group_window)
+                with self._group_lock:
+                    self._group = None
                 try:
-                    msg = self.get(key)
-                except QueueError as exc:
-                    raise exc
+                    self._commit(group.files)
+                except BaseException as exc:
+                    group.error = exc
                 finally:
-                    self.remove(key)
-                return key, msg
+                    group.done = True
 
-        return None, None
+        if group.error is not None:
+            raise group.error
+
+    def pop(self, raw=False):
+        """
+        Pops a message off the queue.  Unless the queue is ordered, the
+        order messages are popped in is not really maintained.
 
-    def get(self, key):
+        It returns a (key, message) tuple for that item.  If raw is True the
+        message is returned as bytes rather than a MailRequest, see get.
+        """
+        popped = self.pop_many(1, raw)
+        return popped[0] if popped else (None, None)
+
+    def pop_many(self, n, raw=True):
+        """
+        Pops up to n messages off the queue in one go and returns a list of
+        (key, message) tuples, which is empty if the queue is.  Unlike pop,
+        messages are returned as bytes unless raw is False, so that they can
+        be parsed by whatever ends up needing them.
+        """
+        return self._take(n, lambda lane, count: lane._pop_lane(count, raw))
+
+    def _pop_lane(self, n, raw):
+        popped = []
+        for key, path in self._files():
+            if self._remove_oversize(key, path):
+                continue
+
+            try:
+                msg_data, size = self._read(path)
+                os.unlink(path)
+            except FileNotFoundError:
+                # popped by someone else
+                continue
+            except _DECOMPRESS_ERRORS as exc:
+                self._remove_corrupt(key, path, exc)
+                continue
+
+            self._removed(key, size)
+            popped.append((key, msg_data if raw else self._parse(msg_data)))
+            if len(popped) >= n:
+                break
+
+        return popped
+
+    def claim(self, raw=False):
+        """
+        Like pop, but rather than deleting the message it's moved to the
+        claimed directory until you call ack (once you're done with it) or
+        release (to put it back).  It returns a (key, message) tuple, and
+        that key is the one to pass to ack or release.
+
+        Claims are atomic, so any number of processes can claim messages from
+        the same queue without getting the same one, even over a shared
+        filesystem.  If a process dies before acking a message, reap will
+        return it to the queue once its lease has expired.
+        """
+        claimed = self.claim_many(1, raw)
+        return claimed[0] if claimed else (None, None)
+
+    def claim_many(self, n, raw=True):
+        """Claims up to n messages in one go, see claim and pop_many"""
+        return self._take(n, lambda lane, count: lane._claim_lane(count, raw))
+
+    def _claim_lane(self, n, raw):
+        claimed = []
+        for key, path in self._files():
+            if self._remove_oversize(key, path):
+                continue
+
+            # the time is part of the name so that it's set in the same
+            # atomic step as the claim itself
+            claim_key = "%s.%d" % (key, time.time())
+            claim_name = os.path.join(self.claimed_dir, claim_key)
+            self._make_claimed_dir()
+            try:
+                os.rename(path, claim_name)
+            except FileNotFoundError:
+                # someone else got there first
+                continue
+
+            try:
+                msg_data, size = self._read(claim_name)
+            except _DECOMPRESS_ERRORS as exc:
+                # rather than leaving it claimed, to fail again every time it's reaped
+                self._remove_corrupt(key, claim_name, exc)
+                continue
+            self._removed(key, size)
+            claimed.append((claim_key, msg_data if raw else self._parse(msg_data)))
+            if len(claimed) >= n:
+                break
+
+        return claimed
+
+    def _make_claimed_dir(self):
+        if not self._claimed_dir_made:
+            os.makedirs(self.claimed_dir, exist_ok=True)
+            self._claimed_dir_made = True
+
+    def _take(self, n, take):
+        """
+        Takes up to n messages from the lanes by calling take(lane, count),
+        choosing a lane for each message in proportion to its weight.
+        """
+        if len(self.lanes) == 1:
+            return take(self, n)
+
+        taken = []
+        empty = set()
+        while len(taken) < n and len(empty) < len(self.lanes):
+            priority = self._next_lane(empty)
+            lane = self.lanes[priority]
+            got = take(lane, 1)
+            if not got:
+                empty.add(priority)
+            elif lane is self:
+                taken.extend(got)
+            else:
+                taken.extend(("%s/%s" % (priority, key), msg) for key, msg in got)
+
+        return taken
+
+    def _next_lane(self, skip):
+        """
+        Picks the lane to take the next message from with smooth weighted
+        round robin, which interleaves the lanes rather than taking a lane's
+        whole share in one go.  Lanes in skip are left out.
+        """
+        total = 0
+        best = None
+        for priority, weight in self.priorities.items():
+            if priority in skip:
+                continue
+            self._current_weights[priority] += weight
+            total += weight
+            if best is None or self._current_weights[priority] > self._current_weights[best]:
+                best = priority
+
+        self._current_weights[best] -= total
+        return best
+
+    def _lane(self, key):
+        """Returns the lane that the message with key is in, and its key within that lane"""
+        priority, _, lane_key = key.rpartition("/")
+        return self.lanes[priority or "normal"], lane_key
+
+    def ack(self, key):
+        """Deletes a message that was claimed, now that it's been dealt with"""
+        lane, key = self._lane(key)
+        os.unlink(os.path.join(lane.claimed_dir, key))
+
+    def release(self, key):
+        """Puts a message that was claimed back into the queue"""
+        lane, key = self._lane(key)
+        lane._release_lane(key)
+
+    def _release_lane(self, claim_key):
+        key = claim_key.rsplit(".", 1)[0]
+        path = os.path.join(self.dir, "new", key)
+        os.rename(os.path.join(self.claimed_dir, claim_key), path)
+        self._moved_in(key, path)
+
+    def reap(self, lease_timeout):
+        """
+        Releases messages that were claimed more than lease_timeout seconds
+        ago, presumably by a process that has since died.  Returns how many
+        messages were released.
+        """
+        return sum(lane._reap_lane(lease_timeout) for lane in self.lanes.values())
+
+    def _reap_lane(self, lease_timeout):
+        expired = time.time() - lease_timeout
+        released = 0
+        try:
+            claimed = os.listdir(self.claimed_dir)
+        except FileNotFoundError:
+            # nothing has ever been claimed
+            return 0
+
+        for key in claimed:
+            try:
+                claimed_at = int(key.rsplit(".", 1)[1])
+            except (IndexError, ValueError):
+                continue
+
+            if claimed_at < expired:
+                try:
+                    self._release_lane(key)
+                except FileNotFoundError:
+                    # acked or reaped while we were looking
+                    continue
+                logging.warning("Lease on message %s in %s expired, releasing it", key, self.dir)
+                released += 1
+
+        return released
+
+    def _remove_oversize(self, key, path):
+        """Moves or deletes the message at path if it's oversize, returns True if it was"""
+        if not self.pop_limit:
+            return False
+
+        try:
+            if _message_size(path) <= self.pop_limit:
+                return False
+
+            size = os.path.getsize(path)
+            if self.oversize_dir:
+                logging.info("Message key %s over size limit %d, moving to %s.",
+                             key, self.pop_limit, self.oversize_dir)
+                os.rename(path, os.path.join(self.oversize_dir, key))
+            else:
+                logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).",
+                             key, self.pop_limit)
+                os.unlink(path)
+        except FileNotFoundError:
+            # taken by someone else
+            return True
+
+        self._removed(key, size)
+        return True
+
+    def _remove_corrupt(self, key, path, exc):
+        """Moves or deletes the message at path, which couldn't be decompressed"""
+        try:
+            size = os.path.getsize(path)
+            if self.oversize_dir:
+                logging.error("Message key %s couldn't be decompressed (%s), moving to %s.",
+                              key, exc, self.oversize_dir)
+                os.rename(path, os.path.join(self.oversize_dir, key))
+            else:
+                logging.error("Message key %s couldn't be decompressed (%s), DELETING (set oversize_dir).",
+                              key, exc)
+                os.unlink(path)
+        except FileNotFoundError:
+            # taken by someone else
+            return
+
+        self._removed(key, size)
+
+    def _files(self):
+        """
+        Yields the (key, path) of messages for pop and claim to try, which
+        may have been taken by someone else since they were listed.  It
+        carries on from where the last call left off, and when that scan of
+        new/ and cur/ is finished it starts one more to find files that have
+        been added since, unless they were empty last time and haven't changed.
+        """
+        rescanned = found = False
+        mtimes = started = None
+        while True:
+            if not self._cursor and self._scan is not None:
+                self._fill_cursor()
+
+            if not self._cursor:
+                self._scan = None
+                if rescanned:
+                    if not found:
+                        self._found_empty(mtimes, started)
+                    return
+                mtimes = self._mtimes()
+                if mtimes == self._empty_mtimes:
+                    return
+                started = time.time_ns()
+                self._scan = self._scan_files()
+                rescanned = True
+                continue
+
+            subdir, name = heapq.heappop(self._cursor)[1:] if self.ordered else self._cursor.popleft()
+            found = found or rescanned
+            yield name.split(self.mbox.colon)[0], os.path.join(self.dir, subdir, name)
+
+    def _fill_cursor(self):
+        if self.ordered:
+            # the oldest message could be anywhere, so take the whole scan
+            self._cursor = [(_key_order(name), subdir, name) for subdir, name in self._scan]
+            heapq.heapify(self._cursor)
+        else:
+            self._cursor.extend(itertools.islice(self._scan, SCAN_BATCH))
+
+    def _listed(self, key):
+        """
+        Adds a message that has just been put in new/ to the heap, if pop
+        would otherwise miss it until the queue is next listed
+        """
+        if self.ordered and self._cursor:
+            heapq.heappush(self._cursor, (_key_order(key), "new", key))
+
+    def _mtimes(self):
+        return tuple(os.stat(os.path.join(self.dir, subdir)).st_mtime_ns for subdir in ("new", "cur"))
+
+    def _found_empty(self, mtimes, started):
+        """
+        Records that new/ and cur/ were empty, so they aren't scanned again
+        until one of them changes.  Like git's racy index check, directories
+        changed within a second of the scan could have changed again without
+        their mtime showing it, so those are always scanned again.
+        """
+        if self._stats is not None:
+            self._stats = _Stats()
+        self._empty_mtimes = mtimes if max(mtimes) < started - 1000000000 else None
+
+    def _scan_files(self):
+        for subdir in ("new", "cur"):
+            with os.scandir(os.path.join(self.dir, subdir)) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield subdir, entry.name
+
+    def _read(self, path):
+        """Returns the message in the file at path, uncompressed, and the size of the file"""
+        with open(path, "rb") as msg_file:
+            msg_data = msg_file.read()
+        return _decompress(msg_data), len(msg_data)
+
+    def _count_files(self):
+        """Counts the messages in new/ and cur/ with a single pass over each, see _Stats"""
+        stats = _Stats()
+        for subdir in ("new", "cur"):
+            with os.scandir(os.path.join(self.dir, subdir)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            stats.add(entry.name.split(self.mbox.colon)[0], entry.stat().st_size)
+                    except FileNotFoundError:
+                        # popped while we were looking
+                        continue
+        return stats
+
+    def _added(self, key, size):
+        self._listed(key)
+        if self._stats is not None:
+            self._stats.add(key, size)
+
+    def _removed(self, key, size):
+        if self._stats is not None:
+            self._stats.remove(key, size)
+
+    def _moved_in(self, key, path):
+        """Counts a message that was moved into new/ from elsewhere"""
+        self._listed(key)
+        if self._stats is not None:
+            self._stats.add(key, os.path.getsize(path))
+
+    def wait(self, timeout):
+        """
+        Blocks until a message may have been pushed onto the queue, or until
+        timeout seconds have passed.  Returns True if something may have
+        arrived and False if it timed out, so callers should pop again either
+        way.
+
+        On Linux this uses inotify, so it returns as soon as a message is
+        pushed.  Elsewhere it just sleeps for timeout seconds.
+        """
+        if self._watcher is None:
+            try:
+                self._watcher = InotifyWatcher(*[os.path.join(lane.dir, "new") for lane in self.lanes.values()])
+            except OSError as exc:
+                logging.debug("Can't watch %s (%s), falling back to polling", self.dir, exc)
+                self._watcher = False
+            else:
+                # a message could have arrived before we started watching
+                return True
+
+        if self._watcher:
+            return self._watcher.wait(timeout)
+
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        """Stops watching the queue for new messages, see wait"""
+        if self._watcher:
+            self._watcher.close()
+        self._watcher = None
+
+    def get(self, key, raw=False):
         """
         Get the specific message referenced by the key.  The message is NOT
         removed from the queue.
+
+        If raw is True the message is returned as bytes, exactly as it was
+        pushed, rather than parsed into a MailRequest.
         """
-        msg_file = self.mbox.get_file(key)
+        lane, key = self._lane(key)
+        msg_file = lane.mbox.get_file(key)
 
         if not msg_file:
             return None
 
-        msg_data = msg_file.read()
+        with msg_file:
+            msg_data = _decompress(msg_file.read())
+
+        if raw:
+            return msg_data
+
+        return lane._parse(msg_data)
 
+    def _parse(self, msg_data):
         try:
             return mail.MailRequest(self.dir, None, None, msg_data)
         except Exception as exc:
@@ -154,37 +985,810 @@ class Queue:
 
     def remove(self, key):
         """Removes the queue, but not returned."""
-        self.mbox.remove(key)
+        if not self.remove_many([key]):
+            raise KeyError(key)
+
+    def remove_many(self, keys):
+        """
+        Removes the messages with the given keys without reading them, and
+        returns how many were removed.  Keys that aren't in the queue are
+        skipped.
+        """
+        removed = 0
+        for key in keys:
+            lane, lane_key = self._lane(key)
+            # messages in new/ are named after their key, so only those that
+            # have been moved to cur/ need looking up
+            path = os.path.join(lane.dir, "new", lane_key)
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                try:
+                    path = os.path.join(lane.dir, lane.mbox._lookup(lane_key))
+                    size = os.path.getsize(path)
+                except (KeyError, FileNotFoundError):
+                    continue
+
+            if _unlink(path):
+                lane._removed(lane_key, size)
+                removed += 1
+        return removed
 
     def __len__(self):
-        """Returns the number of messages in the queue."""
-        return len(self.mbox)
+        """
+        Returns the number of messages in the queue.  Unless exact_len is
+        set, this is only counted the first time and may not include changes
+        made by other processes since then.
+        """
+        return sum(lane._len_lane() for lane in self.lanes.values())
+
+    def _len_lane(self):
+        return self._lane_stats(self.exact_len).count
+
+    def _lane_stats(self, exact):
+        if exact or self._stats is None:
+            self._stats = self._count_files()
+        return self._stats
+
+    def stats(self, exact=False):
+        """
+        Returns a dict of the number of messages in the queue ("depth"),
+        their total size on disk ("bytes") and how many seconds ago the oldest of
+        them was pushed ("oldest_age", None if the queue is empty).  Claimed
+        messages aren't included.
+
+        Like len, these are kept up to date as messages are pushed and popped
+        after being counted the first time, unless exact or exact_len is set.
+        Counting takes one pass over new/ and cur/.
+        """
+        depth = size = 0
+        oldest = None
+        for lane in self.lanes.values():
+            stats = lane._lane_stats(exact or self.exact_len)
+            depth += stats.count
+            size += stats.bytes
+            lane_oldest = stats.oldest()
+            if lane_oldest is not None and (oldest is None or lane_oldest < oldest):
+                oldest = lane_oldest
+
+        return {
+            "depth": depth,
+            "bytes": size,
+            "oldest_age": None if oldest is None else max(time.time() - oldest, 0),
+        }
 
     # synonym of __len__ for backwards compatibility
     count = __len__
 
-    def clear(self):
+    def clear(self, workers=1):
         """
-        Clears out the contents of the entire queue.
+        Clears out the contents of the entire queue, apart from messages that
+        have been claimed, and returns how many messages were removed.
 
-        Warning: This could be horribly inefficient since it pops messages
-        until the queue is empty. It could also cause an infinite loop if
-        another process is writing to messages to the Queue faster than we can
-        pop.
+        Messages are unlinked straight from a listing of new/ and cur/
+        without being read, by up to workers threads.  Messages pushed once
+        it has started may be left behind.
         """
-        # man this is probably a really bad idea
-        while len(self) > 0:
-            self.pop()
+        pool = Pool(workers) if workers > 1 else None
+        removed = 0
+        try:
+            for lane in self.lanes.values():
+                paths = (os.path.join(lane.dir, subdir, name) for subdir, name in lane._scan_files())
+                if pool is None:
+                    cleared = sum(map(_unlink, paths))
+                else:
+                    cleared = sum(pool.imap_unordered(_unlink, paths, chunksize=100))
+                lane._cursor.clear()
+                lane._scan = None
+                # anything pushed meanwhile wasn't cleared, so count again next time
+                lane._stats = None
+                removed += cleared
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return removed
 
     def keys(self):
         """
         Returns the keys in the queue.
         """
-        return self.mbox.keys()
+        keys = self.mbox.keys()
+        for priority, lane in self.lanes.items():
+            if lane is not self:
+                keys.extend("%s/%s" % (priority, key) for key in lane.mbox.keys())
+        return keys
 
     def oversize(self, key):
+        """Returns (True, file name) if the message in new/ called key is oversize"""
         if self.pop_limit:
             file_name = os.path.join(self.dir, "new", key)
-            return os.path.getsize(file_name) > self.pop_limit, file_name
+            return _message_size(file_name) > self.pop_limit, file_name
         else:
             return False, None
+
+
+def recipient_domain(message):
+    """
+    A shard_key for ShardedQueue that puts mail for the same domain into the
+    same shard.  Only the headers of raw messages are parsed, and files are
+    put back where they were afterwards.
+    """
+    if hasattr(message, "read"):
+        start = message.tell()
+        lines = []
+        for line in iter(message.readline, b""):
+            if line in (b"\n", b"\r\n"):
+                break
+            lines.append(line)
+        message.seek(start)
+        message = b"".join(lines)
+    if isinstance(message, str):
+        message = message.encode("utf-8", "surrogateescape")
+    if isinstance(message, bytes):
+        message = BytesHeaderParser().parsebytes(message)
+
+    addresses = getaddresses([message["To"] or ""])
+    return addresses[0][1].rpartition("@")[2].lower() if addresses else ""
+
+
+class ShardedQueue:
+    """
+    Spreads a queue over several Maildirs, called shards, so that no one
+    directory gets too big.  It has the same API as Queue, except that keys
+    are prefixed with the number of the shard their message is in.
+
+    The shards are the Maildirs queue_dir/0, queue_dir/1 and so on.
+    """
+
+    def __init__(self, queue_dir, shards=16, shard_ids=None, shard_key=None, **kwargs):
+        """
+        Messages are pushed onto each shard in turn, unless shard_key is
+        given.  That is called with each message, and messages it returns the
+        same string for go into the same shard, e.g. recipient_domain.
+
+        Giving a list of shard numbers as shard_ids limits pop, claim, wait
+        etc. to those shards, so that several consumers can each drain their
+        own shards without getting in each other's way.  Every process using
+        the queue must agree on the number of shards.
+
+        Other keyword arguments are passed to Queue for every shard.
+        """
+        shard_ids = list(range(shards)) if shard_ids is None else list(shard_ids)
+        if not shard_ids:
+            raise ValueError("shard_ids must include at least one shard")
+        for shard_id in shard_ids:
+            if not isinstance(shard_id, int) or not 0 <= shard_id < shards:
+                raise ValueError("shard_ids must be between 0 and %d, not %r" % (shards - 1, shard_id))
+
+        self.dir = queue_dir
+        self.shard_key = shard_key
+        os.makedirs(queue_dir, exist_ok=True)
+        self.shards = [Queue(os.path.join(queue_dir, str(i)), **kwargs) for i in range(shards)]
+        self.shard_ids = shard_ids
+        self._next_push = itertools.cycle(range(shards))
+        self._next_pop = 0
+        self._watcher = None
+
+    def _split(self, key):
+        shard, key = key.split("/", 1)
+        return self.shards[int(shard)], key
+
+    def _pinned(self):
+        return [self.shards[shard_id] for shard_id in self.shard_ids]
+
+    def _rotated(self):
+        """
+        Yields the (number, shard) of each shard in shard_ids, starting one
+        further along each time so that every shard gets drained.
+        """
+        count = len(self.shard_ids)
+        start = self._next_pop
+        self._next_pop = (start + 1) % count
+        for i in range(count):
+            shard_id = self.shard_ids[(start + i) % count]
+            yield shard_id, self.shards[shard_id]
+
+    def _shard_for(self, message):
+        if self.shard_key is None:
+            return next(self._next_push)
+        # crc32 rather than hash, as that's different for every process
+        return zlib.crc32(self.shard_key(message).encode("utf-8")) % len(self.shards)
+
+    def push(self, message, priority="normal"):
+        """Pushes the message onto a shard, see Queue.push"""
+        shard_id = self._shard_for(message)
+        return "%d/%s" % (shard_id, self.shards[shard_id].push(message, priority))
+
+    def push_many(self, messages, priority="normal"):
+        """Pushes each of messages onto a shard, committing each shard's messages together, see Queue.push_many"""
+        by_shard = collections.defaultdict(list)
+        for i, message in enumerate(messages):
+            by_shard[self._shard_for(message)].append((i, message))
+
+        keys = {}
+        for shard_id, shard_messages in by_shard.items():
+            shard_keys = self.shards[shard_id].push_many([message for i, message in shard_messages], priority)
+            for (i, message), key in zip(shard_messages, shard_keys):
+                keys[i] = "%d/%s" % (shard_id, key)
+        return [keys[i] for i in range(len(keys))]
+
+    def pop(self, raw=False):
+        popped = self.pop_many(1, raw)
+        return popped[0] if popped else (None, None)
+
+    def pop_many(self, n, raw=True):
+        popped = []
+        for shard_id, shard in self._rotated():
+            popped.extend(("%d/%s" % (shard_id, key), msg) for key, msg in shard.pop_many(n - len(popped), raw))
+            if len(popped) >= n:
+                break
+        return popped
+
+    def claim(self, raw=False):
+        claimed = self.claim_many(1, raw)
+        return claimed[0] if claimed else (None, None)
+
+    def claim_many(self, n, raw=True):
+        claimed = []
+        for shard_id, shard in self._rotated():
+            claimed.extend(("%d/%s" % (shard_id, key), msg) for key, msg in shard.claim_many(n - len(claimed), raw))
+            if len(claimed) >= n:
+                break
+        return claimed
+
+    def ack(self, key):
+        shard, key = self._split(key)
+        shard.ack(key)
+
+    def release(self, key):
+        shard, key = self._split(key)
+        shard.release(key)
+
+    def reap(self, lease_timeout):
+        return sum(shard.reap(lease_timeout) for shard in self._pinned())
+
+    def wait(self, timeout):
+        """See Queue.wait, this waits for a message on any of the shards in shard_ids"""
+        if self._watcher is None:
+            try:
+                self._watcher = InotifyWatcher(*[os.path.join(lane.dir, "new") for shard in self._pinned()
+                                                 for lane in shard.lanes.values()])
+            except OSError as exc:
+                logging.debug("Can't watch %s (%s), falling back to polling", self.dir, exc)
+                self._watcher = False
+            else:
+                return True
+
+        if self._watcher:
+            return self._watcher.wait(timeout)
+
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        if self._watcher:
+            self._watcher.close()
+        self._watcher = None
+
+    def get(self, key, raw=False):
+        shard, key = self._split(key)
+        return shard.get(key, raw)
+
+    def remove(self, key):
+        shard, key = self._split(key)
+        shard.remove(key)
+
+    def remove_many(self, keys):
+        by_shard = collections.defaultdict(list)
+        for key in keys:
+            shard, key = self._split(key)
+            by_shard[shard].append(key)
+        return sum(shard.remove_many(shard_keys) for shard, shard_keys in by_shard.items())
+
+    def __len__(self):
+        """The number of messages in the shards in shard_ids, see Queue.__len__"""
+        return sum(len(shard) for shard in self._pinned())
+
+    count = __len__
+
+    def stats(self, exact=False):
+        """The stats of the shards in shard_ids added together, see Queue.stats"""
+        return _merge_stats([shard.stats(exact) for shard in self._pinned()])
+
+    def clear(self, workers=1):
+        return sum(shard.clear(workers) for shard in self._pinned())
+
+    def keys(self):
+        return ["%d/%s" % (shard_id, key) for shard_id in self.shard_ids for key in self.shards[shard_id].keys()]
+
+
+class DeferredQueue:
+    """
+    A queue of messages that aren't to be delivered until some time in the
+    future, such as those that are being retried after a temporary failure.
+    It has the same API as Queue, except that only messages that are due can
+    be popped or claimed.
+
+    Messages are kept in Maildirs under queue_dir called buckets, named after
+    the time their messages are due and how many times they've been tried,
+    e.g. queue_dir/1700000040.2.  Finding the messages that are due only
+    lists queue_dir itself, never the messages in buckets that aren't due.
+    Keys are prefixed with the name of the message's bucket.
+    """
+
+    def __init__(self, queue_dir, resolution=10, backoff=60, max_backoff=4 * 3600, max_attempts=10, **kwargs):
+        """
+        Due times are rounded up to the next multiple of resolution seconds,
+        so messages are delivered up to that late, in return for fewer
+        buckets.  Empty buckets are removed once they're resolution seconds
+        past due, so nothing should take longer than that to push a message.
+
+        A message that is retried is delayed by backoff seconds, doubling
+        with every attempt up to max_backoff, until it has been tried
+        max_attempts times.
+
+        Other keyword arguments are passed to Queue for every bucket.
+        """
+        self.dir = queue_dir
+        self.resolution = resolution
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.kwargs = dict(kwargs, priorities=None)
+        self._buckets = {}
+        self._watcher = None
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _bucket(self, name):
+        if name not in self._buckets:
+            self._buckets[name] = Queue(os.path.join(self.dir, name), **self.kwargs)
+        return self._buckets[name]
+
+    def _bucket_name(self, delay, attempts):
+        due = (int(time.time() + delay) // self.resolution + 1) * self.resolution
+        return "%d.%d" % (due, attempts)
+
+    def _split(self, key):
+        name, key = key.split("/", 1)
+        return name, self._bucket(name), key
+
+    def _listing(self):
+        """Returns the (due time, name) of every bucket, soonest first"""
+        buckets = []
+        for name in os.listdir(self.dir):
+            due, _, attempts = name.partition(".")
+            if due.isdigit() and attempts.isdigit():
+                buckets.append((int(due), name))
+        return sorted(buckets)
+
+    def _due(self):
+        """Yields the name and Queue of each bucket that's due, removing those that are finished with"""
+        now = time.time()
+        for due, name in self._listing():
+            if due > now:
+                break
+            bucket = self._bucket(name)
+            yield name, bucket
+            if due < now - self.resolution:
+                self._remove_if_empty(name, bucket)
+
+    def _remove_if_empty(self, name, bucket):
+        subdirs = [os.path.join(bucket.dir, subdir) for subdir in ("new", "cur", "tmp")]
+        if os.path.isdir(bucket.claimed_dir):
+            subdirs.append(bucket.claimed_dir)
+        try:
+            if any(os.listdir(subdir) for subdir in subdirs):
+                return
+            for subdir in subdirs:
+                os.rmdir(subdir)
+            os.rmdir(bucket.dir)
+        except OSError as exc:
+            logging.debug("Couldn't remove bucket %s: %s", bucket.dir, exc)
+        else:
+            del self._buckets[name]
+
+    def push(self, message, delay=0, attempts=0):
+        """
+        Pushes the message onto the queue to be delivered in delay seconds,
+        see Queue.push.  attempts is how many times it's been tried already.
+        """
+        name = self._bucket_name(delay, attempts)
+        return "%s/%s" % (name, self._bucket(name).push(message))
+
+    def pop(self, raw=False):
+        popped = self.pop_many(1, raw)
+        return popped[0] if popped else (None, None)
+
+    def pop_many(self, n, raw=True):
+        """Pops up to n messages that are due, the longest overdue first"""
+        popped = []
+        for name, bucket in self._due():
+            if len(popped) < n:
+                popped.extend(("%s/%s" % (name, key), msg) for key, msg in bucket.pop_many(n - len(popped), raw))
+        return popped
+
+    def claim(self, raw=False):
+        claimed = self.claim_many(1, raw)
+        return claimed[0] if claimed else (None, None)
+
+    def claim_many(self, n, raw=True):
+        """Claims up to n messages that are due, the longest overdue first"""
+        claimed = []
+        for name, bucket in self._due():
+            if len(claimed) < n:
+                claimed.extend(("%s/%s" % (name, key), msg) for key, msg in bucket.claim_many(n - len(claimed), raw))
+        return claimed
+
+    def ack(self, key):
+        name, bucket, key = self._split(key)
+        bucket.ack(key)
+
+    def release(self, key):
+        """Puts a message that was claimed back into the queue, where it's due straight away"""
+        name, bucket, key = self._split(key)
+        bucket.release(key)
+
+    def retry(self, key, message=None):
+        """
+        Puts a message that was claimed back into the queue to be tried again
+        after a backoff, and returns its new key.  If message is given it's
+        tried again in place of the one that was claimed, for when only part
+        of it needs to be.  Once it has been tried max_attempts times it's
+        removed from the queue instead, and QueueError is raised with the
+        message as its data.
+        """
+        name, bucket, key = self._split(key)
+        attempts = int(name.split(".")[1]) + 1
+        path = os.path.join(bucket.claimed_dir, key)
+
+        if attempts >= self.max_attempts:
+            if message is None:
+                message, size = bucket._read(path)
+            bucket.ack(key)
+            raise QueueError("Gave up after %d attempts" % attempts, message)
+
+        new_name = self._bucket_name(min(self.backoff * 2 ** (attempts - 1), self.max_backoff), attempts)
+        new_bucket = self._bucket(new_name)
+        if message is not None:
+            new_key = new_bucket.push(message)
+            bucket.ack(key)
+            return "%s/%s" % (new_name, new_key)
+
+        key = key.rsplit(".", 1)[0]
+        new_path = os.path.join(new_bucket.dir, "new", key)
+        os.rename(path, new_path)
+        new_bucket._moved_in(key, new_path)
+        return "%s/%s" % (new_name, key)
+
+    def reap(self, lease_timeout):
+        return sum(self._bucket(name).reap(lease_timeout) for due, name in self._listing())
+
+    def _next_due(self, now):
+        """
+        Returns when the next message is due, which is now if any are.  Due
+        buckets that are empty are ignored.
+        """
+        for due, name in self._listing():
+            if due > now:
+                return due
+            bucket = self._bucket(name)
+            if any(os.listdir(os.path.join(bucket.dir, subdir)) for subdir in ("new", "cur")):
+                return now
+        return None
+
+    def wait(self, timeout):
+        """
+        Blocks until a message is due, or until timeout seconds have passed.
+        Returns True if a message is due.  A message pushed with a shorter
+        delay than any other in the queue is noticed straight away when
+        inotify is available, otherwise it may have to wait for timeout.
+        """
+        if self._watcher is None:
+            try:
+                # buckets are created when something is pushed into them
+                self._watcher = InotifyWatcher(self.dir)
+            except OSError as exc:
+                logging.debug("Can't watch %s (%s), falling back to polling", self.dir, exc)
+                self._watcher = False
+
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            due = self._next_due(now)
+            if due is not None and due <= now:
+                return True
+
+            until = deadline if due is None else min(deadline, due)
+            if until <= now:
+                return False
+
+            if self._watcher:
+                self._watcher.wait(until - now)
+            else:
+                time.sleep(until - now)
+
+    def close(self):
+        if self._watcher:
+            self._watcher.close()
+        self._watcher = None
+
+    def get(self, key, raw=False):
+        name, bucket, key = self._split(key)
+        return bucket.get(key, raw)
+
+    def remove(self, key):
+        name, bucket, key = self._split(key)
+        bucket.remove(key)
+
+    def remove_many(self, keys):
+        by_bucket = collections.defaultdict(list)
+        for key in keys:
+            name, bucket, key = self._split(key)
+            by_bucket[bucket].append(key)
+        return sum(bucket.remove_many(bucket_keys) for bucket, bucket_keys in by_bucket.items())
+
+    def __len__(self):
+        """The number of messages in the queue, whether they're due or not, see Queue.__len__"""
+        return sum(len(self._bucket(name)) for due, name in self._listing())
+
+    count = __len__
+
+    def stats(self, exact=False):
+        """
+        The stats of every bucket added together, whether its messages are
+        due or not, see Queue.stats.  oldest_age is from when a message was
+        first pushed, not when it was last retried.
+        """
+        return _merge_stats([self._bucket(name).stats(exact) for due, name in self._listing()])
+
+    def clear(self, workers=1):
+        removed = 0
+        for due, name in self._listing():
+            bucket = self._bucket(name)
+            removed += bucket.clear(workers)
+            self._remove_if_empty(name, bucket)
+        return removed
+
+    def keys(self):
+        return ["%s/%s" % (name, key) for due, name in self._listing() for key in self._bucket(name).keys()]
+
+
+class SQLiteQueue:
+    """
+    A queue kept in a single SQLite database rather than a Maildir, which
+    saves creating, renaming and listing a file for every message when there
+    are lots of small ones.  It has the same API as Queue, except for
+    priorities, and messages are popped in the order they were pushed.
+
+    Keys are the ids of messages in the database.  The database is in WAL
+    mode, so any number of processes can share it.
+    """
+
+    def __init__(self, path, pop_limit=0, oversize_dir=None, fsync=False, timeout=30, poll_interval=0.1):
+        """
+        The database at path is created if it doesn't exist, once the queue
+        is first used.  pop_limit, oversize_dir and fsync work like they do
+        for Queue, except that when fsync is "none" a power failure can lose
+        the last few messages pushed (but never corrupt the database).
+        Otherwise every transaction is flushed to disk, so "group" is the same
+        as "message" and push_many is the way to share a flush between
+        messages.
+
+        timeout is how many seconds to wait for another process to finish
+        with the database, and wait checks for new messages every
+        poll_interval seconds.
+        """
+        fsync = {False: "none", True: "message"}.get(fsync, fsync)
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of %s, not %r" % (", ".join(FSYNC_POLICIES), fsync))
+
+        self.dir = path
+        self.fsync = fsync
+        self.pop_limit = pop_limit
+        self.oversize_dir = oversize_dir
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # opened by _connection, in whichever process first uses the queue
+        self._db = None
+        self._pid = None
+
+        if oversize_dir:
+            self._oversize_mbox = mailbox.Maildir(oversize_dir)
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """
+        Yields the connection to the database with the lock held, opening it
+        if this process hasn't yet.  A connection mustn't be used on both
+        sides of a fork, so a forked child (such as a QueueReceiver worker)
+        opens its own and gets a new lock, as the old one may have been held
+        by another thread.
+        """
+        if self._pid != os.getpid():
+            # the parent's connection is left alone rather than closed from here
+            self._lock = threading.Lock()
+            self._db = None
+            self._pid = os.getpid()
+
+        # the connection is shared with QueueReceiver's callback thread
+        with self._lock:
+            if self._db is None:
+                self._db = sqlite3.connect(self.dir, timeout=self.timeout, isolation_level=None,
+                                           check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=%s" % ("NORMAL" if self.fsync == "none" else "FULL"))
+                self._db.executescript(SQLITE_SCHEMA)
+            yield self._db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def _execute(self, sql, params=()):
+        with self._connection() as db:
+            return db.execute(sql, params)
+
+    def _query(self, sql, params=()):
+        with self._connection() as db:
+            return db.execute(sql, params).fetchall()
+
+    def push(self, message):
+        """Pushes the message onto the end of the queue, see Queue.push"""
+        return str(self._execute("INSERT INTO messages (data, pushed_at) VALUES (?, ?)",
+                                 (self._data(message), time.time())).lastrowid)
+
+    def push_many(self, messages):
+        """Pushes each of messages onto the end of the queue in one transaction, and returns their keys"""
+        with self._transaction() as db:
+            now = time.time()
+            return [str(db.execute("INSERT INTO messages (data, pushed_at) VALUES (?, ?)",
+                                   (self._data(message), now)).lastrowid)
+                    for message in messages]
+
+    def _data(self, message):
+        if hasattr(message, "read"):
+            return message.read()
+        elif isinstance(message, bytes):
+            return message
+        return str(message).encode("utf-8")
+
+    def pop(self, raw=False):
+        popped = self.pop_many(1, raw)
+        return popped[0] if popped else (None, None)
+
+    def pop_many(self, n, raw=True):
+        """Pops up to n messages from the front of the queue, see Queue.pop_many"""
+        return self._take(n, raw, "DELETE FROM messages WHERE id = ?", ())
+
+    def claim(self, raw=False):
+        claimed = self.claim_many(1, raw)
+        return claimed[0] if claimed else (None, None)
+
+    def claim_many(self, n, raw=True):
+        """Claims up to n messages from the front of the queue, see Queue.claim"""
+        return self._take(n, raw, "UPDATE messages SET claimed_at = ? WHERE id = ?", (time.time(),))
+
+    def _take(self, n, raw, sql, params):
+        """
+        Runs sql with params and the id of each of up to n messages from the
+        front of the queue, in the same transaction that finds them so that no
+        other process can take them too.
+        """
+        taken = []
+        while len(taken) < n:
+            rows = []
+            oversize = []
+            with self._transaction() as db:
+                for row in db.execute("SELECT id, data FROM messages WHERE claimed_at IS NULL ORDER BY id LIMIT ?",
+                                      (n - len(taken),)):
+                    if self.pop_limit and len(row[1]) > self.pop_limit:
+                        oversize.append(row)
+                    else:
+                        rows.append(row)
+                self._remove_oversize(db, oversize)
+                db.executemany(sql, [params + (key,) for key, data in rows])
+
+            if not rows and not oversize:
+                break
+            taken.extend((str(key), data if raw else self._parse(data)) for key, data in rows)
+        return taken
+
+    def _remove_oversize(self, db, oversize):
+        for key, data in oversize:
+            if self.oversize_dir:
+                logging.info("Message key %s over size limit %d, moving to %s.", key, self.pop_limit, self.oversize_dir)
+                self._oversize_mbox.add(data)
+            else:
+                logging.info("Message key %s over size limit %d, DELETING (set oversize_dir).", key, self.pop_limit)
+            db.execute("DELETE FROM messages WHERE id = ?", (key,))
+
+    def ack(self, key):
+        self._execute("DELETE FROM messages WHERE id = ? AND claimed_at IS NOT NULL", (int(key),))
+
+    def release(self, key):
+        """Puts a message that was claimed back where it was in the queue"""
+        self._execute("UPDATE messages SET claimed_at = NULL WHERE id = ?", (int(key),))
+
+    def reap(self, lease_timeout):
+        return self._execute("UPDATE messages SET claimed_at = NULL WHERE claimed_at < ?",
+                             (time.time() - lease_timeout,)).rowcount
+
+    def wait(self, timeout):
+        """Blocks until there are messages in the queue, or until timeout seconds have passed"""
+        deadline = time.monotonic() + timeout
+        while not len(self):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+        return True
+
+    def close(self):
+        if self._db is None or self._pid != os.getpid():
+            return
+        with self._lock:
+            self._db.close()
+            self._db = None
+
+    def get(self, key, raw=False):
+        rows = self._query("SELECT data FROM messages WHERE id = ?", (int(key),))
+        if not rows:
+            return None
+        return rows[0][0] if raw else self._parse(rows[0][0])
+
+    def _parse(self, msg_data):
+        try:
+            return mail.MailRequest(self.dir, None, None, msg_data)
+        except Exception as exc:
+            logging.exception("Failed to decode message: %s; msg_data: %r", exc, msg_data)
+            return None
+
+    def remove(self, key):
+        if not self._execute("DELETE FROM messages WHERE id = ?", (int(key),)).rowcount:
+            raise KeyError(key)
+
+    def remove_many(self, keys):
+        with self._transaction() as db:
+            return db.executemany("DELETE FROM messages WHERE id = ?", [(int(key),) for key in keys]).rowcount
+
+    def __len__(self):
+        """The number of messages in the queue that haven't been claimed, which is always exact"""
+        return self._query("SELECT waiting FROM counts")[0][0]
+
+    count = __len__
+
+    def stats(self, exact=False):
+        """
+        Returns the number, size and age of the messages that haven't been
+        claimed, see Queue.stats.  These are always exact, so exact is ignored.
+        """
+        with self._connection() as db:
+            depth, size = db.execute("SELECT waiting, bytes FROM counts").fetchone()
+            oldest = db.execute("SELECT pushed_at FROM messages WHERE claimed_at IS NULL ORDER BY id LIMIT 1")
+            oldest = oldest.fetchone()
+        return {
+            "depth": depth,
+            "bytes": size,
+            "oldest_age": None if oldest is None else max(time.time() - oldest[0], 0),
+        }
+
+    def clear(self, workers=1):
+        """Removes every message that hasn't been claimed, workers is ignored"""
+        return self._execute("DELETE FROM messages WHERE claimed_at IS NULL").rowcount
+
+    def keys(self):
+        return [str(row[0]) for row in self._query("SELECT id FROM messages WHERE claimed_at IS NULL ORDER BY id")]
+
+    def oversize(self, key):
+        """Returns (True, None) if the message is oversize, see Queue.oversize"""
+        if not self.pop_limit:
+            return False, None
+        rows = self._query("SELECT length(data) FROM messages WHERE id = ?", (int(key),))
+        return bool(rows) and rows[0][0] > self.pop_limit, None
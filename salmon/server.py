@@ -2,11 +2,22 @@
 The majority of the server related things Salmon needs to run, like receivers,
 relays, and queue processors.
 """
+from collections import Counter
+from email._header_value_parser import get_addr_spec, get_angle_addr
 from multiprocessing.dummy import Pool
+import asyncio
 import asyncore
+import functools
+import json
 import logging
+import multiprocessing
+import os
+import re
 import smtpd
 import smtplib
+import socket
+import stat
+import tempfile
 import threading
 import time
 import traceback
@@ -17,6 +28,35 @@ import lmtpd
 from salmon import __version__, mail, queue, routing
 from salmon.bounce import COMBINED_STATUS_CODES, PRIMARY_STATUS_CODES, SECONDARY_STATUS_CODES
 
+# matches the enhanced status code at the start of a reply's text, see RFC 3463
+ENHANCED_STATUS_CODE = re.compile(r"[245]\.\d{1,3}\.\d{1,3}( |$)")
+
+# arguments to BDAT, see RFC 3030
+BDAT_ARGS = re.compile(r"(\d+)(?: +(LAST))?", re.IGNORECASE)
+
+# how much of a BDAT chunk is read at a time
+CHUNK_READ_SIZE = 64 * 1024
+
+# line endings that have to be changed to CRLF before a message is sent
+# after DATA, see Relay._send_raw
+BARE_LINE_ENDING = re.compile(rb"\r(?!\n)|(?<!\r)\n")
+
+# a message with any of these can only be sent as it is with 8BITMIME, see RFC 6152
+EIGHT_BIT = re.compile(rb"[\x80-\xff]")
+
+# sent when a receiver's DeliveryPool is full
+BUSY_REPLY = "451 Too busy to deliver mail, try again later"
+
+# the first line of every message spooled by AsyncSMTPReceiver, followed by the
+# envelope as JSON
+ENVELOPE_HEADER = b"X-Salmon-Envelope: "
+
+# the first file descriptor used by the LISTEN_FDS protocol
+LISTEN_FDS_START = 3
+
+# sockets passed to this process with LISTEN_FDS, see inherited_sockets
+_inherited_sockets = None
+
 lmtpd.__version__ = "Salmon Mail router LMTPD, version %s" % __version__
 smtpd.__version__ = "Salmon Mail router SMTPD, version %s" % __version__
 
@@ -33,6 +73,115 @@ def undeliverable_message(raw_message, failure_type):
                       "undeliverable queue with key %r", failure_type, key)
 
 
+def inherited_sockets():
+    """
+    Returns the listening sockets passed to this process by systemd socket
+    activation or ``salmon restart``, both of which use the LISTEN_FDS
+    protocol.  The environment is only read the first time this is called,
+    so call it before daemonizing.
+    """
+    global _inherited_sockets
+
+    if _inherited_sockets is None:
+        _inherited_sockets = []
+        if os.environ.get("LISTEN_PID") == str(os.getpid()):
+            for fd in range(LISTEN_FDS_START, LISTEN_FDS_START + int(os.environ.get("LISTEN_FDS", 0))):
+                os.set_inheritable(fd, False)
+                _inherited_sockets.append(socket.socket(fileno=fd))
+        # these aren't meant for any processes we start
+        for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+            os.environ.pop(name, None)
+
+    return _inherited_sockets
+
+
+def take_inherited_socket(address):
+    """
+    Returns the inherited socket that is listening on address, if there is
+    one, and removes it from those returned by inherited_sockets.
+    """
+    for sock in inherited_sockets():
+        name = sock.getsockname()
+        # IPv6 addresses come with flow info and scope ID
+        if isinstance(name, tuple):
+            matches = isinstance(address, tuple) and name[:2] == address[:2]
+        else:
+            matches = name == address
+        if matches:
+            _inherited_sockets.remove(sock)
+            return sock
+
+
+def pack_envelope(Peer, From, To, Data):
+    """
+    Prepends the SMTP envelope to Data as a single header line, so that it can
+    be spooled to a Queue along with the message.  To is a list of recipients.
+    """
+    if not isinstance(To, list):
+        raise ValueError("Envelope recipients must be a list, not %r" % (To,))
+    envelope = json.dumps({"peer": Peer, "from": From, "to": To})
+    return ENVELOPE_HEADER + envelope.encode("ascii") + b"\n" + Data
+
+
+def unpack_envelope(Data):
+    """
+    Reverses pack_envelope, returning (Peer, From, To, Data) or None if Data
+    doesn't start with an envelope.  Only the first line is ever looked at.
+    """
+    if not Data.startswith(ENVELOPE_HEADER):
+        return None
+
+    line, _, Data = Data.partition(b"\n")
+    envelope = json.loads(line[len(ENVELOPE_HEADER):])
+    Peer = envelope["peer"]
+    if isinstance(Peer, list):
+        Peer = tuple(Peer)
+    if not isinstance(envelope["to"], list):
+        raise ValueError("Envelope recipients must be a list, not %r" % (envelope["to"],))
+    return Peer, envelope["from"], envelope["to"], Data
+
+
+class _EnvelopeFile:
+    """
+    Reads like the bytes pack_envelope would return for the message in file,
+    so that a message in a DataSpool can be pushed to a Queue without being
+    read into memory first.  envelope is the line pack_envelope puts in front.
+    """
+
+    def __init__(self, envelope, file):
+        self.envelope = envelope
+        self.file = file
+        self.seek(0)
+
+    def read(self, size=-1):
+        data = self._read_envelope(size)
+        if size is None or size < 0:
+            return data + self.file.read()
+        return data + self.file.read(size - len(data))
+
+    def readline(self, size=-1):
+        # the envelope is always a line of its own
+        if self.pos < len(self.envelope):
+            return self._read_envelope(size)
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise ValueError("Can only seek from the start of an envelope file")
+        self.pos = min(offset, len(self.envelope))
+        self.file.seek(offset - self.pos)
+        return offset
+
+    def tell(self):
+        return self.pos + self.file.tell()
+
+    def _read_envelope(self, size):
+        end = len(self.envelope) if size is None or size < 0 else self.pos + size
+        data = self.envelope[self.pos:end]
+        self.pos += len(data)
+        return data
+
+
 class SMTPError(Exception):
     """
     You can raise this error when you want to abort with a SMTP error code to
@@ -112,7 +261,13 @@ class Relay:
         configured relay server.
 
         You can pass in an alternate To and From, which will be used in the
-        SMTP/LMTP send lines rather than what's in the message.
+        SMTP/LMTP send lines rather than what's in the message.  To can be a
+        list of recipients.
+
+        A MailRequest that hasn't been modified (see MailRequest.is_modified)
+        is relayed exactly as it was received, without being converted back
+        into a string, unless it has 8-bit data and the relay server doesn't
+        support 8BITMIME.
         """
         # Check in multiple places for To and From.
         # Ordered in preference.
@@ -122,9 +277,105 @@ class Relay:
         hostname = self.hostname or self.resolve_relay_host(recipient)
 
         relay_host = self.configure_relay(hostname)
-        relay_host.sendmail(sender, recipient, str(message))
+        mail_options = self._raw_mail_options(relay_host, message)
+        if mail_options is None:
+            relay_host.sendmail(sender, recipient, str(message))
+        else:
+            self._send_raw(relay_host, sender, recipient, message.Data, mail_options)
         relay_host.quit()
 
+    def _raw_mail_options(self, relay_host, message):
+        """
+        Returns the options to give MAIL if message can be sent as it was
+        received (see _send_raw), or None if it has to be converted back into
+        a string.
+        """
+        if not isinstance(message, mail.MailRequest) or not isinstance(message.Data, bytes) or \
+                message.is_modified():
+            return None
+        if not EIGHT_BIT.search(message.Data):
+            return []
+
+        relay_host.ehlo_or_helo_if_needed()
+        if not relay_host.has_extn("8bitmime"):
+            # str(message) is 7-bit
+            return None
+        return ["BODY=8BITMIME"]
+
+    def _send_raw(self, relay_host, sender, recipients, data, mail_options=()):
+        """
+        Like relay_host.sendmail, but data is sent as it is, other than its
+        line endings being changed to CRLF.  It returns the recipients that
+        were refused in the same way, which over LMTP includes any the server
+        couldn't deliver to once it had the message.
+        """
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        relay_host.ehlo_or_helo_if_needed()
+        code, resp = relay_host.mail(sender, mail_options)
+        if code != 250:
+            self._abort(relay_host, code)
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+
+        accepted, refused = self._send_rcpts(relay_host, recipients)
+        try:
+            # this does the dot stuffing
+            code, resp = relay_host.data(BARE_LINE_ENDING.sub(b"\r\n", data))
+        except smtplib.SMTPDataError as err:
+            self._abort(relay_host, err.smtp_code)
+            raise
+
+        if self.lmtp:
+            refused.update(self._lmtp_replies(relay_host, accepted, (code, resp)))
+            if len(refused) == len(recipients):
+                raise smtplib.SMTPRecipientsRefused(refused)
+        elif code != 250:
+            self._abort(relay_host, code)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _lmtp_replies(self, relay_host, accepted, reply):
+        """
+        Reads the rest of the replies an LMTP server gives after the message,
+        one for each recipient it accepted (see RFC 2033), of which reply is
+        the first.  Returns a dict of those it refused.
+        """
+        refused = {}
+        for i, recipient in enumerate(accepted):
+            code, resp = relay_host.getreply() if i else reply
+            if code != 250:
+                refused[recipient] = (code, resp)
+        return refused
+
+    def _send_rcpts(self, relay_host, recipients):
+        """Sends RCPT for each of recipients, returning those accepted and a dict of those refused"""
+        accepted = []
+        refused = {}
+        code = None
+        for recipient in recipients:
+            code, resp = relay_host.rcpt(recipient)
+            if code in (250, 251):
+                accepted.append(recipient)
+            else:
+                refused[recipient] = (code, resp)
+            if code == 421:
+                break
+
+        if not accepted or code == 421:
+            self._abort(relay_host, code)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return accepted, refused
+
+    def _abort(self, relay_host, code):
+        """Resets the transaction after the server refused part of it, as relay_host.sendmail does"""
+        if code == 421:
+            relay_host.close()
+            return
+        try:
+            relay_host.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
     def resolve_relay_host(self, To):
         target_host = To.split("@")[1]
 
@@ -288,6 +539,1000 @@ class LMTPReceiver(lmtpd.LMTPServer):
         logging.error(trace)
 
 
+class DataSpool:
+    """
+    Collects the message sent with DATA or BDAT, normalising line endings to
+    LF as it goes (and dot-unstuffing if asked to).  Messages are kept in
+    memory until they grow past threshold bytes, after which they're written
+    to a temporary file instead.
+
+    Once more than size_limit bytes have been received the message is
+    oversize, and anything else written to the spool is thrown away unless
+    keep_oversize is True.
+    """
+    def __init__(self, threshold, size_limit=0, unstuff=False, keep_oversize=False):
+        self.file = tempfile.SpooledTemporaryFile(threshold)
+        self.size_limit = size_limit
+        self.unstuff = unstuff
+        self.keep_oversize = keep_oversize
+        self.size = 0
+        # pretend the message starts on a new line so that a dot on the first
+        # line gets unstuffed, the resulting LF is skipped when it's written
+        self.tail = b"\r\n"
+        self.skip = 1
+
+    @property
+    def oversize(self):
+        # the final line ending isn't part of the message's size
+        return bool(self.size_limit) and self.size - len(self.tail) > self.size_limit
+
+    def write(self, data):
+        self.size += len(data)
+
+        # hold back the line ending, it might be the final one or half of a CRLF
+        text = self.tail + data
+        if text.endswith(b"\r\n"):
+            cut = 2
+        elif text.endswith((b"\r", b"\n")):
+            cut = 1
+        else:
+            cut = 0
+        self.tail = text[len(text) - cut:]
+
+        if self.oversize:
+            if not self.keep_oversize:
+                return
+            self.file.rollover()
+        self._write(text[:len(text) - cut])
+
+    def finish(self):
+        """Call once the whole message has been written, the final CRLF is dropped"""
+        if self.tail == b"\r\n":
+            self.size -= len(self.tail)
+        elif not self.oversize or self.keep_oversize:
+            self._write(self.tail)
+        self.tail = b""
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+    def _write(self, text):
+        if self.unstuff:
+            text = text.replace(b"\r\n.", b"\r\n")
+        text = text.replace(b"\r\n", b"\n")
+        if self.skip and text:
+            text = text[self.skip:]
+            self.skip = 0
+        self.file.write(text)
+
+
+class AsyncSMTPChannel:
+    """
+    Handles a single SMTP session for AsyncSMTPReceiver.  It speaks the same
+    dialect as smtpd.SMTPChannel and, like SMTPChannel, rejects more than one
+    recipient per transaction unless the receiver spools messages.
+
+    PIPELINING (RFC 2920) and CHUNKING (RFC 3030) are also supported.  Commands
+    are read from the stream one at a time, so pipelined commands are answered
+    in the order they were sent.
+    """
+    COMMAND = 0
+    DATA = 1
+    BDAT = 2
+
+    version = "Salmon Mail router SMTPD, version %s" % __version__
+    # see SMTPChannel.smtp_RCPT for why multiple recipients are refused
+    single_recipient = True
+
+    def __init__(self, server, reader, writer):
+        self.smtp_server = server
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.fqdn = server.fqdn
+        self.seen_greeting = ""
+        self.extended_smtp = False
+        self.closing = False
+        self.draining = False
+        self.data_spool = None
+        if server.spool is not None:
+            # the spool is our queue, so there's no partial delivery to worry about
+            self.single_recipient = False
+        self._set_rset_state()
+
+    def _set_rset_state(self):
+        self.smtp_state = self.COMMAND
+        self.mailfrom = None
+        self.rcpttos = []
+        self.mail_options = []
+        self.rcpt_options = []
+        if self.data_spool is not None:
+            self.data_spool.close()
+        self.data_spool = None
+
+    def push(self, msg):
+        self.writer.write(msg.encode("utf-8") + b"\r\n")
+
+    async def read(self, coro):
+        """Awaits a read from the client, giving up if it takes longer than the idle timeout"""
+        timeout = self.smtp_server.idle_timeout
+        if not timeout:
+            return await coro
+
+        timer = asyncio.get_running_loop().call_later(timeout, self.timed_out)
+        try:
+            return await coro
+        finally:
+            timer.cancel()
+
+    def timed_out(self):
+        logging.debug("Connection from %r timed out", self.peer)
+        self.smtp_server.metrics["timed_out"] += 1
+        self.push("421 %s Error: timeout exceeded" % self.fqdn)
+        # the pending read will now see the end of the stream
+        self.writer.close()
+
+    @property
+    def idle(self):
+        """True if there's no transaction in progress"""
+        return self.mailfrom is None and self.smtp_state == self.COMMAND
+
+    def drain(self):
+        """Ends the session as soon as the current transaction is over"""
+        self.draining = True
+        if self.idle:
+            self.shutting_down()
+
+    def shutting_down(self):
+        self.push("421 %s Service shutting down" % self.fqdn)
+        self.closing = True
+        # wakes up the pending read, if there is one
+        self.writer.close()
+
+    async def run(self):
+        """Greets the client and then processes commands until the session ends"""
+        self.push("220 %s %s" % (self.fqdn, self.version))
+        try:
+            while not self.closing:
+                if self.draining and self.idle:
+                    self.shutting_down()
+                    break
+                await self.writer.drain()
+                if self.smtp_state == self.DATA:
+                    await self.collect_data()
+                elif self.smtp_state == self.BDAT:
+                    await self.collect_chunk()
+                else:
+                    await self.collect_command()
+            await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logging.debug("Connection from %r lost", self.peer)
+        finally:
+            self._set_rset_state()
+            self.writer.close()
+
+    async def collect_command(self):
+        try:
+            line = await self.read(self.reader.readline())
+        except ValueError:
+            self.push("500 Error: line too long")
+            return
+
+        if not line:
+            self.closing = True
+            return
+
+        line = line.rstrip(b"\r\n").decode("utf-8", "replace")
+        if not line:
+            self.push("500 Error: bad syntax")
+            return
+
+        command, _, arg = line.partition(" ")
+        command = command.upper()
+        arg = arg.strip() or None
+
+        method = getattr(self, "smtp_" + command, None)
+        if not method:
+            self.push('500 Error: command "%s" not recognized' % command)
+            return
+        method(arg)
+
+    def new_data_spool(self, unstuff):
+        server = self.smtp_server
+        return DataSpool(server.memory_threshold, server.size_limit, unstuff,
+                         keep_oversize=server.oversize is not None)
+
+    async def read_data(self, spool):
+        """Writes everything up to the end of data marker to spool"""
+        previous = b"\n"
+        while True:
+            try:
+                chunk = await self.read(self.reader.readuntil(b".\r\n"))
+            except asyncio.LimitOverrunError as exc:
+                chunk = await self.read(self.reader.readexactly(exc.consumed))
+                spool.write(chunk)
+                previous = chunk
+                continue
+
+            # the marker only counts at the start of a line, and the CRLF that
+            # ended the DATA command counts as the start of the first line
+            if len(chunk) > 3:
+                at_line_start = chunk[-4:-3] == b"\n"
+            else:
+                at_line_start = previous.endswith(b"\n")
+
+            if at_line_start:
+                spool.write(chunk[:-3])
+                break
+            spool.write(chunk)
+            previous = chunk
+
+    async def collect_data(self):
+        # Remove extraneous carriage returns and de-transparency according
+        # to RFC 5321, Section 4.5.2.
+        self.data_spool = self.new_data_spool(unstuff=True)
+        await self.read_data(self.data_spool)
+        await self.finish_data()
+
+    async def collect_chunk(self):
+        # BDAT doesn't dot-stuff, but line endings are normalised just as they
+        # are for DATA, including dropping the final CRLF
+        if self.data_spool is None and not self.chunk_error:
+            self.data_spool = self.new_data_spool(unstuff=False)
+
+        remaining = self.chunk_size
+        while remaining:
+            piece = await self.read(self.reader.read(min(remaining, CHUNK_READ_SIZE)))
+            if not piece:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(piece)
+            # the chunk is read even if there's an error so that we know where
+            # the next command starts
+            if not self.chunk_error:
+                self.data_spool.write(piece)
+
+        self.smtp_state = self.COMMAND
+        if self.chunk_error:
+            self.push(self.chunk_error)
+        elif not self.chunk_last:
+            self.push("250 %d octets received" % self.chunk_size)
+        else:
+            await self.finish_data()
+
+    async def finish_data(self):
+        """Delivers the message in data_spool, or deals with it being oversize"""
+        spool = self.data_spool
+        spool.finish()
+        if not spool.oversize:
+            # a spooled message is copied into the spool from the file it's in
+            await self.process_data(spool.file if self.smtp_server.spool is not None else spool.file.read())
+        elif spool.keep_oversize:
+            status = await self.smtp_server.store_oversize(self.peer, self.mailfrom, self.rcpttos, spool.file)
+            self.push_status(status or "250 OK")
+        else:
+            self.push_status("552 Error: message size exceeds fixed maximum message size")
+        self._set_rset_state()
+
+    def push_status(self, status):
+        """Replies to the end of data with status"""
+        self.push(status)
+
+    async def process_data(self, data):
+        """Delivers the message and replies to the end of data"""
+        status = await self.deliver(self.rcpttos, data)
+        self.push(status or "250 OK")
+
+    async def deliver(self, rcpttos, data):
+        return await self.smtp_server.deliver(self.peer, self.mailfrom, rcpttos, data,
+                                              mail_options=self.mail_options, rcpt_options=self.rcpt_options)
+
+    def _strip_command_keyword(self, keyword, arg):
+        keylen = len(keyword)
+        if arg[:keylen].upper() == keyword:
+            return arg[keylen:].strip()
+        return ""
+
+    def _getaddr(self, arg):
+        if not arg:
+            return "", ""
+        try:
+            if arg.lstrip().startswith("<"):
+                address, rest = get_angle_addr(arg)
+            else:
+                address, rest = get_addr_spec(arg)
+        except Exception:
+            return "", ""
+        if not address:
+            return address, rest
+        return address.addr_spec, rest
+
+    def _getparams(self, params):
+        # Return params as dictionary. Return None if not all parameters
+        # appear to be syntactically valid according to RFC 1869.
+        result = {}
+        for param in params:
+            param, eq, value = param.partition("=")
+            if not param.isalnum() or eq and not value:
+                return None
+            result[param] = value if eq else True
+        return result
+
+    def extensions(self):
+        """ESMTP extensions advertised in reply to EHLO"""
+        extensions = ["8BITMIME", "PIPELINING", "CHUNKING"]
+        if self.smtp_server.size_limit:
+            extensions.append("SIZE %d" % self.smtp_server.size_limit)
+        return extensions
+
+    def smtp_HELO(self, arg):
+        if not arg:
+            self.push("501 Syntax: HELO hostname")
+            return
+        if self.seen_greeting:
+            self.push("503 Duplicate HELO/EHLO")
+            return
+        self._set_rset_state()
+        self.seen_greeting = arg
+        self.push("250 %s" % self.fqdn)
+
+    def smtp_EHLO(self, arg):
+        if not arg:
+            self.push("501 Syntax: EHLO hostname")
+            return
+        if self.seen_greeting:
+            self.push("503 Duplicate HELO/EHLO")
+            return
+        self._set_rset_state()
+        self.seen_greeting = arg
+        self.extended_smtp = True
+        self.push("250-%s" % self.fqdn)
+        for extension in self.extensions():
+            self.push("250-%s" % extension)
+        self.push("250 HELP")
+
+    def smtp_NOOP(self, arg):
+        if arg:
+            self.push("501 Syntax: NOOP")
+        else:
+            self.push("250 OK")
+
+    def smtp_QUIT(self, arg):
+        self.push("221 Bye")
+        self.closing = True
+
+    def smtp_HELP(self, arg):
+        self.push("250 Supported commands: EHLO HELO MAIL RCPT DATA BDAT RSET NOOP QUIT VRFY")
+
+    def smtp_VRFY(self, arg):
+        if arg:
+            address, params = self._getaddr(arg)
+            if address:
+                self.push("252 Cannot VRFY user, but will accept message and attempt delivery")
+            else:
+                self.push("502 Could not VRFY %s" % arg)
+        else:
+            self.push("501 Syntax: VRFY <address>")
+
+    def check_mail_params(self, params):
+        """
+        Validates the ESMTP parameters given to MAIL FROM, removing those that
+        are understood. Returns an error reply if they're not acceptable.
+        """
+        body = params.pop("BODY", "7BIT")
+        if body not in ["7BIT", "8BITMIME"]:
+            return "501 Error: BODY can only be one of 7BIT, 8BITMIME"
+        size = params.pop("SIZE", "0")
+        if not isinstance(size, str) or not size.isdigit():
+            return "501 Syntax: MAIL FROM: <address> [SP <mail-parameters>]"
+        if self.smtp_server.size_limit and int(size) > self.smtp_server.size_limit:
+            return "552 Error: message size exceeds fixed maximum message size"
+        if params:
+            return "555 MAIL FROM parameters not recognized or not implemented"
+
+    def smtp_MAIL(self, arg):
+        if not self.seen_greeting:
+            self.push("503 Error: send HELO first")
+            return
+        syntaxerr = "501 Syntax: MAIL FROM: <address>"
+        if self.extended_smtp:
+            syntaxerr += " [SP <mail-parameters>]"
+        if arg is None:
+            self.push(syntaxerr)
+            return
+        arg = self._strip_command_keyword("FROM:", arg)
+        address, params = self._getaddr(arg)
+        if not address:
+            self.push(syntaxerr)
+            return
+        if not self.extended_smtp and params:
+            self.push(syntaxerr)
+            return
+        if self.mailfrom:
+            self.push("503 Error: nested MAIL command")
+            return
+        self.mail_options = params.upper().split()
+        params = self._getparams(self.mail_options)
+        if params is None:
+            self.push(syntaxerr)
+            return
+        error = self.check_mail_params(params)
+        if error:
+            self.push(error)
+            return
+        if not self.smtp_server.allow_transaction(self.peer):
+            self.push("451 Too many messages, slow down")
+            return
+        self.mailfrom = address
+        self.push("250 OK")
+
+    def smtp_RCPT(self, arg):
+        if not self.seen_greeting:
+            self.push("503 Error: send HELO first")
+            return
+        if not self.mailfrom:
+            self.push("503 Error: need MAIL command")
+            return
+        if self.rcpttos and self.single_recipient:
+            logging.warning("Client attempted to deliver mail with multiple RCPT TOs. This is not supported.")
+            self.push("451 Will not accept multiple recipients in one transaction")
+            return
+        syntaxerr = "501 Syntax: RCPT TO: <address>"
+        if self.extended_smtp:
+            syntaxerr += " [SP <mail-parameters>]"
+        if arg is None:
+            self.push(syntaxerr)
+            return
+        arg = self._strip_command_keyword("TO:", arg)
+        address, params = self._getaddr(arg)
+        if not address:
+            self.push(syntaxerr)
+            return
+        if not self.extended_smtp and params:
+            self.push(syntaxerr)
+            return
+        self.rcpt_options = params.upper().split()
+        params = self._getparams(self.rcpt_options)
+        if params is None:
+            self.push(syntaxerr)
+            return
+        if params:
+            self.push("555 RCPT TO parameters not recognized or not implemented")
+            return
+        self.rcpttos.append(address)
+        self.push("250 OK")
+
+    def smtp_RSET(self, arg):
+        if arg:
+            self.push("501 Syntax: RSET")
+            return
+        self._set_rset_state()
+        self.push("250 OK")
+
+    def smtp_DATA(self, arg):
+        if not self.seen_greeting:
+            self.push("503 Error: send HELO first")
+            return
+        if not self.rcpttos:
+            self.push("503 Error: need RCPT command")
+            return
+        if arg:
+            self.push("501 Syntax: DATA")
+            return
+        if self.data_spool is not None:
+            self.push("503 Error: DATA can't be used after BDAT")
+            return
+        if self.smtp_server.busy():
+            self.push(BUSY_REPLY)
+            return
+        self.smtp_state = self.DATA
+        self.push("354 End data with <CR><LF>.<CR><LF>")
+
+    def smtp_BDAT(self, arg):
+        match = BDAT_ARGS.fullmatch(arg or "")
+        if not match:
+            # there's no telling where the chunk ends, so give up on the session
+            self.push("501 Syntax: BDAT <chunk-size> [LAST]")
+            self.closing = True
+            return
+
+        self.chunk_size = int(match.group(1))
+        self.chunk_last = match.group(2) is not None
+        self.chunk_error = None
+        if not self.seen_greeting:
+            self.chunk_error = "503 Error: send HELO first"
+        elif not self.rcpttos:
+            self.chunk_error = "503 Error: need RCPT command"
+        self.smtp_state = self.BDAT
+
+    def smtp_EXPN(self, arg):
+        self.push("502 EXPN not implemented")
+
+
+class RateLimiter:
+    """
+    A token bucket per peer, each holding up to burst tokens and refilled at
+    rate tokens per minute.  Buckets that have refilled completely are the
+    same as new ones, so they're thrown away every so often to stop the
+    number of buckets from growing forever.
+    """
+    def __init__(self, rate, burst=None, max_buckets=1024):
+        self.rate = rate / 60.0
+        self.burst = burst or rate
+        self.max_buckets = max_buckets
+        self.buckets = {}
+
+    def allow(self, peer):
+        """Takes a token from peer's bucket, returns False if there aren't any left"""
+        now = time.monotonic()
+        tokens, last = self.buckets.get(peer, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[peer] = (tokens, now)
+
+        if len(self.buckets) > self.max_buckets:
+            self.prune(now)
+        return allowed
+
+    def prune(self, now):
+        full = [peer for peer, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for peer in full:
+            del self.buckets[peer]
+
+
+class DeliveryPool:
+    """
+    Runs process_message for the asyncio receivers in a pool of threads, so
+    that a slow handler or relay doesn't stall every other session.  No more
+    than max_in_flight deliveries can be waiting or running at once, receivers
+    check busy() and ask clients to try again later rather than queue up more.
+
+    The metrics attribute is a Counter of:
+
+    - ``delivered``: deliveries completed
+    - ``in_flight``: deliveries currently waiting for or running on a thread
+    - ``saturated``: deliveries refused because the pool was full
+    - ``queue_wait``: total seconds deliveries spent waiting for a thread
+    - ``queue_wait_max``: the longest any delivery has waited for a thread
+    """
+    def __init__(self, workers=10, max_in_flight=None):
+        # Pool is from multiprocess.dummy which uses threads rather than
+        # processes. Unlike concurrent.futures, it keeps accepting work after
+        # the main thread has exited, which it does once salmon start is done
+        self.workers = Pool(workers)
+        self.max_in_flight = max_in_flight or workers * 2
+        # only ever updated from the event loop's thread
+        self.metrics = Counter()
+
+    def busy(self):
+        if self.metrics["in_flight"] >= self.max_in_flight:
+            self.metrics["saturated"] += 1
+            return True
+        return False
+
+    @staticmethod
+    def _call(func):
+        return time.monotonic(), func()
+
+    @staticmethod
+    def _resolve(future, result=None, exc=None):
+        if future.cancelled():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    async def run(self, func, *args, **kwargs):
+        """Calls func in a worker thread and returns what it returned"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queued = time.monotonic()
+        self.metrics["in_flight"] += 1
+        try:
+            self.workers.apply_async(
+                self._call, args=(functools.partial(func, *args, **kwargs),),
+                callback=lambda result: loop.call_soon_threadsafe(self._resolve, future, result),
+                error_callback=lambda exc: loop.call_soon_threadsafe(self._resolve, future, None, exc),
+            )
+            started, result = await future
+        finally:
+            self.metrics["in_flight"] -= 1
+
+        wait = started - queued
+        self.metrics["delivered"] += 1
+        self.metrics["queue_wait"] += wait
+        self.metrics["queue_wait_max"] = max(self.metrics["queue_wait_max"], wait)
+        return result
+
+    def shutdown(self):
+        self.workers.close()
+        self.workers.join()
+
+
+class AsyncSMTPReceiver:
+    """
+    Receives emails and hands it to the Router for further processing.  Unlike
+    SMTPReceiver this is built on asyncio rather than the deprecated smtpd and
+    asyncore modules.
+    """
+    channel_class = AsyncSMTPChannel
+
+    def __init__(self, host='127.0.0.1', port=8825, workers=10, max_in_flight=None, spool=None,
+                 size_limit=0, oversize_dir=None, memory_threshold=1024 * 1024,
+                 max_connections=None, max_peer_connections=None, rate_limit=None, idle_timeout=300,
+                 drain_timeout=30):
+        """
+        Initializes to bind on the given port and host/IP address.  Typically
+        in deployment you'd give 0.0.0.0 for "all internet devices" but consult
+        your operating system.
+
+        Just like SMTPReceiver, the socket is bound here, so you have to call
+        this far after you use python-daemonize or else daemonize will close
+        the socket.
+
+        Messages are handed to the Router by a DeliveryPool of workers threads,
+        which will queue up to max_in_flight deliveries (twice the number of
+        workers by default) before new messages are refused with a 451.  If
+        workers is 0, messages are delivered on the event loop's thread instead.
+        Consider adding ``@nolocking`` to your handlers if you are able to.
+
+        If spool is given (either a queue.Queue or a directory to create one
+        with fsync="group"), messages aren't given to the Router at all.  Instead
+        they're pushed to the spool along with their envelope and the client
+        only gets its 250 once that's done, which means any number of
+        recipients can be accepted in one transaction.  Run a QueueReceiver
+        with envelope=True on the same directory to deliver them.
+
+        Messages are held in memory while they're received until they're
+        bigger than memory_threshold bytes, then they're written to a temporary
+        file instead.  If size_limit is set it's advertised with ESMTP SIZE and
+        bigger messages are refused with a 552, unless oversize_dir is given.
+        In that case messages that turn out to be too big are accepted and
+        put in the oversize_dir Maildir rather than being delivered, just like
+        Queue's oversize_dir.
+
+        Connections beyond max_connections in total, or max_peer_connections
+        from one IP address, are sent a 421 and closed straight away.  If
+        rate_limit is given, each IP address can start that many transactions
+        a minute, after that MAIL FROM gets a 451.  Sessions that haven't sent
+        anything for idle_timeout seconds are sent a 421 and closed.
+
+        When ``salmon stop --graceful`` or ``salmon restart`` stops the
+        receiver, sessions have drain_timeout seconds to finish the transaction
+        they're in the middle of.  If the process was started with sockets
+        using the LISTEN_FDS protocol (as systemd's socket activation and
+        ``salmon restart`` do), the one listening on host and port is used
+        rather than binding a new one.
+
+        The metrics attribute is a Counter of:
+
+        - ``connections``: connections currently open
+        - ``connections_refused``: connections refused because of max_connections
+        - ``peer_connections_refused``: connections refused because of max_peer_connections
+        - ``rate_limited``: transactions refused because of rate_limit
+        - ``timed_out``: sessions closed because of idle_timeout
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        if isinstance(spool, str):
+            spool = queue.Queue(spool, fsync="group")
+        self.spool = spool
+        self.size_limit = size_limit
+        self.memory_threshold = memory_threshold
+        self.oversize = queue.Queue(oversize_dir) if oversize_dir else None
+        self.max_connections = max_connections
+        self.max_peer_connections = max_peer_connections
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.idle_timeout = idle_timeout
+        self.drain_timeout = drain_timeout
+        # only ever updated from the event loop's thread
+        self.metrics = Counter()
+        self.peer_connections = Counter()
+        self.pool = None
+        self.fqdn = socket.getfqdn()
+        self.sock = self.bind()
+        self.socket = "%s:%d" % (self.host, self.port)
+        self.loop = None
+        self.channels = {}
+
+    def bind(self):
+        """Creates the listening socket, which is handed to asyncio on start"""
+        family, type_, proto, _, address = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        sock = take_inherited_socket(address)
+        if sock is not None:
+            return sock
+
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(address)
+            sock.listen(socket.SOMAXCONN)
+        except OSError:
+            sock.close()
+            raise
+
+        # we might have been asked for any free port
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def create_server(self):
+        return asyncio.start_server(self.handle_connection, sock=self.sock)
+
+    def start(self):
+        """
+        Kicks everything into gear and starts listening on the port.  This
+        fires off a thread running the event loop and returns.
+        """
+        logging.info("%s started on %s.", type(self).__name__, self.socket)
+        if self.workers:
+            self.pool = DeliveryPool(self.workers, self.max_in_flight)
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self.create_server())
+        self.poller = threading.Thread(target=self.loop.run_forever)
+        self.poller.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the event loop and closes the listening socket.  If timeout is
+        given, sessions have that many seconds to finish their current
+        transaction before they're dropped.
+        """
+        if self.loop is None:
+            self.sock.close()
+            return
+
+        if timeout:
+            asyncio.run_coroutine_threadsafe(self.drain(timeout), self.loop).result()
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.poller.join()
+        self.loop.close()
+        self.loop = None
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    async def drain(self, timeout):
+        """Stops accepting connections and waits for sessions to finish their transactions"""
+        self.server.close()
+        for channel in list(self.channels):
+            channel.drain()
+        sessions = list(self.channels.values())
+        if sessions:
+            await asyncio.wait(sessions, timeout=timeout)
+        if self.channels:
+            logging.warning("Dropping %d sessions that didn't finish in time", len(self.channels))
+
+    async def shutdown(self):
+        """Closes the listening socket and drops any open sessions"""
+        self.server.close()
+        sessions = list(self.channels.items())
+        for channel, task in sessions:
+            channel.writer.close()
+        await asyncio.gather(*[task for channel, task in sessions], return_exceptions=True)
+
+    def check_connection(self, host):
+        """Returns a reply refusing the connection if there are too many already"""
+        if self.max_connections and len(self.channels) >= self.max_connections:
+            self.metrics["connections_refused"] += 1
+            return "421 %s Too many connections, try again later" % self.fqdn
+        if self.max_peer_connections and self.peer_connections[host] >= self.max_peer_connections:
+            self.metrics["peer_connections_refused"] += 1
+            return "421 %s Too many connections from your address, try again later" % self.fqdn
+
+    def allow_transaction(self, peer):
+        """False if peer has started too many transactions recently"""
+        if self.rate_limiter is None or self.rate_limiter.allow(self.peer_host(peer)):
+            return True
+        self.metrics["rate_limited"] += 1
+        return False
+
+    @staticmethod
+    def peer_host(peer):
+        # UNIX sockets don't have an address, so they all count as one peer
+        return peer[0] if isinstance(peer, tuple) else peer
+
+    async def handle_connection(self, reader, writer):
+        host = self.peer_host(writer.get_extra_info("peername"))
+        error = self.check_connection(host)
+        if error:
+            logging.warning("Refused connection from %r: %s", host, error)
+            writer.write(error.encode("utf-8") + b"\r\n")
+            writer.close()
+            return
+
+        channel = self.channel_class(self, reader, writer)
+        self.channels[channel] = asyncio.current_task()
+        self.peer_connections[host] += 1
+        self.metrics["connections"] += 1
+        try:
+            await channel.run()
+        finally:
+            del self.channels[channel]
+            self.metrics["connections"] -= 1
+            self.peer_connections[host] -= 1
+            if not self.peer_connections[host]:
+                del self.peer_connections[host]
+
+    def busy(self):
+        """True if the DeliveryPool can't take any more messages"""
+        return self.pool is not None and self.pool.busy()
+
+    async def deliver(self, Peer, From, To, Data, **kwargs):
+        """Calls process_message (or spool_message), in the DeliveryPool if there is one"""
+        func = self.process_message if self.spool is None else self.spool_message
+        if self.pool is None:
+            return func(Peer, From, To, Data, **kwargs)
+        elif self.pool.busy():
+            return BUSY_REPLY
+        return await self.pool.run(func, Peer, From, To, Data, **kwargs)
+
+    async def store_oversize(self, Peer, From, To, message):
+        """
+        Puts a message that's over size_limit into the oversize Maildir, message
+        is a file so that it doesn't have to be read into memory.
+        """
+        logging.info("Message from Peer: %r, From: %r, to To %r over size limit %d, moving to %s.",
+                     Peer, From, To, self.size_limit, self.oversize.dir)
+        try:
+            if self.pool is None:
+                self.oversize.push(message)
+            else:
+                await self.pool.run(self.oversize.push, message)
+        except Exception:
+            logging.exception("Failed to store oversize message from Peer: %r, From: %r, to To %r.", Peer, From, To)
+            return "451 Requested action aborted: local error in processing"
+
+    def spool_message(self, Peer, From, To, Data, **kwargs):
+        """
+        Called instead of process_message when the receiver has a spool.  Data
+        is either bytes or the binary file AsyncSMTPChannel received it into.
+        """
+        if hasattr(Data, "read"):
+            message = _EnvelopeFile(pack_envelope(Peer, From, To, b""), Data)
+        else:
+            message = pack_envelope(Peer, From, To, Data)
+
+        try:
+            key = self.spool.push(message)
+        except Exception:
+            logging.exception("Failed to spool message from Peer: %r, From: %r, to To %r.", Peer, From, To)
+            return "451 Requested action aborted: local error in processing"
+
+        logging.debug("Message from Peer: %r, From: %r, to To %r spooled with key %r.", Peer, From, To, key)
+
+    def process_message(self, Peer, From, To, Data, **kwargs):
+        """
+        Called by AsyncSMTPChannel when there's a message received.
+        """
+
+        try:
+            logging.debug("Message received from Peer: %r, From: %r, to To %r.", Peer, From, To)
+            routing.Router.deliver(mail.MailRequest(Peer, From, To, Data))
+        except SMTPError as err:
+            # looks like they want to return an error, so send it out
+            return str(err)
+        except Exception:
+            logging.exception("Exception while processing message from Peer: %r, From: %r, to To %r.",
+                              Peer, From, To)
+            undeliverable_message(Data, "Error in message %r:%r:%r, look in logs." % (Peer, From, To))
+
+
+class AsyncLMTPChannel(AsyncSMTPChannel):
+    """
+    Handles a single LMTP session for AsyncLMTPReceiver.  Every recipient gets
+    its own reply after DATA, as described in RFC 2033.
+    """
+    version = "Salmon Mail router LMTPD, version %s" % __version__
+    single_recipient = False
+
+    # LMTP uses LHLO instead
+    smtp_HELO = None
+    smtp_EHLO = None
+
+    def push(self, msg):
+        # every reply but the greeting, 354 and LHLO gets an enhanced status code
+        code, sep, text = msg.partition(" ")
+        if code != "220" and code[0] in "245" and not ENHANCED_STATUS_CODE.match(text):
+            msg = "%s %s.0.0 %s" % (code, code[0], text)
+        AsyncSMTPChannel.push(self, msg)
+
+    def extensions(self):
+        return AsyncSMTPChannel.extensions(self) + ["ENHANCEDSTATUSCODES"]
+
+    def smtp_LHLO(self, arg):
+        if not arg:
+            self.push("501 Syntax: LHLO hostname")
+            return
+        if self.seen_greeting:
+            self.push("503 Duplicate LHLO")
+            return
+        self._set_rset_state()
+        self.seen_greeting = arg
+        self.extended_smtp = True
+        AsyncSMTPChannel.push(self, "250-%s" % self.fqdn)
+        for extension in self.extensions()[:-1]:
+            AsyncSMTPChannel.push(self, "250-%s" % extension)
+        AsyncSMTPChannel.push(self, "250 %s" % self.extensions()[-1])
+
+    def smtp_HELP(self, arg):
+        self.push("250 Supported commands: LHLO MAIL RCPT DATA BDAT RSET NOOP QUIT VRFY")
+
+    async def process_data(self, data):
+        """
+        Delivers the message to each recipient in turn, replying for each one.
+        If the receiver has a spool the message is spooled once for all of
+        them, and they all get the same reply.
+        """
+        if self.smtp_server.spool is not None:
+            status = await self.deliver(self.rcpttos, data)
+            self.push_status(status or "250 OK")
+            return
+
+        for rcptto in self.rcpttos:
+            status = await self.deliver(rcptto, data)
+            self.push(status or "250 OK")
+
+    def push_status(self, status):
+        for rcptto in self.rcpttos:
+            self.push(status)
+
+
+class AsyncLMTPReceiver(AsyncSMTPReceiver):
+    """
+    Receives emails and hands it to the Router for further processing.  Unlike
+    LMTPReceiver this is built on asyncio rather than the deprecated asyncore
+    module.
+    """
+    channel_class = AsyncLMTPChannel
+
+    def __init__(self, host='127.0.0.1', port=8824, socket=None, workers=10, max_in_flight=None, **kwargs):
+        """
+        Initializes to bind on the given port and host/IP address. Remember that
+        LMTP isn't for use over a WAN, so bind it to either a LAN address or
+        localhost. If socket is not None, it will be assumed to be a path name
+        and a UNIX socket will be set up instead.
+
+        See AsyncSMTPReceiver for the other options.  Each recipient is a
+        separate delivery.
+        """
+        self.path = socket
+        AsyncSMTPReceiver.__init__(self, host, port, workers, max_in_flight, **kwargs)
+        if self.path is not None:
+            self.socket = self.path
+
+    def bind(self):
+        if self.path is None:
+            return AsyncSMTPReceiver.bind(self)
+
+        sock = take_inherited_socket(self.path)
+        if sock is not None:
+            return sock
+
+        # clean up after a previous run, but don't remove anything that's not a socket
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+            sock.listen(socket.SOMAXCONN)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def create_server(self):
+        if self.path is None:
+            return AsyncSMTPReceiver.create_server(self)
+        return asyncio.start_unix_server(self.handle_connection, sock=self.sock)
+
+
 class QueueReceiver:
     """
     Rather than listen on a socket this will watch a queue directory and
@@ -295,61 +1540,300 @@ class QueueReceiver:
     same way otherwise.
     """
 
-    def __init__(self, queue_dir, sleep=10, size_limit=0, oversize_dir=None, workers=10):
+    def __init__(self, queue_dir, sleep=10, size_limit=0, oversize_dir=None, workers=10, envelope=False,
+                 max_in_flight=None, mode="thread", lease_timeout=600, batch_size=1, shards=0, shard_ids=None,
+                 priorities=None, deferred=False, backoff=60, max_attempts=10):
         """
         The router should be fully configured and ready to work, the queue_dir
         can be a fully qualified path or relative. The option workers dictates
         how many threads are started to process messages. Consider adding
         ``@nolocking`` to your handlers if you are able to.
+
+        Workers are handed up to batch_size messages at a time, as they were
+        stored in the queue, and parse them themselves.
+
+        Set mode to "process" to process messages in worker processes rather
+        than threads, for handlers that spend most of their time parsing or
+        otherwise using the CPU.  Workers are forked when start is called, so
+        they inherit the already loaded handlers and settings.  Each worker
+        has its own copy of the Router, so handlers that use states will need
+        a STATE_STORE that isn't MemoryStorage.
+
+        No more than max_in_flight messages (by default twice the number of
+        workers) are popped and waiting for or being processed at once.  When
+        that many are, the receiver stops popping until a worker finishes one,
+        so a large backlog stays on disk rather than in memory.
+
+        Messages are claimed rather than popped off the queue (see
+        Queue.claim), and only deleted once they've been delivered.  If the
+        receiver dies, another one sharing queue_dir (or this one, once it's
+        been restarted) delivers them once lease_timeout seconds have passed,
+        so that should be longer than any message takes to deliver.  Any
+        number of receivers can share queue_dir.
+
+        queue_dir can also be a queue object, such as a SQLiteQueue, in which
+        case size_limit, oversize_dir, shards, shard_ids, priorities, backoff
+        and max_attempts are ignored.
+
+        If shards is given, queue_dir is a ShardedQueue with that many shards,
+        and shard_ids can limit the receiver to some of them.
+
+        If priorities is given, e.g. queue.PRIORITIES, messages pushed with a
+        higher priority are delivered ahead of a backlog of lower priority
+        ones, with priorities mapping each priority to its weight (see
+        Queue).  Producers should use the same priorities.
+
+        Set deferred to True if queue_dir is a DeferredQueue, in which case
+        messages are only delivered once they're due.  Handlers can raise an
+        SMTPError with a 4xx code to have the message tried again later, after
+        backoff seconds and then twice as long each time, until it's been
+        tried max_attempts times and is given up on as undeliverable.  If
+        envelope is set, the message is only tried again for the recipient
+        that raised and those after it, not those it was already delivered to.
+
+        Set envelope to True if queue_dir is the spool of an AsyncSMTPReceiver.
+        Messages are then delivered once per recipient in their envelope.  Only
+        do this for queues that are written to by Salmon itself.
+
+        The metrics attribute is a Counter of:
+
+        - ``delivered``: messages processed
+        - ``failed``: messages that couldn't be processed, and will be tried
+          again once their lease has expired (or later, if deferred is set)
+        - ``deferred``: messages put back to be tried again later
+        - ``in_flight``: messages currently waiting for or running on a thread
+        - ``saturated``: how many times the receiver had to wait for a free slot
+        - ``blocked``: total seconds spent waiting for a free slot
         """
-        self.queue = queue.Queue(queue_dir, pop_limit=size_limit,
-                                 oversize_dir=oversize_dir)
-        self.sleep = sleep
+        if mode not in ("thread", "process"):
+            raise ValueError("mode must be 'thread' or 'process', not %r" % mode)
+        if deferred and shards:
+            raise ValueError("deferred and shards can't be used together")
 
-        # Pool is from multiprocess.dummy which uses threads rather than processes
-        self.workers = Pool(workers)
+        if not isinstance(queue_dir, str):
+            self.queue = queue_dir
+        elif deferred:
+            self.queue = queue.DeferredQueue(queue_dir, backoff=backoff, max_attempts=max_attempts,
+                                             pop_limit=size_limit, oversize_dir=oversize_dir)
+        elif shards:
+            self.queue = queue.ShardedQueue(queue_dir, shards, shard_ids, pop_limit=size_limit,
+                                            oversize_dir=oversize_dir, priorities=priorities)
+        else:
+            self.queue = queue.Queue(queue_dir, pop_limit=size_limit,
+                                     oversize_dir=oversize_dir, priorities=priorities)
+        self.sleep = sleep
+        self.mode = mode
+        self.envelope = envelope
+        self.deferred = deferred
+        self.lease_timeout = lease_timeout
+        self.next_reap = 0
+        self.batch_size = batch_size
+        self.worker_count = workers
+        self.workers = None
+        self.max_in_flight = max_in_flight or workers * 2
+        self.slots = None
+        # updated from worker threads too
+        self.metrics = Counter()
+        self.metrics_lock = threading.Lock()
 
     def start(self, one_shot=False):
         """
-        Start simply loops indefinitely sleeping and pulling messages
-        off for processing when they are available.
+        Start simply loops indefinitely pulling messages off for processing
+        and waiting for more when the queue is empty.  On Linux new messages
+        are noticed straight away, elsewhere the queue is checked every
+        self.sleep seconds.
 
         If you give one_shot=True it will stop once it has exhausted the queue
         """
 
         logging.info("Queue receiver started on queue dir %s", self.queue.dir)
-        logging.debug("Sleeping for %d seconds...", self.sleep)
-
-        # if there are no messages left in the maildir and this a one-shot, the
-        # while loop terminates
-        while not (len(self.queue) == 0 and one_shot):
-            # if there's nothing in the queue, take a break
-            if len(self.queue) == 0:
-                time.sleep(self.sleep)
-                continue
+        logging.debug("Waiting up to %d seconds for new messages...", self.sleep)
 
-            try:
-                key, msg = self.queue.pop()
-            except KeyError:
-                logging.debug("Could not find message in Queue")
+        # Pool is from multiprocess.dummy which uses threads rather than
+        # processes. It's created here so that it survives being forked by
+        # salmon start --processes
+        if self.mode == "process":
+            self.workers = multiprocessing.get_context("fork").Pool(self.worker_count)
+        else:
+            self.workers = Pool(self.worker_count)
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+
+        while True:
+            self.reap()
+            slots = self.take_slots()
+            batch = self.queue.claim_many(slots)
+            for i in range(slots - len(batch)):
+                self.slots.release()
+
+            if not batch:
+                # if there are no messages left in the maildir and this a
+                # one-shot, we're done
+                if one_shot:
+                    break
+                self.queue.wait(self.sleep)
                 continue
 
-            logging.debug("Pulled message with key: %r off", key)
-            self.workers.apply_async(self.process_message, args=(msg,))
+            logging.debug("Pulled messages with keys: %r off", [key for key, data in batch])
+            self.submit(batch)
 
         self.workers.close()
         self.workers.join()
 
+    def submit(self, batch):
+        """Hands a batch of messages that have been claimed from the queue to a worker"""
+        with self.metrics_lock:
+            self.metrics["in_flight"] += len(batch)
+
+        keys = [key for key, data in batch]
+        messages = [data for key, data in batch]
+        self.workers.apply_async(self.process_batch, args=(self.queue.dir, messages, self.envelope, self.deferred),
+                                 callback=functools.partial(self.finished, keys),
+                                 error_callback=functools.partial(self.failed, keys))
+
+    def reap(self):
+        """Every so often, puts messages with expired leases back on the queue"""
+        now = time.monotonic()
+        if now < self.next_reap:
+            return
+        self.next_reap = now + self.lease_timeout / 2
+        self.queue.reap(self.lease_timeout)
+
+    def take_slots(self):
+        """
+        Waits for a free slot and then takes as many more as are free, up to
+        batch_size.  Returns how many it took.
+        """
+        self.wait_for_slot()
+        taken = 1
+        while taken < self.batch_size and self.slots.acquire(blocking=False):
+            taken += 1
+        return taken
+
+    def wait_for_slot(self):
+        """Blocks until fewer than max_in_flight messages are being processed"""
+        if self.slots.acquire(blocking=False):
+            return
+
+        with self.metrics_lock:
+            self.metrics["saturated"] += 1
+        started = time.monotonic()
+        self.slots.acquire()
+        with self.metrics_lock:
+            self.metrics["blocked"] += time.monotonic() - started
+
+    def finished(self, keys, errors):
+        for i, key in enumerate(keys):
+            if i in errors:
+                if self.deferred:
+                    self.retry(key, errors[i])
+                # otherwise leave it claimed, so it'll be tried again once the lease expires
+                continue
+            try:
+                self.queue.ack(key)
+            except OSError:
+                logging.exception("Failed to remove delivered message %s from %s", key, self.queue.dir)
+
+        with self.metrics_lock:
+            self.metrics["in_flight"] -= len(keys)
+            self.metrics["delivered"] += len(keys) - len(errors)
+            self.metrics["failed"] += len(errors)
+        for key in keys:
+            self.slots.release()
+
+    def retry(self, key, data=None):
+        """
+        Puts a message that failed back on the DeferredQueue to be tried again
+        later, as data if that's given.
+        """
+        try:
+            new_key = self.queue.retry(key, data)
+        except queue.QueueError as err:
+            undeliverable_message(err.data, str(err))
+        except OSError:
+            logging.exception("Failed to defer message %s in %s", key, self.queue.dir)
+            return
+        else:
+            logging.info("Deferred message %s as %s", key, new_key)
+        with self.metrics_lock:
+            self.metrics["deferred"] += 1
+
+    def failed(self, keys, exc):
+        # leave them claimed, so they'll be tried again once the lease expires
+        logging.error("Failed to process messages %s from %s", keys, self.queue.dir, exc_info=exc)
+        with self.metrics_lock:
+            self.metrics["in_flight"] -= len(keys)
+            self.metrics["failed"] += len(keys)
+        for key in keys:
+            self.slots.release()
+
     def process_message(self, msg):
         """
         Exactly the same as SMTPReceiver.process_message but just designed for the queue's
         quirks.
         """
+        envelope = unpack_envelope(msg.Data) if self.envelope else None
+        if envelope is None:
+            self.deliver(msg)
+        else:
+            self.deliver_envelope(*envelope)
+
+    @staticmethod
+    def process_batch(queue_dir, batch, envelope, deferred=False):
+        """
+        Calls process_raw for each message in batch, and returns a dict of
+        the positions of any that raised an exception.  Each is mapped to what
+        should be tried again in its place, or None for the message as it was.
+        This is what runs in the workers.
+        """
+        errors = {}
+        for i, data in enumerate(batch):
+            try:
+                QueueReceiver.process_raw(queue_dir, data, envelope, deferred)
+            except Exception as err:
+                logging.exception("Exception while processing message from %s", queue_dir)
+                errors[i] = getattr(err, "retry_data", None)
+        return errors
+
+    @staticmethod
+    def process_raw(queue_dir, data, envelope, deferred=False):
+        """
+        Like process_message, but takes the message as it was stored in the
+        queue.  If deferred is True, SMTPErrors with a 4xx code are raised
+        rather than the message being given up on.
+        """
+        unpacked = unpack_envelope(data) if envelope else None
+        if unpacked is not None:
+            QueueReceiver.deliver_envelope(*unpacked, deferred=deferred)
+            return
+
+        try:
+            msg = mail.MailRequest(queue_dir, None, None, data)
+        except Exception:
+            logging.exception("Failed to decode message from %s", queue_dir)
+            undeliverable_message(data, "Failed to decode message.")
+            return
+        QueueReceiver.deliver(msg, deferred)
+
+    @staticmethod
+    def deliver_envelope(Peer, From, To, Data, deferred=False):
+        if isinstance(To, str):
+            raise TypeError("Envelope recipients must be a list, not %r" % To)
+        for i, rcpt in enumerate(To):
+            try:
+                QueueReceiver.deliver(mail.MailRequest(Peer, From, rcpt, Data), deferred)
+            except SMTPError as err:
+                # the recipients before this one have had it, so only the rest are tried again
+                err.retry_data = pack_envelope(Peer, From, To[i:], Data)
+                raise
 
+    @staticmethod
+    def deliver(msg, deferred=False):
         try:
             logging.debug("Message received from Peer: %r, From: %r, to To %r.", msg.Peer, msg.From, msg.To)
             routing.Router.deliver(msg)
         except SMTPError as err:
+            if deferred and 400 <= err.code < 500:
+                raise
             logging.exception("Raising SMTPError when running in a QueueReceiver is unsupported.")
             undeliverable_message(msg.Data, err.message)
         except Exception:
@@ -4,11 +4,16 @@ really belong anywhere else in the modules.  This module
 is kind of a dumping ground, so if you find something that
 can be improved feel free to work up a patch.
 """
+import fcntl
 import imp
 import importlib
 import logging
 import os
+import select
+import signal
 import sys
+import threading
+import time
 
 from lockfile import pidlockfile
 import daemon
@@ -17,6 +22,16 @@ from salmon import routing, server
 
 settings = None
 
+# how long restart_process waits for the new process to start its receiver
+RESTART_TIMEOUT = 30
+
+# the environment variable restart_process passes the new process's end of
+# the pipe it says it's ready on in, see notify_ready
+READY_FD_ENV = "SALMON_READY_FD"
+
+# the pid file start_server daemonized with, if it did
+_pid_file = None
+
 
 def import_settings(boot_also, boot_module="config.boot"):
     """Returns the current settings module, there is no harm in calling it
@@ -112,15 +127,278 @@ def check_for_pid(pid, force):
             os.unlink(pid)
 
 
-def start_server(pid, force, chroot, chdir, uid, gid, umask, settings_loader, debug, daemon_proc):
+def _restarted_from(pid):
+    """True if this process was started by salmon restart from the process in the pid file"""
+    old_pid = os.environ.pop("SALMON_RESTART", None)
+    if old_pid is None or not os.path.exists(pid):
+        return False
+    with open(pid) as pid_file:
+        return pid_file.readline().strip() == old_pid
+
+
+def restart_process(socks, timeout=RESTART_TIMEOUT):
+    """
+    Starts a new copy of this process with the same command line, handing it
+    socks using the LISTEN_FDS protocol.  Returns the new process's pid once
+    it has started its receiver (see notify_ready).  If it exits or doesn't
+    say it's ready within timeout seconds it's killed and None is returned,
+    so this process can carry on serving.
+    """
+    ready_fd, new_ready_fd = os.pipe()
+    new_pid = os.fork()
+    if new_pid:
+        os.close(new_ready_fd)
+        return _wait_for_ready(new_pid, ready_fd, timeout)
+
+    try:
+        # move the sockets (and the end of the pipe) clear of where they're
+        # going first, so that putting them at 3, 4, ... can't clobber one
+        # that's yet to be moved
+        start = server.LISTEN_FDS_START
+        fds = [fcntl.fcntl(fd, fcntl.F_DUPFD_CLOEXEC, start + len(socks) + 1)
+               for fd in [sock.fileno() for sock in socks] + [new_ready_fd]]
+        for i, fd in enumerate(fds):
+            # dup2 makes the new descriptor inheritable
+            os.dup2(fd, start + i)
+
+        # daemonizing can leave /dev/null on stdin as close-on-exec, which
+        # would leave the new process without one
+        for fd in range(start):
+            try:
+                os.set_inheritable(fd, True)
+            except OSError:
+                pass
+
+        env = dict(os.environ, LISTEN_FDS=str(len(socks)), LISTEN_PID=str(os.getpid()),
+                   SALMON_RESTART=str(os.getppid()))
+        env[READY_FD_ENV] = str(start + len(socks))
+        argv = getattr(sys, "orig_argv", [sys.executable] + sys.argv)
+        os.execve(sys.executable, argv, env)
+    except BaseException:
+        logging.exception("Failed to start a new process")
+    os._exit(1)
+
+
+def _wait_for_ready(new_pid, ready_fd, timeout):
+    """Waits for new_pid to say it's ready on ready_fd, see restart_process"""
+    try:
+        ready, _, _ = select.select([ready_fd], [], [], timeout)
+        # the pipe is closed without anything being written if it exits
+        ready = ready and os.read(ready_fd, 1) == b"1"
+    finally:
+        os.close(ready_fd)
+    if ready:
+        return new_pid
+
+    logging.error("New process %d exited or didn't start within %d seconds, carrying on", new_pid, timeout)
+    try:
+        os.kill(new_pid, signal.SIGKILL)
+        os.waitpid(new_pid, 0)
+    except ChildProcessError:
+        # reaped already
+        pass
+
+    # the new process removes the pid file before writing its own
+    if _pid_file is not None:
+        with open(_pid_file, "w") as pid_file:
+            pid_file.write("%d\n" % os.getpid())
+    return None
+
+
+def notify_ready(ready=True):
+    """
+    Tells the process that started this one with restart_process that its
+    receiver has started, so that it can stop its own.  With ready False the
+    pipe is just closed, for a process that leaves saying so to its children.
+    Does nothing if this process wasn't started by restart_process, or has
+    already been called.
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        if ready:
+            os.write(int(fd), b"1")
+    except OSError:
+        logging.exception("Failed to tell the old process this one is ready")
+    finally:
+        os.close(int(fd))
+
+
+def wait_for_stop(receiver, restart=True):
+    """
+    Blocks until SIGTERM (or SIGUSR2 if restart is True) is received and then
+    stops receiver, giving sessions receiver.drain_timeout seconds to finish.
+
+    SIGUSR2 starts a new copy of this process first, which takes over the
+    receiver's listening socket so that no connections are refused.  Once
+    that has started its receiver, this process exits without cleaning up,
+    as the pid file now belongs to the new process.  If it fails to start,
+    this process carries on as it was.
+    """
+    received = []
+    stop = threading.Event()
+
+    def handler(signum, frame):
+        received.append(signum)
+        stop.set()
+
+    signums = [signal.SIGTERM, signal.SIGUSR2] if restart else [signal.SIGTERM]
+    previous = {signum: signal.signal(signum, handler) for signum in signums}
+    new_pid = None
+    try:
+        while new_pid is None:
+            while not stop.wait(1):
+                pass
+            stop.clear()
+            if signal.SIGTERM in received:
+                break
+            new_pid = restart_process([receiver.sock])
+    finally:
+        for signum, old_handler in previous.items():
+            signal.signal(signum, old_handler)
+
+    if new_pid is None:
+        logging.info("Received SIGTERM, stopping")
+    else:
+        logging.info("Started new process %d, stopping", new_pid)
+
+    receiver.stop(receiver.drain_timeout)
+
+    if new_pid is not None:
+        os._exit(0)
+
+
+def _run_worker(receiver):
+    """Runs receiver in a freshly forked worker, never returns"""
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+    # restarts are handled by the supervisor
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    try:
+        receiver.start()
+        notify_ready()
+        if isinstance(receiver, server.AsyncSMTPReceiver):
+            wait_for_stop(receiver, restart=False)
+        # receivers run in their own threads, wait for them rather than
+        # returning into the supervisor's code
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+    except Exception:
+        logging.exception("Worker %d crashed", os.getpid())
+        os._exit(1)
+
+    os._exit(0)
+
+
+class Supervisor:
+    """
+    Forks workers that each run receiver.start() on the socket that was bound
+    when the receiver was created, so the kernel spreads connections between
+    them.  Workers that die are replaced, but no faster than once every
+    respawn_delay seconds.  SIGHUP and SIGTERM are passed on to the workers,
+    after which the supervisor waits for them to exit.
+
+    SIGUSR2 starts a new copy of the whole process (see wait_for_stop) and
+    then, once it has started, stops the workers with SIGTERM.
+    """
+    def __init__(self, receiver, processes, respawn_delay=1):
+        self.receiver = receiver
+        self.processes = processes
+        self.respawn_delay = respawn_delay
+        self.workers = {}
+        self.stopping = False
+        self.restarted = False
+
+    def spawn(self):
+        worker = os.fork()
+        if worker == 0:
+            _run_worker(self.receiver)
+        self.workers[worker] = time.monotonic()
+        logging.info("Started worker %d", worker)
+
+    def forward(self, signum, frame):
+        self.stopping = True
+        for worker in self.workers:
+            try:
+                os.kill(worker, signum)
+            except ProcessLookupError:
+                pass
+
+    def restart(self, signum, frame):
+        new_pid = restart_process([self.receiver.sock])
+        if new_pid is None:
+            # the workers carry on
+            return
+        logging.info("Started new process %d, stopping workers", new_pid)
+        self.restarted = True
+        self.forward(signal.SIGTERM, frame)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.forward)
+        signal.signal(signal.SIGTERM, self.forward)
+        if isinstance(self.receiver, server.AsyncSMTPReceiver):
+            signal.signal(signal.SIGUSR2, self.restart)
+
+        for i in range(self.processes):
+            self.spawn()
+        # the workers each say they're ready themselves
+        notify_ready(False)
+
+        while self.workers:
+            try:
+                worker, status = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.workers.pop(worker, None)
+            if started is None or self.stopping:
+                continue
+
+            logging.error("Worker %d exited with status %d, starting a new one", worker, status)
+            if time.monotonic() - started < self.respawn_delay:
+                time.sleep(self.respawn_delay)
+                # a worker started now wouldn't be told to stop
+                if self.stopping:
+                    continue
+            self.spawn()
+
+        logging.info("All workers have exited")
+        if self.restarted:
+            # the pid file belongs to the new process now
+            os._exit(0)
+
+
+def supervise(receiver, processes, respawn_delay=1):
+    """Runs receiver in processes workers until told to stop, see Supervisor"""
+    Supervisor(receiver, processes, respawn_delay).run()
+
+
+def start_server(pid, force, chroot, chdir, uid, gid, umask, settings_loader, debug, daemon_proc, processes=1):
     """
     Starts the server by doing a daemonize and then dropping priv
     accordingly.  It will only drop to the uid/gid given if both are given.
+
+    If processes is more than 1, that many workers are forked to run the
+    receiver and this process supervises them.
+
+    Receivers that support it are stopped gracefully on SIGTERM and restarted
+    without dropping connections on SIGUSR2, see wait_for_stop.
     """
-    check_for_pid(pid, force)
+    global _pid_file
+
+    check_for_pid(pid, force or _restarted_from(pid))
+
+    # sockets passed to us have to survive daemonizing, as does the pipe to
+    # the process that started us if there is one
+    inherited = [sock.fileno() for sock in server.inherited_sockets()]
+    inherited += [int(fd) for fd in [os.environ.get(READY_FD_ENV)] if fd]
 
     if not debug and daemon_proc:
-        daemonize(pid, chdir, chroot, umask, files_preserve=[])
+        daemonize(pid, chdir, chroot, umask, files_preserve=inherited)
+        _pid_file = pid
 
     sys.path.append(os.getcwd())
 
@@ -132,9 +410,16 @@ def start_server(pid, force, chroot, chdir, uid, gid, umask, settings_loader, de
         logging.warning("You probably meant to give a uid and gid, but you gave: uid=%r, gid=%r. "
                         "Will not change to any user.", uid, gid)
 
+    if processes > 1:
+        supervise(settings.receiver, processes)
+        return
+
     settings.receiver.start()
+    notify_ready()
 
-    if debug:
+    if isinstance(settings.receiver, server.AsyncSMTPReceiver) and not debug:
+        wait_for_stop(settings.receiver)
+    elif debug:
         print("Salmon started in debug mode. ctrl-c to quit...")
         import time
         try:
@@ -1,7 +1,9 @@
 from tempfile import mkdtemp
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, call, patch
+import json
 import mailbox
 import os
+import signal
 import sys
 
 from click import testing
@@ -56,6 +58,7 @@ class CommandTestCase(SalmonTestCase):
         mq.get.return_value = "A sample message"
         mq.keys.return_value = ["key1", "key2"]
         mq.pop.return_value = ('key1', 'message1')
+        mq.clear.return_value = 0
         mq.__len__.return_value = 1
 
         runner = CliRunner()
@@ -71,6 +74,11 @@ class CommandTestCase(SalmonTestCase):
 
         runner.invoke(commands.main, ("queue", "--clear"))
         self.assertEqual(mq.clear.call_count, 1)
+        self.assertEqual(mq.clear.call_args, call(1))
+
+        result = runner.invoke(commands.main, ("queue", "--clear", "--workers", "4"))
+        self.assertEqual(mq.clear.call_args, call(4))
+        self.assertIn("Removed 0 messages", result.output)
 
         runner.invoke(commands.main, ("queue", "--keys"))
         self.assertEqual(mq.keys.call_count, 1)
@@ -78,6 +86,12 @@ class CommandTestCase(SalmonTestCase):
         runner.invoke(commands.main, ("queue", "--count"))
         self.assertEqual(mq.__len__.call_count, 1)
 
+        mq.stats.return_value = {"depth": 1, "bytes": 100, "oldest_age": 2.5}
+        result = runner.invoke(commands.main, ("queue", "--stats"))
+        self.assertEqual(mq.stats.call_count, 1)
+        self.assertEqual(json.loads(result.output.splitlines()[-1]),
+                         {"depth": 1, "bytes": 100, "oldest_age": 2.5})
+
     @patch('salmon.utils.daemonize')
     @patch('salmon.server.SMTPReceiver')
     def test_log_command(self, MockSMTPReceiver, daemon_mock):
@@ -156,6 +170,19 @@ class StartCommandTestCase(SalmonTestCase):
         self.assertEqual(daemon_mock.call_count, 2)
         self.assertEqual(daemon_mock.call_args, (("run/fake.pid", ".", None, None), {"files_preserve": []}))
 
+    @patch('salmon.utils.daemonize')
+    @patch('salmon.utils.import_settings')
+    @patch('salmon.utils.supervise')
+    def test_processes(self, supervise_mock, settings_mock, daemon_mock):
+        runner = CliRunner()
+        runner.invoke(commands.main, ("start", "--pid", "run/fake.pid", "--processes", "4"))
+        self.assertEqual(supervise_mock.call_count, 1)
+        self.assertEqual(supervise_mock.call_args, ((settings_mock.return_value.receiver, 4), {}))
+        self.assertEqual(settings_mock.return_value.receiver.start.call_count, 0)
+
+        result = runner.invoke(commands.main, ("start", "--pid", "run/fake.pid", "--processes", "0"))
+        self.assertEqual(result.exit_code, 2)
+
     @patch('salmon.utils.daemonize')
     @patch('salmon.utils.import_settings')
     def test_non_daemon(self, settings_mock, daemon_mock):
@@ -279,6 +306,51 @@ class StopCommandTestCase(SalmonTestCase):
         self.assertEqual(result.exit_code, 0)
         assert not os.path.exists("run/fake.pid")
 
+    def test_stop_graceful(self):
+        runner = CliRunner()
+        make_fake_pid_file()
+        os.kill.side_effect = [None, None, ProcessLookupError]
+        result = runner.invoke(commands.main, ("stop", "--pid", "run/fake.pid", "--graceful"))
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(os.kill.call_args_list, [call(0, signal.SIGTERM), call(0, 0), call(0, 0)])
+        # the server removes its own pid file
+        self.assertTrue(os.path.exists("run/fake.pid"))
+
+    def test_stop_graceful_timeout(self):
+        runner = CliRunner()
+        make_fake_pid_file()
+        result = runner.invoke(commands.main, ("stop", "--pid", "run/fake.pid", "--graceful", "--timeout", "0"))
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("didn't stop in time", result.output)
+
+    def test_restart(self):
+        runner = CliRunner()
+        make_fake_pid_file()
+
+        def new_process(pid, signum):
+            if signum == 0:
+                # the old process has stopped
+                raise ProcessLookupError
+            with open("run/fake.pid", "w") as f:
+                f.write("1234")
+
+        os.kill.side_effect = new_process
+        result = runner.invoke(commands.main, ("restart", "--pid", "run/fake.pid"))
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(os.kill.call_args_list[0], call(0, signal.SIGUSR2))
+        self.assertIn("Salmon restarted with PID 1234", result.output)
+
+    def test_restart_not_running(self):
+        runner = CliRunner()
+        result = runner.invoke(commands.main, ("restart", "--pid", "run/fake.pid"))
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(os.kill.call_count, 0)
+
+        make_fake_pid_file()
+        result = runner.invoke(commands.main, ("restart", "--pid", "run/fake.pid", "--timeout", "0"))
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("didn't restart in time", result.output)
+
     def test_stop_force_oserror(self):
         runner = CliRunner()
         make_fake_pid_file()
@@ -2,7 +2,7 @@ from unittest.mock import Mock, patch
 
 from salmon import mail, view
 from salmon.confirm import ConfirmationEngine, ConfirmationStorage
-from salmon.queue import Queue
+from salmon.queue import Queue, SQLiteQueue
 from salmon.testing import delivered, relay
 import jinja2
 
@@ -98,3 +98,9 @@ class ConfirmationTestCase(SalmonTestCase):
         self.engine.cancel(target, confirm['To'], expect_secret)
 
         self.assertIn(b"testing:somedude@localhost", self.engine.storage.confirmations.keys())
+
+
+class SQLiteConfirmationTestCase(ConfirmationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine = ConfirmationEngine(SQLiteQueue('run/confirm.sqlite3'), self.storage)
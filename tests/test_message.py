@@ -176,6 +176,22 @@ class MessageTestCase(TestCase):
         self.assertEqual(len(msg_parts), 0)
         assert msg.body()
 
+    def test_mail_request_is_modified(self):
+        msg = mail.MailRequest("localhost", None, None, sample_message.encode())
+        self.assertFalse(msg.is_modified())
+        msg["Subject"] = "changed"
+        self.assertTrue(msg.is_modified())
+
+        msg = mail.MailRequest("localhost", None, None, sample_message.encode())
+        msg.base.body = "Changed"
+        self.assertTrue(msg.is_modified())
+
+        sample = self.test_mail_response_attachments()
+        msg = mail.MailRequest("localhost", None, None, str(sample).encode())
+        self.assertFalse(msg.is_modified())
+        msg.all_parts()[1].body = "Changed"
+        self.assertTrue(msg.is_modified())
+
     def test_mail_response_mailing_list_headers(self):
         list_addr = "test.users@localhost"
 
@@ -1,7 +1,12 @@
 from unittest.mock import Mock, patch
+import io
 import mailbox
+import multiprocessing
 import os
 import shutil
+import threading
+import time
+import unittest
 
 from salmon import mail, queue
 
@@ -55,6 +60,101 @@ class QueueTestCase(SalmonTestCase):
         self.assertEqual(q.count(), 0)
         assert not q.pop()[0]
 
+    def test_pop_raw(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.clear()
+        q.push(BYTES_MESSAGE)
+
+        key, msg = q.pop(raw=True)
+        self.assertEqual(msg, BYTES_MESSAGE)
+        self.assertEqual(len(q), 0)
+
+    def test_pop_many(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        keys = {q.push(BYTES_MESSAGE) for i in range(3)}
+
+        popped = q.pop_many(2)
+        self.assertEqual(len(popped), 2)
+        self.assertEqual([msg for key, msg in popped], [BYTES_MESSAGE, BYTES_MESSAGE])
+
+        popped += q.pop_many(2, raw=False)
+        self.assertEqual(len(popped), 3)
+        self.assertEqual(popped[2][1]['subject'], "bob!")
+        self.assertEqual({key for key, msg in popped}, keys)
+        self.assertEqual(q.pop_many(2), [])
+
+    def test_claim_many(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        for i in range(3):
+            q.push(BYTES_MESSAGE)
+
+        claimed = q.claim_many(5)
+        self.assertEqual([msg for key, msg in claimed], [BYTES_MESSAGE] * 3)
+        self.assertEqual(sorted(os.listdir(q.claimed_dir)), sorted(key for key, msg in claimed))
+        self.assertEqual(q.claim_many(5), [])
+
+    def test_claim(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.clear()
+        q.push(BYTES_MESSAGE)
+        q.push(BYTES_MESSAGE)
+
+        key, msg = q.claim()
+        self.assertEqual(msg['subject'], "bob!")
+        self.assertEqual(len(q), 1)
+        self.assertEqual(os.listdir(q.claimed_dir), [key])
+
+        # another process can't get the same message
+        other_key, other_msg = queue.Queue("run/queue", safe=self.use_safe).claim(raw=True)
+        self.assertNotEqual(other_key, key)
+        self.assertEqual(other_msg, BYTES_MESSAGE)
+        self.assertEqual(q.claim(), (None, None))
+
+        q.ack(key)
+        q.release(other_key)
+        self.assertEqual(os.listdir(q.claimed_dir), [])
+        self.assertEqual(len(q), 1)
+
+    def test_claim_race(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.clear()
+        key = q.push(BYTES_MESSAGE)
+
+        # claimed by someone else between listing and renaming
+        with patch("salmon.queue.os.rename", side_effect=FileNotFoundError):
+            self.assertEqual(q.claim(), (None, None))
+        self.assertEqual(q.keys(), [key])
+
+    def test_reap(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.clear()
+        q.push(BYTES_MESSAGE)
+        key, msg = q.claim()
+        # left over from something else
+        open(os.path.join(q.claimed_dir, "junk"), "w").close()
+
+        self.assertEqual(q.reap(60), 0)
+        self.assertEqual(len(q), 0)
+
+        with patch("salmon.queue.time.time", return_value=time.time() + 61):
+            self.assertEqual(q.reap(60), 1)
+        self.assertEqual(os.listdir(q.claimed_dir), ["junk"])
+        self.assertEqual(q.keys(), [key.rsplit(".", 1)[0]])
+
+    def test_claimed_dir(self):
+        shutil.rmtree("run/queue", ignore_errors=True)
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.push(BYTES_MESSAGE)
+        q.pop()
+        # claimed/ is only made by claim
+        self.assertFalse(os.path.exists(q.claimed_dir))
+        self.assertEqual(q.reap(60), 0)
+
+        q.push(BYTES_MESSAGE)
+        key, msg = q.claim()
+        self.assertEqual(os.listdir(q.claimed_dir), [key])
+        q.ack(key)
+
     def test_get(self):
         q = self.test_push()
         msg = mail.MailResponse(To="test@localhost", From="test@localhost", Subject="Test", Body="Test")
@@ -157,6 +257,757 @@ class QueueTestCase(SalmonTestCase):
         q = self.test_push()
         self.assertEqual(len(q), 1)
 
+    def test_len_approximate(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        other = queue.Queue("run/queue", safe=self.use_safe)
+        exact = queue.Queue("run/queue", safe=self.use_safe, exact_len=True)
+        for i in range(3):
+            q.push(BYTES_MESSAGE)
+
+        self.assertEqual(len(q), 3)
+        self.assertEqual(len(other), 3)
+        q.pop()
+        q.push(BYTES_MESSAGE)
+        q.push(BYTES_MESSAGE)
+        self.assertEqual(len(q), 4)
+
+        # other doesn't know about q's changes, but exact does
+        self.assertEqual(len(other), 3)
+        self.assertEqual(len(exact), 4)
+
+        # finding the queue empty puts other right again
+        q.clear()
+        self.assertEqual(other.pop(), (None, None))
+        self.assertEqual(len(other), 0)
+        self.assertEqual(len(q), 0)
+
+    @patch("salmon.queue.SCAN_BATCH", 2)
+    def test_pop_cursor(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        keys = {q.push(BYTES_MESSAGE) for i in range(5)}
+
+        with patch("salmon.queue.os.scandir", wraps=os.scandir) as scandir_mock:
+            popped = {q.pop(raw=True)[0] for i in range(5)}
+            self.assertEqual(popped, keys)
+            # new/ and cur/ were only listed once between them
+            scanned = [args[0] for args, kwargs in scandir_mock.call_args_list
+                       if os.path.dirname(args[0]) == "run/queue"]
+            self.assertEqual(len(scanned), 2)
+
+            # a message pushed after the scan is found by the next one
+            key = q.push(BYTES_MESSAGE)
+            self.assertEqual(q.pop(raw=True)[0], key)
+            self.assertEqual(q.pop(), (None, None))
+
+    def test_ordered(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, ordered=True)
+        keys = []
+        # pushed newest first, so the order they're listed in doesn't matter
+        for pushed in range(1005, 1000, -1):
+            with patch("salmon.queue.time.time", return_value=pushed + 0.5):
+                keys.insert(0, q.push(BYTES_MESSAGE))
+
+        with patch("salmon.queue.os.scandir", wraps=os.scandir) as scandir_mock:
+            self.assertEqual(q.pop(raw=True)[0], keys[0])
+            key, msg = q.claim()
+            self.assertEqual(key.rsplit(".", 1)[0], keys[1])
+
+            # messages this queue pushes or releases go straight into the heap
+            with patch("salmon.queue.time.time", return_value=1000):
+                older = q.push(BYTES_MESSAGE)
+            q.release(key)
+            self.assertEqual([key for key, msg in q.pop_many(5)], [older] + keys[1:])
+            self.assertEqual(q.pop(), (None, None))
+
+            # the queue was only listed when it was first popped, and when it was empty
+            scanned = [args[0] for args, kwargs in scandir_mock.call_args_list
+                       if os.path.dirname(args[0]) == "run/queue"]
+            self.assertEqual(len(scanned), 4)
+
+    def test_ordered_same_second(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, ordered=True)
+        with patch("salmon.queue.time.time", return_value=1000):
+            keys = [q.push(BYTES_MESSAGE) for i in range(20)]
+        self.assertEqual([key for key, msg in q.pop_many(20)], keys)
+
     def test_count(self):
         q = self.test_push()
         self.assertEqual(q.count(), 1)
+
+    def test_stats(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES)
+        self.assertEqual(q.stats(), {"depth": 0, "bytes": 0, "oldest_age": None})
+
+        with patch("salmon.queue.time.time", return_value=1000):
+            first = q.push(BYTES_MESSAGE)
+        with patch("salmon.queue.time.time", return_value=1005):
+            q.push(BYTES_MESSAGE)
+            q.push(BYTES_MESSAGE, priority="high")
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            self.assertEqual(q.stats(), {"depth": 3, "bytes": 3 * len(BYTES_MESSAGE), "oldest_age": 10})
+            q.remove(first)
+            key, msg = q.claim()
+            # removing and claiming are counted without looking at the queue again
+            with patch("salmon.queue.os.scandir") as scandir_mock:
+                self.assertEqual(q.stats(), {"depth": 1, "bytes": len(BYTES_MESSAGE), "oldest_age": 5})
+                q.release(key)
+                self.assertEqual(q.stats()["depth"], 2)
+                self.assertEqual(scandir_mock.call_count, 0)
+
+        # other only knows about changes made by other processes if it's exact
+        other = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES)
+        self.assertEqual(other.stats()["depth"], 2)
+        q.push(BYTES_MESSAGE)
+        self.assertEqual(other.stats()["depth"], 2)
+        self.assertEqual(other.stats(exact=True)["depth"], 3)
+
+    def test_fsync(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, fsync=True)
+        q.clear()
+
+        with patch("salmon.queue.os.fsync", wraps=os.fsync) as fsync_mock:
+            key = q.push(BYTES_MESSAGE)
+
+        # once for the message, once for new/
+        self.assertEqual(fsync_mock.call_count, 2)
+        self.assertEqual(os.listdir("run/queue/tmp"), [])
+        self.assertEqual(q.keys(), [key])
+        self.assertEqual(q.get(key)['subject'], "bob!")
+
+    def test_fsync_error(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, fsync=True)
+        q.clear()
+
+        with patch("salmon.queue.os.fsync", side_effect=OSError):
+            with self.assertRaises(OSError):
+                q.push(BYTES_MESSAGE)
+
+        self.assertEqual(os.listdir("run/queue/tmp"), [])
+        self.assertEqual(len(q), 0)
+
+    def test_fsync_none(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, fsync="none")
+        with patch("salmon.queue.os.fsync") as fsync_mock:
+            key = q.push(BYTES_MESSAGE)
+
+        self.assertEqual(fsync_mock.call_count, 0)
+        self.assertEqual(q.keys(), [key])
+
+        with self.assertRaises(ValueError):
+            queue.Queue("run/queue", fsync="always")
+
+    def test_push_many(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES, fsync="message")
+
+        with patch("salmon.queue.os.fsync", wraps=os.fsync) as fsync_mock, \
+                patch("salmon.queue._syncfs", Mock(return_value=0)) as syncfs_mock:
+            keys = q.push_many([BYTES_MESSAGE, BYTES_MESSAGE.decode(), mail.MailResponse(Subject="bob!")])
+
+        # the messages are flushed together, and then new/
+        self.assertEqual(syncfs_mock.call_count, 1)
+        self.assertEqual(fsync_mock.call_count, 1)
+        self.assertEqual(sorted(q.keys()), sorted(keys))
+        self.assertEqual([q.get(key)["subject"] for key in keys], ["bob!"] * 3)
+        self.assertEqual(len(q), 3)
+        self.assertEqual(os.listdir("run/queue/tmp"), [])
+
+        high_keys = q.push_many([BYTES_MESSAGE] * 2, priority="high")
+        self.assertTrue(all(key.startswith("high/") for key in high_keys))
+        self.assertEqual(q.push_many([]), [])
+
+        # without syncfs each message is flushed
+        with patch("salmon.queue.os.fsync", wraps=os.fsync) as fsync_mock, patch("salmon.queue._syncfs", None):
+            q.push_many([BYTES_MESSAGE] * 3)
+        self.assertEqual(fsync_mock.call_count, 4)
+
+    @unittest.skipIf(queue._syncfs is None, "syncfs not available")
+    def test_syncfs(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, fsync="message")
+        q.clear()
+        keys = q.push_many([BYTES_MESSAGE] * 3)
+        self.assertEqual(sorted(q.keys()), sorted(keys))
+
+    def test_fsync_group(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, fsync="group", group_window=0.2)
+        barrier = threading.Barrier(5)
+        keys = []
+
+        def push():
+            barrier.wait()
+            keys.append(q.push(BYTES_MESSAGE))
+
+        with patch("salmon.queue.os.fsync", wraps=os.fsync) as fsync_mock, \
+                patch("salmon.queue._syncfs", Mock(return_value=0)) as syncfs_mock:
+            threads = [threading.Thread(target=push) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # the messages are flushed together by whichever thread commits them, and then new/
+        self.assertEqual(syncfs_mock.call_count, 1)
+        self.assertEqual(fsync_mock.call_count, 1)
+        self.assertEqual(sorted(q.keys()), sorted(keys))
+        self.assertEqual(len(keys), 5)
+
+    def test_fsync_group_error(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, fsync="group", group_window=0.2)
+        barrier = threading.Barrier(2)
+        errors = []
+
+        def push():
+            barrier.wait()
+            try:
+                q.push(BYTES_MESSAGE)
+            except OSError as exc:
+                errors.append(exc)
+
+        with patch("salmon.queue.os.rename", side_effect=OSError):
+            threads = [threading.Thread(target=push) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # every push in the group fails
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(os.listdir("run/queue/tmp"), [])
+        self.assertEqual(len(q), 0)
+
+    def test_compress(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, compress=True)
+        self.assertEqual(q.compress, "zlib")
+        message = BYTES_MESSAGE * 100
+
+        key = q.push(message)
+        with open(os.path.join("run/queue/new", key), "rb") as msg_file:
+            data = msg_file.read()
+        self.assertTrue(data.startswith(b"\0SQz"))
+        self.assertLess(len(data), len(message))
+        self.assertEqual(q.stats()["bytes"], len(data))
+
+        self.assertEqual(q.get(key, raw=True), message)
+        self.assertEqual(q.get(key)["subject"], "bob!")
+        self.assertEqual(q.pop(raw=True), (key, message))
+        self.assertEqual(q.stats()["bytes"], 0)
+
+        with self.assertRaises(ValueError):
+            queue.Queue("run/queue", compress="bz2")
+
+    def test_compress_mixed(self):
+        plain = queue.Queue("run/queue", safe=self.use_safe)
+        compressed = queue.Queue("run/queue", safe=self.use_safe, compress="lzma")
+        plain_key = plain.push(BYTES_MESSAGE)
+        compressed_key = compressed.push(BYTES_MESSAGE)
+
+        # either can read both
+        self.assertEqual(plain.get(compressed_key, raw=True), BYTES_MESSAGE)
+        self.assertEqual(compressed.get(plain_key, raw=True), BYTES_MESSAGE)
+        self.assertEqual(sorted(plain.pop_many(2)), sorted([(plain_key, BYTES_MESSAGE),
+                                                            (compressed_key, BYTES_MESSAGE)]))
+
+    def test_compress_oversize(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, pop_limit=200, oversize_dir="run/big_queue",
+                        compress="zlib")
+        # compresses to well under pop_limit, but isn't under it uncompressed
+        key = q.push("HELLO" * 100)
+        self.assertEqual(q.oversize(key), (True, os.path.join("run/queue/new", key)))
+        self.assertEqual(q.pop(), (None, None))
+        self.assertEqual(queue.Queue("run/big_queue").get(key, raw=True), b"HELLO" * 100)
+
+    def test_compress_corrupt(self):
+        big_queue = queue.Queue("run/big_queue")
+        big_queue.clear()
+        for compress in queue.COMPRESSION:
+            q = queue.Queue("run/queue", safe=self.use_safe, oversize_dir="run/big_queue", compress=compress)
+            corrupt = q.push(BYTES_MESSAGE * 100)
+            with open(os.path.join("run/queue/new", corrupt), "r+b") as msg_file:
+                msg_file.truncate(30)
+            q.push(BYTES_MESSAGE)
+
+            # moved out of the way rather than raising or being left claimed
+            (key, msg), = q.claim_many(5)
+            self.assertEqual(msg, BYTES_MESSAGE)
+            self.assertEqual(os.listdir(q.claimed_dir), [key])
+            q.ack(key)
+            self.assertEqual(q.stats(exact=True)["depth"], 0)
+            self.assertIn(corrupt, big_queue.keys())
+
+        # and deleted if there's nowhere to move it
+        q = queue.Queue("run/queue", safe=self.use_safe, compress="zlib")
+        key = q.push(BYTES_MESSAGE * 100)
+        with open(os.path.join("run/queue/new", key), "r+b") as msg_file:
+            msg_file.truncate(30)
+        self.assertEqual(q.pop(), (None, None))
+        self.assertEqual(len(q), 0)
+        big_queue.clear()
+
+    @unittest.skipIf(queue._libc is None, "inotify not available")
+    def test_wait(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.clear()
+
+        # the first call starts watching, and can't know if it missed anything
+        self.assertEqual(q.wait(0), True)
+        self.assertEqual(q.wait(0), False)
+        q.push(BYTES_MESSAGE)
+        self.assertEqual(q.wait(0), True)
+        self.assertEqual(q.wait(0), False)
+
+        threading.Timer(0.1, q.push, args=(BYTES_MESSAGE,)).start()
+        started = time.monotonic()
+        self.assertEqual(q.wait(5), True)
+        self.assertLess(time.monotonic() - started, 1)
+        q.close()
+
+    @patch("salmon.queue.time.sleep")
+    @patch("salmon.queue._libc", None)
+    def test_wait_polling(self, sleep_mock):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        self.assertEqual(q.wait(10), False)
+        self.assertEqual(q.wait(10), False)
+        self.assertEqual(sleep_mock.call_count, 2)
+        self.assertEqual(sleep_mock.call_args[0], (10,))
+
+    def test_clear(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES)
+        for i in range(4):
+            q.push(BYTES_MESSAGE)
+        q.push(BYTES_MESSAGE, priority="high")
+        claimed_key, msg = q.claim()
+
+        with patch("salmon.queue.Queue._read") as read_mock:
+            self.assertEqual(q.clear(), 4)
+        # nothing was read, let alone parsed
+        self.assertEqual(read_mock.call_count, 0)
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.pop(), (None, None))
+        # claimed messages are left alone
+        q.ack(claimed_key)
+
+    def test_clear_workers(self):
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        for i in range(50):
+            q.push(BYTES_MESSAGE)
+
+        self.assertEqual(q.clear(workers=4), 50)
+        self.assertEqual(queue.Queue("run/queue", exact_len=True).keys(), [])
+
+    def test_remove_many(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES)
+        keys = [q.push(BYTES_MESSAGE) for i in range(3)]
+        keys.append(q.push(BYTES_MESSAGE, priority="low"))
+        # moved to cur/, as a mail client would
+        os.rename(os.path.join("run/queue/new", keys[0]), os.path.join("run/queue/cur", keys[0] + ":2,S"))
+
+        self.assertEqual(q.remove_many(keys[:2] + keys[3:] + ["missing"]), 3)
+        self.assertEqual(q.keys(), [keys[2]])
+        self.assertEqual(len(q), 1)
+
+    def test_priorities(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES)
+        q.clear()
+
+        normal_key = q.push(BYTES_MESSAGE)
+        high_key = q.push(BYTES_MESSAGE, priority="high")
+        low_key = q.push(BYTES_MESSAGE, priority="low")
+        self.assertNotIn("/", normal_key)
+        self.assertTrue(high_key.startswith("high/"))
+        self.assertTrue(low_key.startswith("low/"))
+        self.assertEqual(os.listdir("run/queue/.high/new"), [high_key.split("/")[1]])
+        self.assertEqual(sorted(q.keys()), sorted([normal_key, high_key, low_key]))
+        self.assertEqual(len(q), 3)
+        self.assertEqual(q.get(high_key, raw=True), BYTES_MESSAGE)
+
+        with self.assertRaises(ValueError):
+            q.push(BYTES_MESSAGE, priority="urgent")
+
+        claimed = q.claim_many(3)
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(len(os.listdir("run/queue/.high/claimed")), 1)
+        for key, msg in claimed:
+            if key.startswith("high/"):
+                q.release(key)
+            else:
+                q.ack(key)
+        self.assertEqual(os.listdir("run/queue/.high/claimed"), [])
+        self.assertEqual(q.keys(), [high_key])
+
+        q.remove(high_key)
+        self.assertEqual(len(q), 0)
+
+    def test_priorities_order(self):
+        q = queue.Queue("run/queue", safe=self.use_safe, priorities=queue.PRIORITIES)
+
+        for i in range(20):
+            q.push(BYTES_MESSAGE)
+        high_keys = {q.push(BYTES_MESSAGE, priority="high") for i in range(5)}
+        low_key = q.push(BYTES_MESSAGE, priority="low")
+
+        popped = [key for key, msg in q.pop_many(26)]
+        # high gets 4 of every 7 messages, so jumps the backlog of normal, but
+        # low isn't starved either
+        lanes = [key.rpartition("/")[0] or "normal" for key in popped[:7]]
+        self.assertEqual(lanes, ["high", "normal", "high", "low", "high", "normal", "high"])
+        self.assertLessEqual(high_keys, set(popped[:8]))
+        self.assertIn(low_key, popped)
+        self.assertEqual(len(popped), 26)
+        self.assertEqual(q.pop(), (None, None))
+
+    def test_no_priorities(self):
+        # lanes are only used when asked for
+        q = queue.Queue("run/queue", safe=self.use_safe)
+        q.clear()
+        self.assertEqual(list(q.lanes), ["normal"])
+        self.assertFalse(os.path.exists("run/queue/.high"))
+
+        with self.assertRaises(ValueError):
+            q.push(BYTES_MESSAGE, priority="high")
+        with self.assertRaises(ValueError):
+            queue.Queue("run/queue", priorities={"high": 1})
+
+
+class ShardedQueueTestCase(SalmonTestCase):
+    def test_push(self):
+        q = queue.ShardedQueue("run/queue", shards=4)
+        keys = [q.push(BYTES_MESSAGE) for i in range(8)]
+
+        # spread evenly between the shards
+        self.assertEqual([key.split("/")[0] for key in keys], ["0", "1", "2", "3"] * 2)
+        for i in range(4):
+            self.assertEqual(len(os.listdir("run/queue/%d/new" % i)), 2)
+        self.assertEqual(len(q), 8)
+        self.assertEqual(sorted(q.keys()), sorted(keys))
+
+        self.assertEqual(q.get(keys[0])['subject'], "bob!")
+        self.assertEqual(q.get(keys[0], raw=True), BYTES_MESSAGE)
+        q.remove(keys[0])
+        self.assertEqual(len(q), 7)
+
+        q.clear()
+        self.assertEqual(len(q), 0)
+
+    def test_pop(self):
+        q = queue.ShardedQueue("run/queue", shards=4)
+        keys = {q.push(BYTES_MESSAGE) for i in range(6)}
+
+        key, msg = q.pop()
+        self.assertIn(key, keys)
+        self.assertEqual(msg['subject'], "bob!")
+
+        popped = q.pop_many(10)
+        self.assertEqual({key for key, msg in popped}, keys - {key})
+        self.assertEqual(q.pop(), (None, None))
+        self.assertEqual(q.pop_many(10), [])
+
+    def test_claim(self):
+        q = queue.ShardedQueue("run/queue", shards=2)
+        q.push(BYTES_MESSAGE)
+        q.push(BYTES_MESSAGE)
+
+        claimed = q.claim_many(2)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(q.claim(), (None, None))
+        q.ack(claimed[0][0])
+        q.release(claimed[1][0])
+        self.assertEqual(len(q), 1)
+
+        key, msg = q.claim(raw=True)
+        self.assertEqual(msg, BYTES_MESSAGE)
+        with patch("salmon.queue.time.time", return_value=time.time() + 61):
+            self.assertEqual(q.reap(60), 1)
+        self.assertEqual(len(q), 1)
+
+    def test_push_many(self):
+        q = queue.ShardedQueue("run/queue", shards=4, shard_key=queue.recipient_domain)
+        messages = [b"To: a@example.com\n\n1", b"To: b@example.org\n\n2", b"To: c@example.com\n\n3"]
+
+        keys = q.push_many(messages)
+        self.assertEqual([q.get(key, raw=True) for key in keys], messages)
+        self.assertEqual(keys[0].split("/")[0], keys[2].split("/")[0])
+
+    def test_remove_many(self):
+        q = queue.ShardedQueue("run/queue", shards=4)
+        keys = [q.push(BYTES_MESSAGE) for i in range(6)]
+
+        self.assertEqual(q.remove_many(keys[:5]), 5)
+        self.assertEqual(q.keys(), keys[5:])
+        self.assertEqual(q.clear(), 1)
+
+    def test_stats(self):
+        q = queue.ShardedQueue("run/queue", shards=4)
+        with patch("salmon.queue.time.time", return_value=1000):
+            for i in range(6):
+                q.push(BYTES_MESSAGE)
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            self.assertEqual(q.stats(), {"depth": 6, "bytes": 6 * len(BYTES_MESSAGE), "oldest_age": 10})
+
+    def test_shard_ids(self):
+        producer = queue.ShardedQueue("run/queue", shards=4)
+        evens = queue.ShardedQueue("run/queue", shards=4, shard_ids=[0, 2])
+        odds = queue.ShardedQueue("run/queue", shards=4, shard_ids=[1, 3])
+        for i in range(8):
+            producer.push(BYTES_MESSAGE)
+
+        self.assertEqual(len(evens), 4)
+        self.assertEqual({key.split("/")[0] for key, msg in evens.pop_many(10)}, {"0", "2"})
+        self.assertEqual({key.split("/")[0] for key, msg in odds.pop_many(10)}, {"1", "3"})
+
+        for shard_ids in ([], [4], [-1], ["1"]):
+            with self.assertRaises(ValueError):
+                queue.ShardedQueue("run/queue", shards=4, shard_ids=shard_ids)
+
+    def test_shard_key(self):
+        q = queue.ShardedQueue("run/queue", shards=8, shard_key=queue.recipient_domain)
+        keys = [
+            q.push(b"To: alice@example.com\n\nhi"),
+            q.push("To: Bob <bob@EXAMPLE.com>\n\nhi"),
+            q.push(mail.MailResponse(To="carol@example.com", From="me@localhost", Subject="hi", Body="hi")),
+        ]
+        self.assertEqual(len({key.split("/")[0] for key in keys}), 1)
+
+        self.assertEqual(queue.recipient_domain(b"To: alice@example.com\n\nhi"), "example.com")
+        self.assertEqual(queue.recipient_domain(b"Subject: no one\n\nhi"), "")
+
+        # files are put back so that they can still be pushed
+        message = io.BytesIO(b"To: alice@example.com\r\n\r\nTo: bob@example.org\n")
+        self.assertEqual(queue.recipient_domain(message), "example.com")
+        self.assertEqual(message.tell(), 0)
+
+    @unittest.skipIf(queue._libc is None, "inotify not available")
+    def test_wait(self):
+        producer = queue.ShardedQueue("run/queue", shards=2)
+        q = queue.ShardedQueue("run/queue", shards=2, shard_ids=[1])
+
+        self.assertEqual(q.wait(0), True)
+        self.assertEqual(q.wait(0), False)
+        # shard 0 isn't watched
+        producer.push(BYTES_MESSAGE)
+        self.assertEqual(q.wait(0), False)
+        producer.push(BYTES_MESSAGE)
+        self.assertEqual(q.wait(0), True)
+        q.close()
+
+
+class DeferredQueueTestCase(SalmonTestCase):
+    def test_push(self):
+        q = queue.DeferredQueue("run/deferred", resolution=10)
+
+        with patch("salmon.queue.time.time", return_value=1000):
+            soon = q.push(BYTES_MESSAGE)
+            later = q.push(BYTES_MESSAGE, delay=60)
+            self.assertEqual(soon.split("/")[0], "1010.0")
+            self.assertEqual(later.split("/")[0], "1070.0")
+            self.assertEqual(len(q), 2)
+            self.assertEqual(q.pop(), (None, None))
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            self.assertEqual(q.pop(raw=True), (soon, BYTES_MESSAGE))
+            self.assertEqual(q.pop(), (None, None))
+
+        with patch("salmon.queue.time.time", return_value=1100):
+            self.assertEqual(q.pop()[0], later)
+
+        # buckets are removed once they're empty and well past due
+        self.assertEqual(os.listdir("run/deferred"), [])
+
+    def test_retry(self):
+        q = queue.DeferredQueue("run/deferred", resolution=10, backoff=60, max_attempts=3)
+
+        with patch("salmon.queue.time.time", return_value=1000):
+            q.push(BYTES_MESSAGE)
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            key, msg = q.claim()
+            key = q.retry(key)
+            self.assertEqual(key.split("/")[0], "1080.1")
+            self.assertEqual(q.claim(), (None, None))
+
+        with patch("salmon.queue.time.time", return_value=1080):
+            key, msg = q.claim()
+            key = q.retry(key)
+            # the backoff doubles each time
+            self.assertEqual(key.split("/")[0], "1210.2")
+
+        with patch("salmon.queue.time.time", return_value=1210):
+            key, msg = q.claim()
+            with self.assertRaises(queue.QueueError) as cm:
+                q.retry(key)
+            self.assertEqual(cm.exception.data, BYTES_MESSAGE)
+
+        self.assertEqual(len(q), 0)
+
+    def test_remove_many(self):
+        q = queue.DeferredQueue("run/deferred")
+        keys = [q.push(BYTES_MESSAGE, delay=delay) for delay in (0, 60, 3600)]
+
+        self.assertEqual(q.remove_many(keys[1:]), 2)
+        self.assertEqual(q.keys(), keys[:1])
+        self.assertEqual(q.clear(), 1)
+        self.assertEqual(os.listdir("run/deferred"), [])
+
+    def test_stats(self):
+        q = queue.DeferredQueue("run/deferred")
+        self.assertEqual(q.stats(), {"depth": 0, "bytes": 0, "oldest_age": None})
+        with patch("salmon.queue.time.time", return_value=1000):
+            q.push(BYTES_MESSAGE)
+            q.push(BYTES_MESSAGE, delay=3600)
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            self.assertEqual(q.stats(), {"depth": 2, "bytes": 2 * len(BYTES_MESSAGE), "oldest_age": 10})
+
+    def test_release(self):
+        q = queue.DeferredQueue("run/deferred", resolution=10)
+        with patch("salmon.queue.time.time", return_value=1000):
+            q.push(BYTES_MESSAGE)
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            key, msg = q.claim()
+            q.release(key)
+            self.assertEqual(q.claim()[0].split("/")[0], "1010.0")
+
+    def test_wait(self):
+        q = queue.DeferredQueue("run/deferred", resolution=1)
+        self.assertEqual(q.wait(0.1), False)
+
+        q.push(BYTES_MESSAGE, delay=3600)
+        self.assertEqual(q.wait(0.1), False)
+
+        q.push(BYTES_MESSAGE)
+        started = time.monotonic()
+        self.assertEqual(q.wait(5), True)
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertIsNotNone(q.pop()[0])
+        q.close()
+
+
+class SQLiteQueueTestCase(SalmonTestCase):
+    def test_push(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3")
+        msg = mail.MailResponse(To="test@localhost", From="test@localhost", Subject="Test", Body="Test")
+
+        key = q.push(msg)
+        self.assertEqual(q.get(key)["subject"], "Test")
+        self.assertEqual(q.keys(), [key])
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.get("1000"), None)
+
+    def test_pop(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3")
+        keys = [q.push(BYTES_MESSAGE + str(i).encode()) for i in range(5)]
+
+        # first in, first out
+        self.assertEqual(q.pop(raw=True), (keys[0], BYTES_MESSAGE + b"0"))
+        self.assertEqual(q.pop()[1]["subject"], "bob!")
+        self.assertEqual([key for key, msg in q.pop_many(5)], keys[2:])
+        self.assertEqual(q.pop(), (None, None))
+        self.assertEqual(len(q), 0)
+
+    def test_claim(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3")
+        first = q.push(BYTES_MESSAGE)
+        second = q.push(BYTES_MESSAGE)
+
+        self.assertEqual(q.claim(raw=True), (first, BYTES_MESSAGE))
+        self.assertEqual(len(q), 1)
+        # another process can't get the same message
+        other = queue.SQLiteQueue("run/queue.sqlite3")
+        self.assertEqual(other.claim()[0], second)
+        self.assertEqual(q.claim(), (None, None))
+
+        q.ack(first)
+        other.release(second)
+        self.assertEqual(q.keys(), [second])
+        self.assertEqual(len(q), 1)
+
+        q.claim()
+        self.assertEqual(q.reap(60), 0)
+        with patch("salmon.queue.time.time", return_value=time.time() + 61):
+            self.assertEqual(q.reap(60), 1)
+        self.assertEqual(len(q), 1)
+
+    def test_push_many(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3", fsync="group")
+        keys = q.push_many([BYTES_MESSAGE, BYTES_MESSAGE.decode()])
+
+        self.assertEqual(q.keys(), keys)
+        self.assertEqual([msg for key, msg in q.pop_many(2)], [BYTES_MESSAGE, BYTES_MESSAGE])
+
+        with self.assertRaises(ValueError):
+            queue.SQLiteQueue("run/queue.sqlite3", fsync="always")
+
+    def test_remove(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3")
+        keys = [q.push(BYTES_MESSAGE) for i in range(5)]
+
+        q.remove(keys[0])
+        with self.assertRaises(KeyError):
+            q.remove(keys[0])
+        self.assertEqual(q.remove_many(keys[1:3] + ["1000"]), 2)
+        self.assertEqual(len(q), 2)
+
+        claimed_key, msg = q.claim()
+        self.assertEqual(q.clear(), 1)
+        self.assertEqual(len(q), 0)
+        q.ack(claimed_key)
+        self.assertEqual(q.keys(), [])
+
+    def test_stats(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3")
+        self.assertEqual(q.stats(), {"depth": 0, "bytes": 0, "oldest_age": None})
+        with patch("salmon.queue.time.time", return_value=1000):
+            q.push(BYTES_MESSAGE)
+        with patch("salmon.queue.time.time", return_value=1005):
+            q.push_many([BYTES_MESSAGE + b"!", BYTES_MESSAGE])
+
+        with patch("salmon.queue.time.time", return_value=1010):
+            self.assertEqual(q.stats(), {"depth": 3, "bytes": 3 * len(BYTES_MESSAGE) + 1, "oldest_age": 10})
+            key, msg = q.claim()
+            self.assertEqual(q.stats(), {"depth": 2, "bytes": 2 * len(BYTES_MESSAGE) + 1, "oldest_age": 5})
+            q.release(key)
+            self.assertEqual(q.stats()["oldest_age"], 10)
+            q.clear()
+            self.assertEqual(q.stats(), {"depth": 0, "bytes": 0, "oldest_age": None})
+
+    def test_oversize(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3", pop_limit=100, oversize_dir="run/big_queue")
+        big_key = q.push("HELLO" * 100)
+        key = q.push(BYTES_MESSAGE)
+
+        self.assertEqual(q.oversize(big_key), (True, None))
+        self.assertEqual(q.oversize(key), (False, None))
+        self.assertEqual(q.pop()[0], key)
+        self.assertEqual(len(q), 0)
+        self.assertEqual(queue.Queue("run/big_queue").count(), 1)
+
+    @patch("salmon.queue.time.sleep")
+    def test_wait(self, sleep_mock):
+        q = queue.SQLiteQueue("run/queue.sqlite3", poll_interval=1)
+        sleep_mock.side_effect = lambda seconds: q.push(BYTES_MESSAGE)
+        self.assertEqual(q.wait(10), True)
+        self.assertEqual(sleep_mock.call_count, 1)
+        self.assertEqual(q.wait(10), True)
+        self.assertEqual(sleep_mock.call_count, 1)
+        q.close()
+
+    def test_fork(self):
+        q = queue.SQLiteQueue("run/queue.sqlite3")
+        # nothing is opened until the queue is used
+        self.assertFalse(os.path.exists("run/queue.sqlite3"))
+        q.push(BYTES_MESSAGE)
+        db = q._db
+
+        # a forked child opens its own connection, and the parent keeps using its one
+        child = multiprocessing.get_context("fork").Process(target=q.push_many, args=([BYTES_MESSAGE] * 2,))
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+        self.assertEqual(len(q), 3)
+        self.assertIs(q._db, db)
+
+        with patch("salmon.queue.os.getpid", return_value=os.getpid() + 1):
+            q.pop()
+            self.assertIsNot(q._db, db)
+        q.close()
@@ -1,6 +1,6 @@
 from unittest.mock import Mock, patch
 
-from salmon import routing
+from salmon import queue, routing
 from salmon.mail import MailRequest
 from salmon.routing import MemoryStorage, Router, ShelveStorage, StateStorage, route
 
@@ -87,6 +87,19 @@ class RoutingTestCase(SalmonTestCase):
         Router.deliver(msg)
         self.assertEqual(Router.UNDELIVERABLE_QUEUE.push.call_count, 1)
 
+    def test_Router_undeliverable_sqlite_queue(self):
+        Router.clear_routes()
+        Router.clear_states()
+
+        Router.UNDELIVERABLE_QUEUE = queue.SQLiteQueue("run/undeliverable.sqlite3")
+        try:
+            msg = MailRequest('fakepeer', 'from@localhost', 'to@localhost', "Nothing")
+            Router.deliver(msg)
+            key, undelivered = Router.UNDELIVERABLE_QUEUE.pop()
+            self.assertEqual(undelivered.body(), "Nothing")
+        finally:
+            Router.UNDELIVERABLE_QUEUE = None
+
     def test_StateStorage_get_raises(self):
         s = StateStorage()
         with self.assertRaises(NotImplementedError):
@@ -1,6 +1,12 @@
 # Copyright (C) 2008 Zed A. Shaw.  Licensed under the terms of the GPLv3.
 from unittest.mock import Mock, call, patch
+import io
+import os
+import smtplib
 import socket
+import threading
+import time
+import unittest
 
 import lmtpd
 
@@ -19,6 +25,43 @@ def generate_mail(factory=mail.MailRequest, peer="localhost", From="from@localho
     return msg
 
 
+class DelayProxy:
+    """Forwards TCP connections to port, delaying everything sent in either direction"""
+    def __init__(self, port, delay):
+        self.target = port
+        self.delay = delay
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target))
+            threading.Thread(target=self.forward, args=(conn, upstream), daemon=True).start()
+            threading.Thread(target=self.forward, args=(upstream, conn), daemon=True).start()
+
+    def forward(self, src, dst):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                time.sleep(self.delay)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            src.close()
+            dst.close()
+
+    def close(self):
+        self.listener.close()
+
+
 class ServerTestCase(SalmonTestCase):
     def test_router(self):
         routing.Router.deliver(generate_mail())
@@ -185,6 +228,38 @@ class ServerTestCase(SalmonTestCase):
         relay.deliver(msg)
         self.assertEqual(client_mock.return_value.sendmail.call_count, 4)
 
+    @patch("salmon.server.smtplib.SMTP")
+    def test_relay_raw(self, client_mock):
+        relay_host = client_mock.return_value
+        relay_host.mail.return_value = relay_host.rcpt.return_value = relay_host.data.return_value = (250, b"OK")
+        relay = server.Relay("localhost", port=0)
+
+        # only the line endings are changed, smtplib does the dot stuffing
+        relay.deliver(generate_mail(Data=b"From: from@localhost\nTo: to@localhost\n\n.dot\r\nline\rend"))
+        self.assertEqual(relay_host.mail.call_args, call("from@localhost", []))
+        self.assertEqual(relay_host.data.call_args, call(b"From: from@localhost\r\nTo: to@localhost\r\n\r\n"
+                                                         b".dot\r\nline\r\nend"))
+        self.assertEqual(relay_host.sendmail.call_count, 0)
+
+        # 8-bit data has to be declared, and is converted to 7-bit if it can't be
+        msg = generate_mail(Data="From: from@localhost\nTo: to@localhost\n\nsnowman \u2603".encode())
+        relay.deliver(msg)
+        self.assertEqual(relay_host.mail.call_args, call("from@localhost", ["BODY=8BITMIME"]))
+        self.assertEqual(relay_host.has_extn.call_args, call("8bitmime"))
+        relay_host.has_extn.return_value = False
+        relay.deliver(msg)
+        self.assertEqual(relay_host.mail.call_count, 2)
+        self.assertEqual(relay_host.sendmail.call_args, call("from@localhost", "to@localhost", str(msg)))
+        self.assertTrue(str(msg).isascii())
+
+    @patch("salmon.server.smtplib.SMTP")
+    def test_relay_modified(self, client_mock):
+        relay = server.Relay("localhost", port=0)
+        msg = generate_mail(Data=b"Subject: hi\n\nbody")
+        msg["X-Modified"] = "yes"
+        relay.deliver(msg)
+        self.assertEqual(client_mock.return_value.sendmail.call_args, call("from@localhost", "to@localhost", str(msg)))
+
     @patch("salmon.server.smtplib.SMTP")
     def test_relay_smtp(self, client_mock):
         relay = server.Relay("localhost", port=0)
@@ -258,7 +333,7 @@ class ServerTestCase(SalmonTestCase):
     @patch('salmon.routing.Router')
     def test_queue_receiver(self, router_mock):
         receiver = server.QueueReceiver('run/queue')
-        run_queue = queue.Queue('run/queue')
+        run_queue = queue.Queue('run/queue', exact_len=True)
         run_queue.push(str(generate_mail(factory=mail.MailResponse)))
         assert run_queue.count() > 0
         receiver.start(one_shot=True)
@@ -269,43 +344,301 @@ class ServerTestCase(SalmonTestCase):
         router_mock.deliver.side_effect = RuntimeError("Raised on purpose")
         receiver.process_message(mail.MailRequest('localhost', 'test@localhost', 'test@localhost', 'Fake body.'))
 
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_envelope(self, router_mock):
+        data = server.pack_envelope(["127.0.0.1", 1234], "me@localhost", ["you@localhost"], b"Subject: hi\n\nbody")
+        self.assertEqual(server.unpack_envelope(data),
+                         (("127.0.0.1", 1234), "me@localhost", ["you@localhost"], b"Subject: hi\n\nbody"))
+        self.assertEqual(server.unpack_envelope(b"Subject: hi\n\nbody"), None)
+
+        # a message that's still in a file reads the same
+        envelope = server.pack_envelope(["127.0.0.1", 1234], "me@localhost", ["you@localhost"], b"")
+        envelope_file = server._EnvelopeFile(envelope, io.BytesIO(b"Subject: hi\n\nbody"))
+        self.assertEqual(envelope_file.read(), data)
+        envelope_file.seek(0)
+        self.assertEqual(envelope_file.readline(), envelope)
+        self.assertEqual(envelope_file.readline(), b"Subject: hi\n")
+        envelope_file.seek(5)
+        self.assertEqual(envelope_file.read(len(envelope)), data[5:len(envelope) + 5])
+        self.assertEqual(envelope_file.tell(), len(envelope) + 5)
+        self.assertEqual(list(iter(envelope_file.readline, b"")), [b"ct: hi\n", b"\n", b"body"])
+
+        # recipients are always a list, a str would be delivered a letter at a time
+        with self.assertRaises(ValueError):
+            server.pack_envelope("127.0.0.1", "me@localhost", "you@localhost", b"body")
+        with self.assertRaises(ValueError):
+            server.unpack_envelope(server.ENVELOPE_HEADER + b'{"peer": null, "from": null, "to": "you"}\nbody')
+        with self.assertRaises(TypeError):
+            server.QueueReceiver.deliver_envelope(None, "me@localhost", "you@localhost", b"body")
+
+        # envelopes are ignored unless the queue is known to be a spool
+        receiver = server.QueueReceiver('run/queue')
+        receiver.process_message(mail.MailRequest('run/queue', None, None, data))
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        self.assertEqual(router_mock.deliver.call_args[0][0].To, None)
+
     @patch('salmon.routing.Router')
     @patch("salmon.server.queue.Queue")
     def test_queue_receiver_pop_error(self, queue_mock, router_mock):
-        def key_error(*args, **kwargs):
-            queue_mock.return_value.__len__.return_value = 0
-            raise KeyError
-
-        queue_mock.return_value.__len__.return_value = 1
-        queue_mock.return_value.pop.side_effect = key_error
+        queue_mock.return_value.claim_many.return_value = []
         receiver = server.QueueReceiver('run/queue')
         receiver.start(one_shot=True)
-        self.assertEqual(queue_mock.return_value.pop.call_count, 1)
+        self.assertEqual(queue_mock.return_value.claim_many.call_count, 1)
         self.assertEqual(router_mock.deliver.call_count, 0)
-
-    @patch("salmon.server.time.sleep")
+        # the slot taken for the message that wasn't there was given back
+        self.assertEqual(receiver.slots._value, receiver.max_in_flight)
+
+    @patch("salmon.server.QueueReceiver.deliver")
+    def test_queue_receiver_batch(self, deliver_mock):
+        deliver_mock.side_effect = [None, RuntimeError("Raised on purpose"), None, None]
+        run_queue = queue.Queue('run/queue', exact_len=True)
+        for i in range(4):
+            run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        receiver = server.QueueReceiver('run/queue', workers=1, max_in_flight=4, batch_size=3)
+        with patch.object(receiver.queue, "claim_many", wraps=receiver.queue.claim_many) as claim_mock:
+            receiver.start(one_shot=True)
+
+        # the second batch is as big as the slots that were left
+        self.assertEqual([args[0][0] for args in claim_mock.call_args_list[:2]], [3, 1])
+        self.assertEqual(deliver_mock.call_count, 4)
+        self.assertEqual(type(deliver_mock.call_args[0][0]), mail.MailRequest)
+        self.assertEqual(receiver.metrics["delivered"], 3)
+        self.assertEqual(receiver.metrics["failed"], 1)
+        self.assertEqual(receiver.metrics["in_flight"], 0)
+        # the one that failed is left to be tried again later
+        self.assertEqual(len(run_queue), 0)
+        self.assertEqual(len(os.listdir(run_queue.claimed_dir)), 1)
+
+    @patch("salmon.server.queue.Queue.wait")
     @patch("salmon.server.Pool")
-    def test_queue_receiver_sleep(self, pool_mock, sleep_mock):
-        class SleepCalled(Exception):
+    def test_queue_receiver_sleep(self, pool_mock, wait_mock):
+        class WaitCalled(Exception):
             pass
 
-        def sleepy(*args, **kwargs):
-            if sleep_mock.call_count > 1:
-                raise SleepCalled()
+        def waity(*args, **kwargs):
+            if wait_mock.call_count > 1:
+                raise WaitCalled()
 
-        sleep_mock.side_effect = sleepy
+        wait_mock.side_effect = waity
 
         receiver = server.QueueReceiver('run/queue', sleep=10, workers=1)
-        with self.assertRaises(SleepCalled):
+        with self.assertRaises(WaitCalled):
             receiver.start()
 
         self.assertEqual(receiver.workers.apply_async.call_count, 0)
-        self.assertEqual(sleep_mock.call_count, 2)
-        self.assertEqual(sleep_mock.call_args_list, [call(receiver.sleep), call(receiver.sleep)])
+        self.assertEqual(wait_mock.call_count, 2)
+        self.assertEqual(wait_mock.call_args_list, [call(receiver.sleep), call(receiver.sleep)])
+
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_max_in_flight(self, router_mock):
+        run_queue = queue.Queue('run/queue', exact_len=True)
+        for i in range(5):
+            run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        blocker = threading.Event()
+        router_mock.deliver.side_effect = lambda msg: blocker.wait(5)
+
+        receiver = server.QueueReceiver('run/queue', workers=1, max_in_flight=2)
+        thread = threading.Thread(target=receiver.start, kwargs={"one_shot": True}, daemon=True)
+        thread.start()
+
+        time.sleep(0.3)
+        self.assertEqual(len(run_queue), 3)
+        self.assertEqual(receiver.metrics["in_flight"], 2)
+        self.assertEqual(receiver.metrics["saturated"], 1)
+
+        blocker.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(run_queue), 0)
+        self.assertEqual(router_mock.deliver.call_count, 5)
+        self.assertEqual(receiver.metrics["in_flight"], 0)
+        self.assertEqual(receiver.metrics["delivered"], 5)
+        self.assertGreater(receiver.metrics["blocked"], 0.2)
+
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_lease(self, router_mock):
+        run_queue = queue.Queue('run/queue', exact_len=True)
+        run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+        # claimed by a receiver that then died
+        key, msg = run_queue.claim()
+        run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        receiver = server.QueueReceiver('run/queue', lease_timeout=60)
+        receiver.start(one_shot=True)
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        self.assertEqual(os.listdir(run_queue.claimed_dir), [key])
+
+        # once the lease expires it's delivered by whoever reaps it
+        with patch("salmon.queue.time.time", return_value=time.time() + 61):
+            receiver = server.QueueReceiver('run/queue', lease_timeout=60)
+            receiver.start(one_shot=True)
+        self.assertEqual(router_mock.deliver.call_count, 2)
+        self.assertEqual(os.listdir(run_queue.claimed_dir), [])
+        self.assertEqual(len(run_queue), 0)
+
+    @patch('salmon.server.unpack_envelope')
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_failed(self, router_mock, unpack_mock):
+        unpack_mock.side_effect = RuntimeError("Raised on purpose")
+        run_queue = queue.Queue('run/queue', exact_len=True)
+        run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        receiver = server.QueueReceiver('run/queue', envelope=True)
+        receiver.start(one_shot=True)
+
+        # the message is left claimed, to be tried again later
+        self.assertEqual(router_mock.deliver.call_count, 0)
+        self.assertEqual(receiver.metrics["failed"], 1)
+        self.assertEqual(receiver.metrics["in_flight"], 0)
+        self.assertEqual(len(os.listdir(run_queue.claimed_dir)), 1)
+
+    @patch('salmon.server.undeliverable_message')
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_deferred(self, router_mock, undeliverable_mock):
+        router_mock.deliver.side_effect = server.SMTPError(451)
+        run_queue = queue.DeferredQueue('run/queue')
+        with patch("salmon.queue.time.time", return_value=time.time() - 100):
+            run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        receiver = server.QueueReceiver('run/queue', deferred=True, max_attempts=2)
+        receiver.start(one_shot=True)
+
+        # tried again later rather than given up on
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        self.assertEqual(receiver.metrics["deferred"], 1)
+        self.assertEqual(undeliverable_mock.call_count, 0)
+        key, = run_queue.keys()
+        self.assertTrue(key.split("/")[0].endswith(".1"))
+
+        with patch("salmon.queue.time.time", return_value=time.time() + 120):
+            receiver.start(one_shot=True)
+
+        self.assertEqual(router_mock.deliver.call_count, 2)
+        self.assertEqual(receiver.metrics["deferred"], 2)
+        self.assertEqual(undeliverable_mock.call_count, 1)
+        self.assertEqual(len(run_queue), 0)
+
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_deferred_envelope(self, router_mock):
+        def deliver(msg):
+            if msg.To == "b@localhost" and router_mock.deliver.call_count < 3:
+                raise server.SMTPError(451)
+        router_mock.deliver.side_effect = deliver
+        run_queue = queue.DeferredQueue('run/queue')
+        with patch("salmon.queue.time.time", return_value=time.time() - 100):
+            run_queue.push(server.pack_envelope(None, "from@localhost", ["a@localhost", "b@localhost", "c@localhost"],
+                                                str(generate_mail(factory=mail.MailResponse)).encode()))
+
+        receiver = server.QueueReceiver('run/queue', envelope=True, deferred=True)
+        receiver.start(one_shot=True)
+        self.assertEqual(receiver.metrics["deferred"], 1)
+        key, = run_queue.keys()
+        self.assertTrue(key.split("/")[0].endswith(".1"))
+
+        with patch("salmon.queue.time.time", return_value=time.time() + 120):
+            receiver.start(one_shot=True)
+
+        # a@localhost isn't sent it a second time
+        delivered = [args[0][0].To for args in router_mock.deliver.call_args_list]
+        self.assertEqual(delivered, ["a@localhost", "b@localhost", "b@localhost", "c@localhost"])
+        self.assertEqual(receiver.metrics["deferred"], 1)
+        self.assertEqual(len(run_queue), 0)
+
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_sqlite(self, router_mock):
+        run_queue = queue.SQLiteQueue('run/queue.sqlite3')
+        for i in range(3):
+            run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        receiver = server.QueueReceiver(run_queue, batch_size=2)
+        receiver.start(one_shot=True)
+
+        self.assertEqual(router_mock.deliver.call_count, 3)
+        self.assertEqual(receiver.metrics["delivered"], 3)
+        self.assertEqual(len(run_queue), 0)
+        self.assertEqual(run_queue.keys(), [])
+
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_priorities(self, router_mock):
+        run_queue = queue.Queue('run/queue', exact_len=True, priorities=queue.PRIORITIES)
+        for i in range(10):
+            run_queue.push(str(mail.MailResponse(To="to@localhost", From="from@localhost", Subject="normal")))
+        for i in range(2):
+            run_queue.push(str(mail.MailResponse(To="to@localhost", From="from@localhost", Subject="high")),
+                           priority="high")
+
+        receiver = server.QueueReceiver('run/queue', workers=1, max_in_flight=1, priorities=queue.PRIORITIES)
+        receiver.start(one_shot=True)
+
+        delivered = [args[0][0]["Subject"] for args in router_mock.deliver.call_args_list]
+        self.assertEqual(len(delivered), 12)
+        self.assertEqual(delivered[:4].count("high"), 2)
+        self.assertEqual(len(run_queue), 0)
+
+    @patch('salmon.server.routing.Router')
+    def test_queue_receiver_shards(self, router_mock):
+        run_queue = queue.ShardedQueue('run/queue', shards=4)
+        for i in range(8):
+            run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+
+        receiver = server.QueueReceiver('run/queue', shards=4, shard_ids=[0, 1])
+        receiver.start(one_shot=True)
+        self.assertEqual(router_mock.deliver.call_count, 4)
+        self.assertEqual(len(queue.ShardedQueue('run/queue', shards=4, shard_ids=[0, 1])), 0)
+        self.assertEqual(len(queue.ShardedQueue('run/queue', shards=4, shard_ids=[2, 3])), 4)
+
+        receiver = server.QueueReceiver('run/queue', shards=4, shard_ids=[2, 3])
+        receiver.start(one_shot=True)
+        self.assertEqual(router_mock.deliver.call_count, 8)
+
+    def test_queue_receiver_process_mode(self):
+        run_queue = queue.Queue('run/queue', exact_len=True)
+        run_queue.push(str(generate_mail(factory=mail.MailResponse)))
+        run_queue.push(server.pack_envelope(["127.0.0.1", 1234], "me@localhost",
+                                            ["you@localhost", "them@localhost"], b"Subject: hi\n\nbody"))
+
+        # workers are separate processes, so they report back via another queue
+        delivered = queue.Queue('run/delivered')
+        with patch("salmon.server.routing.Router.deliver", lambda msg: delivered.push(repr(msg.To))):
+            receiver = server.QueueReceiver('run/queue', workers=2, envelope=True, mode="process")
+            receiver.start(one_shot=True)
+
+        self.assertEqual(len(run_queue), 0)
+        self.assertEqual(receiver.metrics["delivered"], 2)
+        self.assertEqual(sorted(delivered.get(key, raw=True) for key in delivered.keys()),
+                         [b"'localhost'", b"'them@localhost'", b"'you@localhost'"])
+
+        with self.assertRaises(ValueError):
+            server.QueueReceiver('run/queue', mode="fibre")
+
+    @unittest.skipIf(queue._libc is None, "inotify not available")
+    @patch("salmon.server.Pool")
+    def test_queue_receiver_wakeup(self, pool_mock):
+        pool_mock.return_value.apply_async.side_effect = lambda func, args, callback, error_callback: callback(None)
+        receiver = server.QueueReceiver('run/queue', sleep=10, workers=1)
+        thread = threading.Thread(target=receiver.start, daemon=True)
+        thread.start()
+
+        # let the receiver find the queue empty
+        time.sleep(0.2)
+        started = time.monotonic()
+        queue.Queue('run/queue').push(str(generate_mail(factory=mail.MailResponse)))
+        while not pool_mock.return_value.apply_async.called and time.monotonic() - started < 5:
+            time.sleep(0.01)
+        self.assertEqual(pool_mock.return_value.apply_async.call_count, 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+        # stop the receiver the next time it runs out of messages
+        receiver.queue.wait = Mock(side_effect=SystemExit)
+        queue.Queue('run/queue').push(str(generate_mail(factory=mail.MailResponse)))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
 
     @patch("salmon.server.Pool")
     def test_queue_receiver_pool(self, pool_mock):
-        run_queue = queue.Queue('run/queue')
+        run_queue = queue.Queue('run/queue', exact_len=True)
         msg = str(generate_mail(factory=mail.MailResponse))
         run_queue.push(msg)
 
@@ -313,17 +646,26 @@ class ServerTestCase(SalmonTestCase):
         receiver.start(one_shot=True)
 
         self.assertEqual(receiver.workers.apply_async.call_count, 1)
-        self.assertEqual(receiver.workers.apply_async.call_args[0], (receiver.process_message,))
+        self.assertEqual(receiver.workers.apply_async.call_args[0], (receiver.process_batch,))
+
+        kwargs = receiver.workers.apply_async.call_args[1]
+        args = kwargs.pop("args")
+        callback = kwargs.pop("callback")
+        error_callback = kwargs.pop("error_callback")
 
-        args = receiver.workers.apply_async.call_args[1]["args"]
-        del receiver.workers.apply_async.call_args[1]["args"]
+        # only "args" and the callbacks should be present
+        self.assertEqual(kwargs, {})
+        self.assertEqual(callback.func, receiver.finished)
+        self.assertEqual(error_callback.func, receiver.failed)
 
-        # onlly the "args" kwarg should be present
-        self.assertEqual(receiver.workers.apply_async.call_args[1], {})
+        # the message stays claimed until the worker is done with it
+        self.assertEqual(len(run_queue), 0)
+        self.assertEqual(len(os.listdir(run_queue.claimed_dir)), 1)
+        callback([])
+        self.assertEqual(os.listdir(run_queue.claimed_dir), [])
 
-        # we can't compare two Mail* objects, so we'll just check the type
-        self.assertEqual(len(args), 1)
-        self.assertEqual(type(args[0]), mail.MailRequest)
+        # workers are sent the message as it was stored
+        self.assertEqual(args, ("run/queue", [msg.encode()], False, False))
 
     @patch('threading.Thread', new=Mock())
     @patch('salmon.routing.Router', new=Mock())
@@ -353,3 +695,673 @@ class ServerTestCase(SalmonTestCase):
 
         err = server.SMTPError(999, "Bogus Error Code")
         self.assertEqual(str(err), "999 Bogus Error Code")
+
+
+class DataSpoolTestCase(SalmonTestCase):
+    def spool(self, pieces, **kwargs):
+        spool = server.DataSpool(1024, **kwargs)
+        self.addCleanup(spool.close)
+        for piece in pieces:
+            spool.write(piece)
+        spool.finish()
+        return spool
+
+    def test_line_endings(self):
+        spool = self.spool([b"Subject: hi\r", b"\n\r\n.dot\r\n..two", b"\r\n", b""])
+        self.assertEqual(spool.file.read(), b"Subject: hi\n\n.dot\n..two")
+
+    def test_unstuff(self):
+        spool = self.spool([b".first\r\n", b"..second\r", b"\n.", b"third\r\n"], unstuff=True)
+        self.assertEqual(spool.file.read(), b"first\n.second\nthird")
+
+        spool = self.spool([b"\r\n"], unstuff=True)
+        self.assertEqual(spool.file.read(), b"")
+
+    def test_rollover(self):
+        spool = self.spool([b"a" * 1000])
+        self.assertFalse(spool.file._rolled)
+        spool = self.spool([b"a" * 1000, b"b" * 1000])
+        self.assertTrue(spool.file._rolled)
+        self.assertEqual(spool.file.read(), b"a" * 1000 + b"b" * 1000)
+
+    def test_oversize(self):
+        spool = self.spool([b"a" * 10, b"b" * 10], size_limit=15)
+        self.assertTrue(spool.oversize)
+        self.assertEqual(spool.size, 20)
+        self.assertEqual(spool.file.read(), b"a" * 10)
+
+        spool = self.spool([b"a" * 10, b"b" * 10], size_limit=15, keep_oversize=True)
+        self.assertTrue(spool.oversize)
+        self.assertTrue(spool.file._rolled)
+        self.assertEqual(spool.file.read(), b"a" * 10 + b"b" * 10)
+
+
+class RateLimiterTestCase(SalmonTestCase):
+    @patch("salmon.server.time.monotonic")
+    def test_allow(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        limiter = server.RateLimiter(60, burst=2)
+        self.assertEqual([limiter.allow("a") for i in range(3)], [True, True, False])
+        self.assertTrue(limiter.allow("b"))
+
+        # one token a second
+        monotonic_mock.return_value = 101
+        self.assertEqual([limiter.allow("a") for i in range(2)], [True, False])
+
+    @patch("salmon.server.time.monotonic")
+    def test_prune(self, monotonic_mock):
+        monotonic_mock.return_value = 100
+        limiter = server.RateLimiter(60, max_buckets=2)
+        limiter.allow("a")
+        limiter.allow("b")
+        monotonic_mock.return_value = 200
+        limiter.allow("c")
+        self.assertEqual(list(limiter.buckets), ["c"])
+
+
+class AsyncSMTPReceiverTestCase(SalmonTestCase):
+    receiver_class = server.AsyncSMTPReceiver
+
+    def setUp(self):
+        super().setUp()
+        self.receiver = self.receiver_class(host="127.0.0.1", port=0)
+        self.receiver.start()
+        self.addCleanup(self.receiver.stop)
+
+    def client(self):
+        client = smtplib.SMTP("127.0.0.1", self.receiver.port)
+        self.addCleanup(client.close)
+        return client
+
+    @patch("salmon.server.routing.Router")
+    def test_deliver(self, router_mock):
+        client = self.client()
+        client.sendmail("me@example.com", "you@example.com", "Subject: hello\r\n\r\n.dotted\r\nbody")
+        client.quit()
+
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        msg = router_mock.deliver.call_args[0][0]
+        self.assertEqual(msg.From, "me@example.com")
+        self.assertEqual(msg.To, "you@example.com")
+        self.assertEqual(msg.Data, b"Subject: hello\n\n.dotted\nbody")
+        self.assertEqual(msg.Peer[0], "127.0.0.1")
+
+    @patch("salmon.server.routing.Router")
+    def test_multiple_rcpt(self, router_mock):
+        client = self.client()
+        client.ehlo()
+        self.assertEqual(client.mail("me@example.com")[0], 250)
+        self.assertEqual(client.rcpt("you@example.com")[0], 250)
+        self.assertEqual(client.rcpt("them@example.com"),
+                         (451, b"Will not accept multiple recipients in one transaction"))
+        self.assertEqual(client.data(b"hello")[0], 250)
+        self.assertEqual(router_mock.deliver.call_count, 1)
+
+    def restart(self, **kwargs):
+        self.receiver.stop()
+        self.receiver = self.receiver_class(host="127.0.0.1", port=0, **kwargs)
+        self.receiver.start()
+        self.addCleanup(self.receiver.stop)
+
+    @patch("salmon.server.routing.Router")
+    def test_large_message(self, router_mock):
+        self.restart(memory_threshold=1024)
+        body = ("." + "a" * 99 + "\r\n") * 1000
+        client = self.client()
+        client.sendmail("me@example.com", "you@example.com", "Subject: big\r\n\r\n" + body)
+        msg = router_mock.deliver.call_args[0][0]
+        self.assertEqual(msg.Data, b"Subject: big\n\n" + (b"." + b"a" * 99 + b"\n") * 999 + b"." + b"a" * 99)
+
+    @patch("salmon.server.routing.Router")
+    def test_relay_unmodified(self, router_mock):
+        data = b"From: me@example.com\nTo: you@example.com\nSubject: hi\n\n.dotted\nbody\n"
+        msg = mail.MailRequest("localhost", None, None, data)
+        self.assertEqual(msg["subject"], "hi")
+        relay = server.Relay("127.0.0.1", port=self.receiver.port)
+
+        with patch("salmon.server.smtplib.SMTP.sendmail") as sendmail_mock:
+            relay.deliver(msg)
+        self.assertEqual(sendmail_mock.call_count, 0)
+        # the receiver undoes the dot stuffing and CRLFs
+        self.assertEqual(router_mock.deliver.call_args[0][0].Data, data[:-1])
+
+        # declared as 8BITMIME, which the receiver supports
+        data = "From: me@example.com\nTo: you@example.com\nSubject: hi\n\nsnowman \u2603".encode()
+        with patch("salmon.server.smtplib.SMTP.sendmail") as sendmail_mock:
+            relay.deliver(mail.MailRequest("localhost", None, None, data))
+        self.assertEqual(sendmail_mock.call_count, 0)
+        self.assertEqual(router_mock.deliver.call_args[0][0].Data, data)
+
+    @patch("salmon.server.routing.Router")
+    def test_relay_recipients(self, router_mock):
+        relay = server.Relay("127.0.0.1", port=self.receiver.port)
+        relay_host = relay.configure_relay("127.0.0.1")
+        data = b"Subject: hi\n\nbody"
+
+        # the receiver only takes one recipient at a time
+        refused = relay._send_raw(relay_host, "me@example.com", ["you@example.com", "them@example.com"], data)
+        self.assertEqual(refused, {
+            "them@example.com": (451, b"Will not accept multiple recipients in one transaction"),
+        })
+        self.assertEqual(router_mock.deliver.call_args[0][0].To, "you@example.com")
+
+        # the transaction is reset after a refusal, so the connection can carry on being used
+        with patch.object(relay_host, "rcpt", return_value=(550, b"No such user")), \
+                patch.object(relay_host, "rset", wraps=relay_host.rset) as rset_mock:
+            with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                relay._send_raw(relay_host, "me@example.com", "you@example.com", data)
+        self.assertEqual(rset_mock.call_count, 1)
+        self.assertEqual(relay._send_raw(relay_host, "me@example.com", "them@example.com", data), {})
+        self.assertEqual(router_mock.deliver.call_count, 2)
+        relay_host.quit()
+
+    @patch("salmon.server.routing.Router")
+    def test_size_limit(self, router_mock):
+        self.restart(size_limit=100)
+        client = self.client()
+        client.ehlo()
+        self.assertEqual(client.esmtp_features["size"], "100")
+        self.assertEqual(client.mail("me@example.com", ["SIZE=101"]),
+                         (552, b"Error: message size exceeds fixed maximum message size"))
+        self.assertEqual(client.mail("me@example.com", ["SIZE=big"])[0], 501)
+
+        # clients don't have to send SIZE
+        self.assertEqual(client.mail("me@example.com")[0], 250)
+        client.rcpt("you@example.com")
+        self.assertEqual(client.data(b"a" * 101),
+                         (552, b"Error: message size exceeds fixed maximum message size"))
+        client.mail("me@example.com")
+        client.rcpt("you@example.com")
+        client.send(b"BDAT 60\r\n" + b"a" * 60 + b"BDAT 60 LAST\r\n" + b"a" * 60)
+        self.assertEqual(client.getreply(), (250, b"60 octets received"))
+        self.assertEqual(client.getreply(), (552, b"Error: message size exceeds fixed maximum message size"))
+        self.assertEqual(router_mock.deliver.call_count, 0)
+
+        client.sendmail("me@example.com", "you@example.com", b"a" * 100)
+        self.assertEqual(router_mock.deliver.call_count, 1)
+
+    @patch("salmon.server.routing.Router")
+    def test_oversize_dir(self, router_mock):
+        self.restart(size_limit=100, oversize_dir="run/oversize")
+        client = self.client()
+        client.ehlo()
+        client.mail("me@example.com")
+        client.rcpt("you@example.com")
+        self.assertEqual(client.data(b"Subject: big\r\n\r\n" + b"a" * 100), (250, b"OK"))
+        self.assertEqual(router_mock.deliver.call_count, 0)
+
+        oversize = queue.Queue("run/oversize")
+        self.assertEqual(len(oversize), 1)
+        key, msg = oversize.pop()
+        self.assertEqual(msg["subject"], "big")
+        self.assertEqual(msg.body(), "a" * 100)
+
+    def test_max_connections(self):
+        self.restart(max_connections=1)
+        client = self.client()
+        self.assertEqual(client.noop()[0], 250)
+        with self.assertRaises(smtplib.SMTPConnectError) as cm:
+            self.client()
+        self.assertEqual(cm.exception.smtp_code, 421)
+        self.assertEqual(self.receiver.metrics["connections_refused"], 1)
+        self.assertEqual(self.receiver.metrics["connections"], 1)
+
+    def test_max_peer_connections(self):
+        self.restart(max_peer_connections=2)
+        clients = [self.client(), self.client()]
+        with self.assertRaises(smtplib.SMTPConnectError) as cm:
+            self.client()
+        self.assertEqual(cm.exception.smtp_code, 421)
+        self.assertEqual(self.receiver.metrics["peer_connections_refused"], 1)
+
+        # closing a connection makes room for another
+        clients[0].quit()
+        for i in range(100):
+            if self.receiver.metrics["connections"] == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.client().noop()[0], 250)
+        self.assertEqual(self.receiver.peer_connections, {"127.0.0.1": 2})
+
+    def test_rate_limit(self):
+        self.restart(rate_limit=2)
+        client = self.client()
+        client.ehlo()
+        for i in range(2):
+            self.assertEqual(client.mail("me@example.com")[0], 250)
+            client.rset()
+        self.assertEqual(client.mail("me@example.com"), (451, b"Too many messages, slow down"))
+        self.assertEqual(self.receiver.metrics["rate_limited"], 1)
+
+        # the limit is per peer, not per connection
+        self.assertEqual(self.client().docmd("HELO", "localhost")[0], 250)
+        self.assertEqual(self.receiver.metrics["rate_limited"], 1)
+
+    def test_idle_timeout(self):
+        self.restart(idle_timeout=0.1)
+        client = self.client()
+        self.assertEqual(client.noop()[0], 250)
+        time.sleep(0.3)
+        self.assertEqual(client.getreply()[0], 421)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            client.noop()
+        self.assertEqual(self.receiver.metrics["timed_out"], 1)
+
+    @patch("salmon.server.routing.Router")
+    def test_graceful_stop(self, router_mock):
+        idle = self.client()
+        busy = self.client()
+        busy.ehlo()
+        busy.mail("me@example.com")
+        busy.rcpt("you@example.com")
+
+        stopper = threading.Thread(target=self.receiver.stop, args=(10,))
+        stopper.start()
+
+        # idle sessions are closed straight away
+        self.assertEqual(idle.getreply()[0], 421)
+
+        # sessions in a transaction get to finish it
+        self.assertEqual(busy.data(b"hello")[0], 250)
+        self.assertEqual(busy.getreply()[0], 421)
+        stopper.join()
+        self.assertEqual(router_mock.deliver.call_count, 1)
+
+        # no new connections are accepted
+        with self.assertRaises(OSError):
+            self.client()
+
+    def test_graceful_stop_timeout(self):
+        busy = self.client()
+        busy.ehlo()
+        busy.mail("me@example.com")
+
+        start = time.monotonic()
+        self.receiver.stop(0.2)
+        self.assertLess(time.monotonic() - start, 5)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            busy.rcpt("you@example.com")
+
+    def test_inherited_socket(self):
+        sock = socket.create_server(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        with patch("salmon.server._inherited_sockets", [sock]):
+            receiver = self.receiver_class(host="127.0.0.1", port=port)
+            self.addCleanup(receiver.stop)
+            self.assertIs(receiver.sock, sock)
+            self.assertEqual(server.inherited_sockets(), [])
+
+            # anything else is bound as normal
+            other = self.receiver_class(host="127.0.0.1", port=0)
+            self.addCleanup(other.stop)
+            self.assertIsNot(other.sock, sock)
+
+    @patch.dict(os.environ, {"LISTEN_FDS": "1"})
+    @patch("salmon.server._inherited_sockets", None)
+    def test_inherited_sockets_env(self):
+        # not for us
+        os.environ["LISTEN_PID"] = "1"
+        self.assertEqual(server.inherited_sockets(), [])
+        self.assertNotIn("LISTEN_FDS", os.environ)
+
+        sock = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(sock.close)
+        with patch("salmon.server.LISTEN_FDS_START", sock.fileno()), \
+                patch("salmon.server._inherited_sockets", None), \
+                patch.dict(os.environ, {"LISTEN_FDS": "1", "LISTEN_PID": str(os.getpid())}):
+            inherited = server.inherited_sockets()
+            self.assertEqual(len(inherited), 1)
+            self.assertEqual(inherited[0].getsockname(), sock.getsockname())
+            inherited[0].detach()
+
+    @patch("salmon.server.routing.Router")
+    def test_spool(self, router_mock):
+        self.receiver.stop()
+        self.receiver = self.receiver_class(host="127.0.0.1", port=0, spool="run/spool")
+        self.assertEqual(self.receiver.spool.fsync, "group")
+        self.receiver.start()
+        self.addCleanup(self.receiver.stop)
+
+        client = self.client()
+        client.ehlo()
+        self.assertEqual(client.mail("me@example.com")[0], 250)
+        self.assertEqual(client.rcpt("you@example.com")[0], 250)
+        self.assertEqual(client.rcpt("them@example.com")[0], 250)
+        with patch.object(self.receiver.spool, "push", wraps=self.receiver.spool.push) as push:
+            self.assertEqual(client.data(b"Subject: hello\r\n\r\nbody")[0], 250)
+        client.quit()
+
+        # pushed straight from the file it was received into
+        self.assertTrue(hasattr(push.call_args[0][0], "read"))
+
+        # spooled once, nothing delivered yet
+        self.assertEqual(router_mock.deliver.call_count, 0)
+        self.assertEqual(len(queue.Queue("run/spool")), 1)
+
+        receiver = server.QueueReceiver("run/spool", envelope=True)
+        receiver.start(one_shot=True)
+        self.assertEqual(len(queue.Queue("run/spool")), 0)
+
+        delivered = [args[0][0] for args in router_mock.deliver.call_args_list]
+        self.assertEqual([msg.To for msg in delivered], ["you@example.com", "them@example.com"])
+        for msg in delivered:
+            self.assertEqual(msg.From, "me@example.com")
+            self.assertEqual(msg.Peer[0], "127.0.0.1")
+            self.assertEqual(msg.Data, b"Subject: hello\n\nbody")
+            self.assertEqual(msg["X-Salmon-Envelope"], None)
+
+    @patch("salmon.server.routing.Router")
+    def test_spool_error(self, router_mock):
+        spool = Mock()
+        spool.push.side_effect = OSError
+        self.receiver.stop()
+        self.receiver = self.receiver_class(host="127.0.0.1", port=0, spool=spool)
+        self.receiver.start()
+        self.addCleanup(self.receiver.stop)
+
+        client = self.client()
+        with self.assertRaises(smtplib.SMTPDataError) as cm:
+            client.sendmail("me@example.com", ["you@example.com", "them@example.com"], "hello")
+        self.assertEqual(cm.exception.smtp_code, 451)
+        self.assertEqual(router_mock.deliver.call_count, 0)
+
+    @patch("salmon.server.routing.Router")
+    def test_smtp_error(self, router_mock):
+        router_mock.deliver.side_effect = server.SMTPError(550, "Not found")
+        client = self.client()
+        with self.assertRaises(smtplib.SMTPDataError) as cm:
+            client.sendmail("me@example.com", "you@example.com", "hello")
+        self.assertEqual(cm.exception.smtp_code, 550)
+        self.assertEqual(cm.exception.smtp_error, b"Not found")
+
+    @patch("salmon.server.routing.Router")
+    def test_slow_delivery(self, router_mock):
+        self.receiver.stop()
+        self.receiver = self.receiver_class(host="127.0.0.1", port=0, workers=1, max_in_flight=1)
+        self.receiver.start()
+        self.addCleanup(self.receiver.stop)
+
+        release = threading.Event()
+        router_mock.deliver.side_effect = lambda msg: release.wait(10)
+
+        slow_client = self.client()
+        slow_client.ehlo()
+        slow_client.mail("me@example.com")
+        slow_client.rcpt("you@example.com")
+        slow_client.send(b"DATA\r\n")
+        self.assertEqual(slow_client.getreply()[0], 354)
+        slow_client.send(b"hello\r\n.\r\n")
+
+        # other sessions carry on while the handler is running, but the pool is full
+        client = self.client()
+        client.ehlo()
+        client.mail("me@example.com")
+        client.rcpt("you@example.com")
+        for i in range(50):
+            if self.receiver.pool.metrics["in_flight"]:
+                break
+            time.sleep(0.01)
+        self.assertEqual(client.docmd("DATA"), (451, b"Too busy to deliver mail, try again later"))
+        self.assertEqual(self.receiver.pool.metrics["saturated"], 1)
+
+        release.set()
+        self.assertEqual(slow_client.getreply(), (250, b"OK"))
+        self.assertEqual(client.data(b"hello"), (250, b"OK"))
+
+        metrics = self.receiver.pool.metrics
+        self.assertEqual(metrics["delivered"], 2)
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertGreaterEqual(metrics["queue_wait"], 0)
+        self.assertGreaterEqual(metrics["queue_wait_max"], 0)
+
+    @patch("salmon.server.routing.Router")
+    def test_no_workers(self, router_mock):
+        self.receiver.stop()
+        self.receiver = self.receiver_class(host="127.0.0.1", port=0, workers=0)
+        self.receiver.start()
+        self.addCleanup(self.receiver.stop)
+
+        self.client().sendmail("me@example.com", "you@example.com", "hello")
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        self.assertIsNone(self.receiver.pool)
+
+    def test_command_errors(self):
+        client = self.client()
+        self.assertEqual(client.docmd("MAIL FROM:<me@example.com>"), (503, b"Error: send HELO first"))
+        self.assertEqual(client.docmd("BOGUS")[0], 500)
+        client.ehlo()
+        self.assertIn("8bitmime", client.esmtp_features)
+        self.assertEqual(client.docmd("DATA"), (503, b"Error: need RCPT command"))
+        self.assertEqual(client.docmd("RCPT TO:<you@example.com>"), (503, b"Error: need MAIL command"))
+        self.assertEqual(client.docmd("MAIL FROM:<me@example.com> BODY=BINARY")[0], 501)
+        self.assertEqual(client.docmd("MAIL FROM:<me@example.com> FOO=BAR")[0], 555)
+        self.assertEqual(client.docmd("MAIL FROM:<me@example.com>"), (250, b"OK"))
+        self.assertEqual(client.docmd("MAIL FROM:<me@example.com>"), (503, b"Error: nested MAIL command"))
+        self.assertEqual(client.rset(), (250, b"OK"))
+        self.assertEqual(client.verify("you@example.com")[0], 252)
+        self.assertEqual(client.noop(), (250, b"OK"))
+        self.assertEqual(client.quit()[0], 221)
+
+    @patch("salmon.server.routing.Router")
+    def test_bdat(self, router_mock):
+        client = self.client()
+        client.ehlo()
+        self.assertIn("pipelining", client.esmtp_features)
+        self.assertIn("chunking", client.esmtp_features)
+        client.mail("me@example.com")
+        client.rcpt("you@example.com")
+
+        client.send(b"BDAT 18\r\nSubject: hello\r\n\r\n")
+        self.assertEqual(client.getreply(), (250, b"18 octets received"))
+        client.send(b"BDAT 13 LAST\r\n.dotted\r\nbody")
+        self.assertEqual(client.getreply(), (250, b"OK"))
+
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        msg = router_mock.deliver.call_args[0][0]
+        self.assertEqual(msg.To, "you@example.com")
+        self.assertEqual(msg.Data, b"Subject: hello\n\n.dotted\nbody")
+
+        # the transaction is over
+        client.send(b"BDAT 0 LAST\r\n")
+        self.assertEqual(client.getreply(), (503, b"Error: need RCPT command"))
+
+    @patch("salmon.server.routing.Router")
+    def test_bdat_errors(self, router_mock):
+        client = self.client()
+        client.send(b"BDAT 5\r\nhello")
+        self.assertEqual(client.getreply(), (503, b"Error: send HELO first"))
+        client.ehlo()
+        client.send(b"BDAT 5 LAST\r\nhello")
+        self.assertEqual(client.getreply(), (503, b"Error: need RCPT command"))
+
+        client.mail("me@example.com")
+        client.rcpt("you@example.com")
+        client.send(b"BDAT 5\r\nhello")
+        self.assertEqual(client.getreply(), (250, b"5 octets received"))
+        self.assertEqual(client.docmd("DATA"), (503, b"Error: DATA can't be used after BDAT"))
+
+        # the stream can't be followed after this
+        self.assertEqual(client.docmd("BDAT lots"), (501, b"Syntax: BDAT <chunk-size> [LAST]"))
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            client.noop()
+        self.assertEqual(router_mock.deliver.call_count, 0)
+
+    @patch("salmon.server.routing.Router")
+    def test_pipelining(self, router_mock):
+        client = self.client()
+        client.ehlo()
+        client.send(b"MAIL FROM:<me@example.com>\r\n"
+                    b"RCPT TO:<you@example.com>\r\n"
+                    b"RCPT TO:<them@example.com>\r\n"
+                    b"BDAT 5 LAST\r\nhello"
+                    b"NOOP\r\n")
+        replies = [client.getreply() for i in range(5)]
+        self.assertEqual(replies, [
+            (250, b"OK"),
+            (250, b"OK"),
+            (451, b"Will not accept multiple recipients in one transaction"),
+            (250, b"OK"),
+            (250, b"OK"),
+        ])
+        self.assertEqual(router_mock.deliver.call_args[0][0].Data, b"hello")
+
+    @patch("salmon.server.routing.Router")
+    def test_pipelining_latency(self, router_mock):
+        # 50ms round trips
+        proxy = DelayProxy(self.receiver.port, 0.025)
+        self.addCleanup(proxy.close)
+
+        start = time.monotonic()
+        client = smtplib.SMTP("127.0.0.1", proxy.port)
+        client.sendmail("me@example.com", "you@example.com", b"hello")
+        client.quit()
+        lockstep = time.monotonic() - start
+
+        start = time.monotonic()
+        client = smtplib.SMTP("127.0.0.1", proxy.port)
+        client.ehlo()
+        client.send(b"MAIL FROM:<me@example.com>\r\nRCPT TO:<you@example.com>\r\nBDAT 5 LAST\r\nhelloQUIT\r\n")
+        replies = [client.getreply()[0] for i in range(4)]
+        client.close()
+        pipelined = time.monotonic() - start
+
+        self.assertEqual(replies, [250, 250, 250, 221])
+        self.assertEqual(router_mock.deliver.call_count, 2)
+        # greeting, EHLO, MAIL, RCPT, DATA, end of data and QUIT are each a
+        # round trip without pipelining, but pipelined it's greeting, EHLO and
+        # then everything else
+        self.assertLess(pipelined, lockstep * 0.75)
+
+    def test_process_message(self):
+        msg = generate_mail()
+
+        with patch("salmon.server.routing.Router") as router_mock, \
+                patch("salmon.server.undeliverable_message") as undeliverable_mock:
+            router_mock.deliver.side_effect = Exception()
+            response = self.receiver.process_message(msg.Peer, msg.From, msg.To, str(msg))
+            assert response is None, response
+            self.assertEqual(undeliverable_mock.call_count, 1)
+
+
+class AsyncLMTPReceiverTestCase(SalmonTestCase):
+    def start_receiver(self, **kwargs):
+        receiver = server.AsyncLMTPReceiver(**kwargs)
+        receiver.start()
+        self.addCleanup(receiver.stop)
+        return receiver
+
+    def client(self, *args):
+        client = smtplib.LMTP(*args)
+        self.addCleanup(client.close)
+        return client
+
+    @patch("salmon.server.routing.Router")
+    def test_spool(self, router_mock):
+        receiver = self.start_receiver(host="127.0.0.1", port=0, spool="run/spool")
+        client = self.client("127.0.0.1", receiver.port)
+
+        client.ehlo()
+        client.mail("me@example.com")
+        client.rcpt("bob@y.com")
+        client.rcpt("al@z.com")
+        self.assertEqual(client.data(b"Subject: hello\r\n\r\nbody"), (250, b"2.0.0 OK"))
+        self.assertEqual(client.getreply(), (250, b"2.0.0 OK"))
+        client.quit()
+
+        # spooled once for both recipients
+        self.assertEqual(router_mock.deliver.call_count, 0)
+        self.assertEqual(len(queue.Queue("run/spool")), 1)
+
+        queue_receiver = server.QueueReceiver("run/spool", envelope=True)
+        queue_receiver.start(one_shot=True)
+        self.assertEqual([args[0][0].To for args in router_mock.deliver.call_args_list], ["bob@y.com", "al@z.com"])
+
+    @patch("salmon.server.routing.Router")
+    def test_relay(self, router_mock):
+        def deliver(msg):
+            if msg.To == "nobody@example.com":
+                raise server.SMTPError(550, "No such user")
+
+        router_mock.deliver.side_effect = deliver
+        receiver = self.start_receiver(host="127.0.0.1", port=0)
+        relay = server.Relay("127.0.0.1", port=receiver.port, lmtp=True)
+        msg = mail.MailRequest("localhost", None, None, b"From: me@example.com\nTo: you@example.com\n\nbody")
+        self.assertFalse(msg.is_modified())
+
+        # one reply is read for each recipient, so the QUIT after them gets its own
+        relay.deliver(msg, To=["you@example.com", "nobody@example.com"], From="me@example.com")
+        self.assertEqual([c[0][0].To for c in router_mock.deliver.call_args_list],
+                         ["you@example.com", "nobody@example.com"])
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            relay.deliver(msg, To=["nobody@example.com"], From="me@example.com")
+
+    @patch("salmon.server.routing.Router")
+    def test_per_recipient_replies(self, router_mock):
+        def deliver(msg):
+            if msg.To == "nobody@example.com":
+                raise server.SMTPError(550, "No such user")
+
+        router_mock.deliver.side_effect = deliver
+        receiver = self.start_receiver(host="127.0.0.1", port=0)
+        client = self.client("127.0.0.1", receiver.port)
+
+        client.ehlo()
+        self.assertIn("pipelining", client.esmtp_features)
+        self.assertIn("enhancedstatuscodes", client.esmtp_features)
+        self.assertEqual(client.mail("me@example.com"), (250, b"2.0.0 OK"))
+        self.assertEqual(client.rcpt("you@example.com"), (250, b"2.0.0 OK"))
+        self.assertEqual(client.rcpt("nobody@example.com"), (250, b"2.0.0 OK"))
+        self.assertEqual(client.rcpt("them@example.com"), (250, b"2.0.0 OK"))
+
+        self.assertEqual(client.data(b"hello"), (250, b"2.0.0 OK"))
+        self.assertEqual(client.getreply(), (550, b"5.0.0 No such user"))
+        self.assertEqual(client.getreply(), (250, b"2.0.0 OK"))
+
+        self.assertEqual(router_mock.deliver.call_count, 3)
+        self.assertEqual([c[0][0].To for c in router_mock.deliver.call_args_list],
+                         ["you@example.com", "nobody@example.com", "them@example.com"])
+
+    @patch("salmon.server.routing.Router")
+    def test_bdat(self, router_mock):
+        router_mock.deliver.side_effect = [None, server.SMTPError(550, "No such user")]
+        receiver = self.start_receiver(host="127.0.0.1", port=0)
+        client = self.client("127.0.0.1", receiver.port)
+        client.ehlo()
+        self.assertIn("chunking", client.esmtp_features)
+        client.send(b"MAIL FROM:<me@example.com>\r\n"
+                    b"RCPT TO:<you@example.com>\r\n"
+                    b"RCPT TO:<nobody@example.com>\r\n"
+                    b"BDAT 5\r\nhello"
+                    b"BDAT 0 LAST\r\n")
+        replies = [client.getreply() for i in range(6)]
+        self.assertEqual(replies, [
+            (250, b"2.0.0 OK"),
+            (250, b"2.0.0 OK"),
+            (250, b"2.0.0 OK"),
+            (250, b"2.0.0 5 octets received"),
+            (250, b"2.0.0 OK"),
+            (550, b"5.0.0 No such user"),
+        ])
+        self.assertEqual(router_mock.deliver.call_args[0][0].Data, b"hello")
+
+    def test_helo_not_allowed(self):
+        receiver = self.start_receiver(host="127.0.0.1", port=0)
+        client = self.client("127.0.0.1", receiver.port)
+        self.assertEqual(client.helo()[0], 500)
+
+    @patch("salmon.server.routing.Router")
+    def test_unix_socket(self, router_mock):
+        path = os.path.abspath("run/lmtp.sock")
+        receiver = self.start_receiver(socket=path)
+        self.assertEqual(receiver.socket, path)
+
+        client = self.client(path)
+        client.sendmail("me@example.com", "you@example.com", "hello")
+        self.assertEqual(router_mock.deliver.call_count, 1)
+        client.quit()
+        receiver.stop()
+
+        # stale sockets are cleaned up
+        self.assertTrue(os.path.exists(path))
+        receiver = self.start_receiver(socket=path)
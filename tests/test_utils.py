@@ -1,7 +1,11 @@
 from tempfile import mkdtemp
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 import os
+import signal
+import socket
+import threading
+import time
 
 from salmon import utils
 
@@ -138,3 +142,163 @@ class DaemonizeTestCase(TestCase):
         self.assertEqual(context.stderr.name, os.path.join(self.tmp_dir, "logs", "salmon.err"))
         self.assertEqual(context.pidfile.path, os.path.join("run", "tests.pid"))
         self.assertEqual(context.umask, 2)
+
+
+class WaitForStopTestCase(SalmonTestCase):
+    def send_signal(self, signum, delay=0.1):
+        timer = threading.Timer(delay, os.kill, args=(os.getpid(), signum))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def test_sigterm(self):
+        receiver = Mock()
+        self.send_signal(signal.SIGTERM)
+        with patch("salmon.utils.restart_process") as restart_mock:
+            utils.wait_for_stop(receiver)
+
+        self.assertEqual(receiver.stop.call_args, ((receiver.drain_timeout,), {}))
+        self.assertEqual(restart_mock.call_count, 0)
+        # handlers are put back
+        self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    @patch("salmon.utils.os._exit")
+    @patch("salmon.utils.restart_process")
+    def test_sigusr2(self, restart_mock, exit_mock):
+        receiver = Mock()
+        self.send_signal(signal.SIGUSR2)
+        utils.wait_for_stop(receiver)
+
+        self.assertEqual(restart_mock.call_args, (([receiver.sock],), {}))
+        self.assertEqual(receiver.stop.call_args, ((receiver.drain_timeout,), {}))
+        self.assertEqual(exit_mock.call_args, ((0,), {}))
+
+    @patch("salmon.utils.os._exit")
+    @patch("salmon.utils.restart_process", return_value=None)
+    def test_restart_failed(self, restart_mock, exit_mock):
+        receiver = Mock()
+        self.send_signal(signal.SIGUSR2)
+        self.send_signal(signal.SIGTERM, 1.5)
+        utils.wait_for_stop(receiver)
+
+        # the receiver kept going until it was told to stop
+        self.assertEqual(restart_mock.call_count, 1)
+        self.assertEqual(receiver.stop.call_count, 1)
+        self.assertEqual(exit_mock.call_count, 0)
+
+    def test_restart_process(self):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+
+        def execve(path, argv, env):
+            # stands in for the new process starting its receiver
+            os.environ[utils.READY_FD_ENV] = env[utils.READY_FD_ENV]
+            utils.notify_ready()
+            os._exit(0)
+
+        with patch("salmon.utils.os.execve", side_effect=execve):
+            new_pid = utils.restart_process([sock])
+        self.assertEqual(os.waitpid(new_pid, 0), (new_pid, 0))
+
+        # one that exits before it's ready is noticed straight away, and one
+        # that takes too long is killed
+        with patch("salmon.utils.os.execve", side_effect=OSError):
+            self.assertIsNone(utils.restart_process([sock]))
+        with patch("salmon.utils.os.execve", side_effect=lambda *args: time.sleep(60)):
+            started = time.monotonic()
+            self.assertIsNone(utils.restart_process([sock], timeout=0.5))
+        self.assertLess(time.monotonic() - started, 10)
+
+    def test_restarted_from(self):
+        with open("run/fake.pid", "w") as pid_file:
+            pid_file.write("1234\n")
+
+        self.assertFalse(utils._restarted_from("run/fake.pid"))
+        with patch.dict(os.environ, {"SALMON_RESTART": "4321"}):
+            self.assertFalse(utils._restarted_from("run/fake.pid"))
+        with patch.dict(os.environ, {"SALMON_RESTART": "1234"}):
+            self.assertTrue(utils._restarted_from("run/fake.pid"))
+            self.assertNotIn("SALMON_RESTART", os.environ)
+
+
+class FakeReceiver:
+    """Writes the pid of each worker to run/workers and then idles"""
+    def start(self):
+        with open(os.path.join("run", "workers", str(os.getpid())), "w"):
+            pass
+        threading.Thread(target=time.sleep, args=(60,)).start()
+
+
+class SuperviseTestCase(SalmonTestCase):
+    def wait_for_workers(self, count):
+        for i in range(100):
+            workers = [int(pid) for pid in os.listdir("run/workers")]
+            if len(workers) >= count:
+                return workers
+            time.sleep(0.05)
+        raise AssertionError("Only %d workers started" % len(workers))
+
+    def test_supervise(self):
+        os.mkdir("run/workers")
+        supervisor = os.fork()
+        if supervisor == 0:
+            try:
+                utils.supervise(FakeReceiver(), 2, respawn_delay=0)
+            finally:
+                os._exit(0)
+
+        try:
+            workers = self.wait_for_workers(2)
+            self.assertEqual(len(workers), 2)
+
+            # dead workers get replaced
+            os.kill(workers[0], signal.SIGKILL)
+            workers = self.wait_for_workers(3)
+
+            # SIGTERM is passed on and then the supervisor exits
+            os.kill(supervisor, signal.SIGTERM)
+            self.assertEqual(os.waitpid(supervisor, 0), (supervisor, 0))
+        except Exception:
+            os.kill(supervisor, signal.SIGKILL)
+            raise
+
+        for worker in workers:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(worker, 0)
+
+    @patch("salmon.utils.signal.signal")
+    def test_stop_while_respawning(self, signal_mock):
+        supervisor = utils.Supervisor(FakeReceiver(), 1, respawn_delay=60)
+        supervisor.spawn = Mock(side_effect=lambda: supervisor.workers.setdefault(1234, time.monotonic()))
+
+        def sleep(seconds):
+            # SIGTERM arrives while waiting to replace the dead worker
+            supervisor.forward(signal.SIGTERM, None)
+
+        with patch("salmon.utils.os.wait", side_effect=[(1234, 9), ChildProcessError]), \
+                patch("salmon.utils.time.sleep", side_effect=sleep), \
+                patch("salmon.utils.os.kill"):
+            supervisor.run()
+        self.assertEqual(supervisor.spawn.call_count, 1)
+        self.assertEqual(supervisor.workers, {})
+
+    @patch("salmon.utils.restart_process", return_value=None)
+    def test_restart_failed(self, restart_mock):
+        supervisor = utils.Supervisor(Mock(), 1)
+        supervisor.workers[1234] = time.monotonic()
+        with patch("salmon.utils.os.kill") as kill_mock:
+            supervisor.restart(signal.SIGUSR2, None)
+        # the workers carry on
+        self.assertEqual(kill_mock.call_count, 0)
+        self.assertFalse(supervisor.stopping)
+        self.assertFalse(supervisor.restarted)
+
+    @patch("salmon.utils.supervise")
+    @patch("salmon.utils.daemonize")
+    def test_start_server_processes(self, daemon_mock, supervise_mock):
+        settings = Mock()
+        utils.start_server("run/fake.pid", False, None, ".", None, None, None, lambda: settings, False, True,
+                           processes=4)
+        self.assertEqual(supervise_mock.call_args, ((settings.receiver, 4), {}))
+        self.assertEqual(settings.receiver.start.call_count, 0)